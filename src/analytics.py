@@ -0,0 +1,215 @@
+"""columnar scans and vectorised aggregates over a DTweets archive.
+    needs NumPy (optional; everything else in tt works without it)
+"""
+import itertools
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# date is stored either as 'YYYY-MM-DD HH:MM:SS' or as Twitter's created_at
+# ('Wed May 23 06:01:13 +0000 2007'), both UTC; strftime() only parses the
+# first, so created_at is rearranged into it (see DTweets_compact.encode_date)
+_DATE_SECONDS = """CAST(CASE WHEN date GLOB '[0-9]*'
+        THEN strftime('%s', date)
+        ELSE strftime('%s', substr(date, 27, 4) || '-'
+            || substr('0' || ((instr('JanFebMarAprMayJunJulAugSepOctNovDec',
+                substr(date, 5, 3)) + 2) / 3), -2)
+            || '-' || substr(date, 9, 2) || ' ' || substr(date, 12, 8))
+        END AS INTEGER)"""
+
+# column name -> SQL expression giving an integer; NULLs read as 0 and
+# date as seconds since epoch
+COLUMN_EXPRESSIONS = {
+        'tweet_id': 'tweet_id',
+        'user': 'IFNULL(user, 0)',
+        'date': 'IFNULL(%s, 0)' % _DATE_SECONDS,
+        'retweeted_count': 'IFNULL(retweeted_count, 0)',
+        'fav_count': 'IFNULL(fav_count, 0)',
+        'is_retweet': 'IFNULL(is_retweet, 0)',
+        'is_my_fav': 'IFNULL(is_my_fav, 0)',
+        'in_reply_to_user': 'IFNULL(in_reply_to_user, 0)',
+        'in_reply_to_tweet': 'IFNULL(in_reply_to_tweet, 0)',
+        }
+DEFAULT_COLUMNS = ['tweet_id', 'user', 'date', 'retweeted_count',
+        'fav_count', 'is_retweet']
+# rows converted per fetchmany() round trip
+DEFAULT_BATCH_SIZE = 50000
+SECONDS_PER_DAY = 86400
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('analytics needs NumPy; pip install numpy')
+
+def read_partition(part_inst, columns=DEFAULT_COLUMNS, where=None,
+        params=None, batch_size=DEFAULT_BATCH_SIZE):
+    """reads columns of one DTweets_part into {column: int64 array}.
+        where is an optional SQL condition, e.g. 'tweet_id >= :since_id'
+        (see DTweets.snowflake_id_at())
+    """
+    _require_numpy()
+    for column in columns:
+        if not column in COLUMN_EXPRESSIONS:
+            raise ValueError('unknown column: %s' % column)
+    query = 'SELECT %s FROM tweets' % ','.join(
+            COLUMN_EXPRESSIONS[column] for column in columns)
+    if where:
+        query += ' WHERE %s' % where
+
+    cursor = part_inst.get_db().cursor()
+    # plain tuples are much cheaper to build than sqlite3.Row
+    cursor.row_factory = None
+    if params is None:
+        cursor.execute(query)
+    else:
+        cursor.execute(query, params)
+    chunks = []
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            chunks.append(numpy.fromiter(
+                itertools.chain.from_iterable(rows), dtype=numpy.int64,
+                count=len(rows) * len(columns)).reshape(-1, len(columns)))
+    finally:
+        cursor.close()
+    if chunks:
+        table = numpy.concatenate(chunks)
+    else:
+        table = numpy.zeros((0, len(columns)), dtype=numpy.int64)
+    return dict((column, numpy.ascontiguousarray(table[:, i]))
+            for (i, column) in enumerate(columns))
+
+def map_columns(tweets, func, columns=DEFAULT_COLUMNS, where=None,
+        params=None, batch_size=DEFAULT_BATCH_SIZE):
+    """reads columns of each partition of a DTweets and returns
+        [func(arrays), ..] in partition order. partitions are read in
+        parallel when the DTweets was created with parallelism > 1; reducing
+        inside func keeps memory bounded to one partition per worker
+    """
+    _require_numpy()
+    def run(part_name, part_inst):
+        return func(read_partition(part_inst, columns, where, params,
+            batch_size))
+    return tweets.map_partitions(run)
+
+def scan_columns(tweets, columns=DEFAULT_COLUMNS, where=None, params=None,
+        batch_size=DEFAULT_BATCH_SIZE):
+    """reads columns of the whole archive into {column: int64 array}"""
+    parts = map_columns(tweets, lambda arrays: arrays, columns, where,
+            params, batch_size)
+    if not parts:
+        return dict((column, numpy.zeros(0, dtype=numpy.int64))
+                for column in columns)
+    return dict((column, numpy.concatenate([arrays[column] for arrays in parts]))
+            for column in columns)
+
+def group_count(*key_arrays):
+    """counts rows per distinct key (one or more arrays of equal length).
+        returns ([unique keys per array, ..], counts), sorted by key
+    """
+    _require_numpy()
+    if len(key_arrays) == 1:
+        (keys, counts) = numpy.unique(key_arrays[0], return_counts=True)
+        return ([keys], counts)
+    packed = _pack_keys(key_arrays)
+    if packed is not None:
+        # one int64 per row; far cheaper than unique(axis=0)
+        (combined, offsets, sizes) = packed
+        (keys, counts) = numpy.unique(combined, return_counts=True)
+        return (_unpack_keys(keys, offsets, sizes), counts)
+    (keys, counts) = numpy.unique(numpy.column_stack(key_arrays), axis=0,
+            return_counts=True)
+    return ([keys[:, i] for i in xrange(keys.shape[1])], counts)
+
+def _pack_keys(key_arrays):
+    """packs several int arrays into one int64 array preserving their sort
+        order; returns (packed, offsets, sizes) or None if they don't fit
+    """
+    if not len(key_arrays[0]):
+        return None
+    offsets = [int(a.min()) for a in key_arrays]
+    sizes = [int(a.max()) - offset + 1 for (a, offset) in zip(key_arrays, offsets)]
+    total = 1
+    for size in sizes:
+        total *= size
+    if total >= 2 ** 62:
+        return None
+    packed = numpy.zeros(len(key_arrays[0]), dtype=numpy.int64)
+    for (a, offset, size) in zip(key_arrays, offsets, sizes):
+        packed *= size
+        packed += a - offset
+    return (packed, offsets, sizes)
+
+def _unpack_keys(packed, offsets, sizes):
+    """inverse of _pack_keys(); returns a list of arrays"""
+    keys = []
+    for (offset, size) in reversed(zip(offsets, sizes)):
+        keys.append(packed % size + offset)
+        packed = packed // size
+    return keys[::-1]
+
+def merge_counts(results):
+    """merges group_count() results (e.g. one per partition) into one"""
+    _require_numpy()
+    results = [r for r in results if len(r[1])]
+    if not results:
+        return ([], numpy.zeros(0, dtype=numpy.int64))
+    key_count = len(results[0][0])
+    keys = [numpy.concatenate([r[0][i] for r in results])
+            for i in xrange(key_count)]
+    counts = numpy.concatenate([r[1] for r in results])
+    packed = _pack_keys(keys) if key_count > 1 else None
+    if key_count == 1:
+        (unique, inverse) = numpy.unique(keys[0], return_inverse=True)
+        unique = [unique]
+    elif packed is not None:
+        (unique, inverse) = numpy.unique(packed[0], return_inverse=True)
+        unique = _unpack_keys(unique, packed[1], packed[2])
+    else:
+        (unique, inverse) = numpy.unique(numpy.column_stack(keys), axis=0,
+                return_inverse=True)
+        unique = [unique[:, i] for i in xrange(unique.shape[1])]
+    return (unique, numpy.bincount(inverse, weights=counts).astype(numpy.int64))
+
+def histogram(values, bins=None):
+    """distribution of values. with bins=None every integer value from 0 to
+        max(values) is its own bin (values must be >= 0) and (values,
+        counts) is returned; otherwise numpy.histogram(values, bins), which
+        returns (counts, bin_edges)
+    """
+    _require_numpy()
+    if bins is None:
+        counts = numpy.bincount(values)
+        present = numpy.nonzero(counts)[0]
+        return (present, counts[present])
+    return numpy.histogram(values, bins)
+
+def top_k(keys, k=10, weights=None):
+    """the k keys with the most rows (or largest sum of weights), largest
+        first; returns (keys, scores)
+    """
+    _require_numpy()
+    (unique, inverse) = numpy.unique(keys, return_inverse=True)
+    scores = numpy.bincount(inverse, weights=weights)
+    if weights is None:
+        scores = scores.astype(numpy.int64)
+    if k < len(unique):
+        best = numpy.argpartition(-scores, k - 1)[:k]
+    else:
+        best = numpy.arange(len(unique))
+    best = best[numpy.argsort(-scores[best], kind='mergesort')]
+    return (unique[best], scores[best])
+
+def tweets_per_user_per_day(tweets):
+    """group_count() of (user, day number since epoch) over the archive;
+        counted per partition, then merged
+    """
+    return merge_counts(map_columns(tweets,
+        lambda a: group_count(a['user'], a['date'] // SECONDS_PER_DAY),
+        ['user', 'date']))
+
+def retweet_count_distribution(tweets):
+    """histogram() of retweeted_count over the archive"""
+    return histogram(scan_columns(tweets, ['retweeted_count'])['retweeted_count'])
@@ -5,11 +5,24 @@ import os
 import time
 import sys
 import hashlib
+import collections
+import heapq
+import threading
+import shutil
+import operator
+import struct
+import zlib
+import calendar
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 try:
     import simplejson as json
 except:
     import json
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 def make_dict(tup_list, omit_if_none=True):
@@ -22,8 +35,64 @@ def make_dict(tup_list, omit_if_none=True):
     return res    
 
 
+def _decode_json(in_str):
+    return json.loads(in_str)
+
+def _decode_datetime(in_str):
+    return datetime.strptime(in_str, '%Y-%m-%d %H:%M:%S')
+
+
 # TODO: create singleton to reuse database connection (if same DSN)
 class DObject(object):
+    # (class name, absolute filename) of files whose schema has already been
+    # initialized by this process; see get_db()
+    _initialized_files = set()
+    # keys that should exist in a row; 'col#' marks a JSON column
+    ROW_REQUIREMENT = []
+    # columns holding 'YYYY-MM-DD HH:MM:SS' strings
+    DATETIME_COLUMNS = ['last_update']
+    # (class, cursor.description) -> row decoding plan; see _row_plan()
+    _row_plans = {}
+    # (table, operation, columns, key columns) -> (sql, extractor); see
+    # _statement()
+    _statements = {}
+    # SQL text of the _make_*_clause() builders, keyed by column shape
+    _clause_texts = {}
+    # column names of a ROW_REQUIREMENT-style list -> (writable, JSON) sets;
+    # see _parse_column_specs()
+    _column_specs = {}
+    # named sets of PRAGMAs applied right after connecting; pick one with
+    # the profile argument of the constructor (None = sqlite defaults)
+    CONNECTION_PROFILES = {
+        # bulk writers: WAL, fsync only at checkpoints, big page cache
+        'ingest': [
+            ('busy_timeout', 5000),
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -65536),
+            ('mmap_size', 268435456),
+            ('temp_store', 'MEMORY'),
+            ],
+        # readers running next to a writer (e.g. tt_task timelines)
+        'read-mostly': [
+            ('busy_timeout', 10000),
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('cache_size', -32768),
+            ('mmap_size', 1073741824),
+            ('temp_store', 'MEMORY'),
+            ],
+        # every commit is durable (settings, profiles)
+        'safe': [
+            ('busy_timeout', 5000),
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'FULL'),
+            ],
+        }
+    # bound parameters per statement; SQLITE_MAX_VARIABLE_NUMBER is 999 on
+    # older builds
+    MAX_SQL_VARIABLES = 900
+
     def debug_msg(self, *args):
         if not self.__verbose:
             return True
@@ -37,6 +106,11 @@ class DObject(object):
             self.__db.close()
             self.__db = None
 
+    def commit(self):
+        '''commits the current transaction, if a connection is open'''
+        if isinstance(self.__db, sqlite3.Connection):
+            self.__db.commit()
+
     def get_db(self):
         '''get database instance; if not established then create'''
         if not isinstance(self.__db, sqlite3.Connection):
@@ -46,11 +120,33 @@ class DObject(object):
                 parent_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
                 fn = parent_dir + fn[2:]
             
+            # schema checks run once per file per process (unless the file
+            # has disappeared in the meantime)
+            init_key = (self.__class__.__name__, os.path.abspath(fn))
+            need_init = (init_key not in DObject._initialized_files
+                    or not os.path.isfile(fn))
             self.__db= sqlite3.connect(fn, isolation_level=self.__dsn[1])
             self.__db.row_factory= sqlite3.Row
-            self.__run_init_queries()
+            self.__apply_profile()
+            if need_init:
+                self.__run_init_queries()
+                self.__run_migrations()
+                DObject._initialized_files.add(init_key)
         return self.__db 
 
+    def __apply_profile(self):
+        '''runs the PRAGMAs of the connection profile'''
+        if self.__profile is None:
+            return True
+        for (pragma, value) in self.CONNECTION_PROFILES[self.__profile]:
+            self.debug_msg('PRAGMA %s=%s' % (pragma, value))
+            self.__db.execute('PRAGMA %s=%s' % (pragma, value)).fetchall()
+        return True
+
+    @property
+    def profile(self):
+        return self.__profile
+
     def __run_init_queries(self):
         '''initializes DB; just have a connection before calling this method'''
         query_list= []
@@ -66,6 +162,23 @@ class DObject(object):
         else:
             self.debug_msg('no initial queries')
             return True
+
+    def __run_migrations(self):
+        '''brings an existing database file up to date. migrations is a list of
+            query lists; the N-th item is applied once, then PRAGMA user_version
+            is set to N so the next connection skips it
+        '''
+        if not self.__migrations:
+            return True
+        version = self.q('PRAGMA user_version', None, 'NUMBER')
+        for idx in range(version, len(self.__migrations)):
+            self.debug_msg('Migrating schema to version', idx + 1)
+            self.q_multiple(self.__migrations[idx],
+                    result_type='NUMBER_OF_ROWS_AFFECTED')
+            self.q('PRAGMA user_version = %d' % (idx + 1), None,
+                    'NUMBER_OF_ROWS_AFFECTED')
+        self.__db.commit()
+        return True
     
     @property
     def dsn(self):
@@ -85,11 +198,18 @@ class DObject(object):
             except:
                 raise Exception('unable to create directory %s' % dirname)
 
-    def __init__(self, dsn, init_queries=None, verbose=False):
-        '''initializes a DObject'''
+    def __init__(self, dsn, init_queries=None, verbose=False, migrations=None,
+            profile=None):
+        '''initializes a DObject; profile is a key of CONNECTION_PROFILES'''
+        if profile is not None and not profile in self.CONNECTION_PROFILES:
+            raise ValueError('unknown connection profile: %s' % profile)
+        self.__profile = profile
         self.__verbose = verbose
         self.__init_queries = init_queries
+        self.__migrations = migrations
         self.__db = None
+        self.__last_description = None
+        self.__last_plan = None
         self.__init_dsn(dsn)
 
     def q_multiple(self, q_list, result_type='ALL_ROWS', auto_commit=False):
@@ -121,37 +241,10 @@ class DObject(object):
                     concatenate tuples and dicts with a list [{..},{..},..] 
                 result_type -- string or int; should be "ALL_ROWS", "ALL_DICTS","ONE_ROW", "ONE_DICT", N, "NUMBER",
                     "CURSOR", 'LAST_ROWID','NUMBER_OF_ROWS_AFFECTED'
-                    for "ONE_DICT" or "ALL_DICTS", json strings are automatically expanded into objects 
-        '''
-        def dict_factory(cursor, row):
-            '''create a dict from a row, with auto-detection of JSON, datetime '''
-            result_dict = {}
-            # string formats accepted
-            formats = [
-                    # json -> list or dict 
-                    (regex.compile('^\{.*\}$|^\[.*\]$'), 
-                        lambda in_str: json.loads(in_str)
-                    ),
-                    # datetime string
-                    (regex.compile('^[0-9]{4}\-[0-9]{2}\-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$'),
-                        lambda in_str: datetime.strptime(in_str, '%Y-%m-%d %H:%M:%S')
-                    ),
-                ]
-            for idx, col in enumerate(cursor.description):
-                field_data = row[idx]
-                # try to convert; if fail then fallback to raw values
-                if instance(field_data, basestring):
-                    for test_format in formats:
-                        if test_format[0].search(field_data):
-                            try:
-                                field_data = test_format[1](field_data)
-                                break
-                            except ValueError:
-                                pass
-                result_dict[col[0]] = field_data 
-            return result_dict
-
-       # -- type check --
+                    for "ONE_DICT" or "ALL_DICTS", JSON columns (marked '#' in
+                    ROW_REQUIREMENT) and DATETIME_COLUMNS are decoded
+        '''
+        # -- type check --
         if not params is None:
             if not isinstance(params,dict) and not isinstance(params,tuple) and not isinstance(params,list):
                 raise TypeError('params should be of either dict,tuple,list type')
@@ -176,7 +269,9 @@ class DObject(object):
                 raise TypeError('query should be a str')
 
         result= False
-        self.get_db().row_factory = dict_factory if result_type == 'ONE_DICT' else sqlite3.Row 
+        self.get_db().row_factory = (self._dict_factory
+                if result_type in ('ONE_DICT', 'ALL_DICTS', 'ALL_DICT')
+                else sqlite3.Row)
         cursor= self.get_db().cursor()
         
         self.debug_msg('Query:', query.strip('\n\t '))
@@ -193,7 +288,7 @@ class DObject(object):
             result= None if row is None else row[0]
         elif 'ONE_ROW' == result_type or 'ONE_DICT' == result_type: 
             result= cursor.fetchone()
-        elif 'ALL_ROWS' == result_type or 'ALL_DICT' == result_type:
+        elif result_type in ('ALL_ROWS', 'ALL_DICTS', 'ALL_DICT'):
             result= cursor.fetchall()
         elif isinstance(result_type,int):
             # fetch N rows
@@ -215,6 +310,114 @@ class DObject(object):
 
         return result
 
+    @classmethod
+    def _json_columns(cls):
+        '''names of columns marked with '#' in ROW_REQUIREMENT'''
+        if not '_json_column_set' in cls.__dict__:
+            columns = set()
+            for k in cls.ROW_REQUIREMENT:
+                col_name = k[0] if isinstance(k, tuple) else k
+                if col_name[-1] == '#':
+                    columns.add(col_name[0:-1])
+            cls._json_column_set = columns
+        return cls._json_column_set
+
+    @classmethod
+    def _row_plan(cls, description):
+        '''returns (column_names, [(idx, column_name, decode_func), ..]) for a
+            cursor.description; built once per class and result shape
+        '''
+        key = (cls, description)
+        plan = cls._row_plans.get(key)
+        if plan is None:
+            json_columns = cls._json_columns()
+            column_names = tuple(col[0] for col in description)
+            decoders = []
+            for idx, col_name in enumerate(column_names):
+                if col_name in json_columns:
+                    decoders.append((idx, col_name, _decode_json))
+                elif col_name in cls.DATETIME_COLUMNS:
+                    decoders.append((idx, col_name, _decode_datetime))
+            plan = (column_names, decoders)
+            cls._row_plans[key] = plan
+        return plan
+
+    def _dict_factory(self, cursor, row):
+        '''create a dict from a row, decoding declared JSON/datetime columns'''
+        description = cursor.description
+        if description is not self.__last_description:
+            # same cursor -> same description object; skip the lookup
+            self.__last_plan = self._row_plan(description)
+            self.__last_description = description
+        (column_names, decoders) = self.__last_plan
+        result_dict = dict(zip(column_names, row))
+        for (idx, col_name, decode) in decoders:
+            field_data = row[idx]
+            # try to convert; if fail then fallback to raw values
+            if isinstance(field_data, basestring):
+                try:
+                    result_dict[col_name] = decode(field_data)
+                except ValueError:
+                    pass
+        return result_dict
+
+    def q_many(self, query, params_list, auto_commit=False):
+        '''executes one query once per item of params_list through a single
+            prepared statement (cursor.executemany). returns the number of
+            rows affected
+        '''
+        if not isinstance(query, str):
+            raise TypeError('query should be a str')
+
+        self.get_db().row_factory = sqlite3.Row
+        cursor = self.get_db().cursor()
+        self.debug_msg('Query:', query.strip('\n\t '))
+        self.debug_msg('Parameter sets:', len(params_list))
+        cursor.executemany(query, params_list)
+        result = cursor.rowcount
+
+        if auto_commit:
+            self.debug_msg('Committing...')
+            self.__db.commit()
+
+        self.debug_msg("Returning:", result)
+        return result
+
+    def insert_many(self, table_name, rows, on_operational_error='fail',
+            verb='INSERT OR REPLACE'):
+        '''inserts a list of row dicts without committing. rows sharing the
+            same column set are sent through one executemany() call.
+            on_operational_error = 'fail' (give up on the first error) or
+            'continue' (retry the failing group row by row, skipping bad rows)
+            returns the number of rows written, or False on failure
+        '''
+        if on_operational_error not in ('fail', 'continue'):
+            raise ValueError('''
+                expecting on_operational_error to be "continue" or "fail"
+                ''')
+        groups = collections.OrderedDict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+
+        written = 0
+        for columns, group in groups.iteritems():
+            (sql, extract) = self._statement(table_name, verb, columns)
+            values_list = map(extract, group)
+            try:
+                written += self.q_many(sql, values_list)
+            except sqlite3.OperationalError as e:
+                sys.stderr.write('unable to insert: %s\n' % str(e))
+                if on_operational_error == 'fail':
+                    return False
+                sys.stderr.write('...retrying row by row\n')
+                for values in values_list:
+                    try:
+                        written += self.q_many(sql, [values])
+                    except sqlite3.OperationalError as e:
+                        sys.stderr.write('unable to insert: %s\n' % str(e))
+                        sys.stderr.write('...ignoring and continue\n')
+        return written
+
     @classmethod
     def _make_set_clause(cls, kv_pairs_dict, accepted_columns_list=None,
             table_name='', parameter_prefix_str='par'):
@@ -232,92 +435,142 @@ class DObject(object):
             table_name --
             parameter_prefix_str -- (Default 'par')
         '''
-        sql_str_list= []
-        params_dict= {}
-        par_count= 0
-        
-        accepted_columns_list2 = []
-        json_column_list = []
-        for k in accepted_columns_list:
-            if isinstance(k, basestring):
-                if k[-1] == '*':
-                    continue
-                elif k[-1] == '#':
-                    json_column_list.append(k[0:-1])
-                    accepted_columns_list2.append(k[0:-1])
-                else:
-                    accepted_columns_list2.append(k)
-            elif isinstance(k, tuple):
-                col_name = k[0]
-                if col_name[-1] == '*':
+        if accepted_columns_list is None:
+            columns = tuple(kv_pairs_dict)
+            json_columns = frozenset()
+        else:
+            (accepted, json_columns) = cls._parse_column_specs(
+                    accepted_columns_list)
+            columns = tuple(c for c in kv_pairs_dict if c in accepted)
+
+        key = ('SET', table_name, parameter_prefix_str, columns)
+        param_names = ['%s_%d' % (parameter_prefix_str, i)
+                for i in xrange(len(columns))]
+        sql = cls._clause_texts.get(key)
+        if sql is None:
+            if table_name == '':
+                sql = ','.join('`%s`=:%s' % (c, p)
+                        for (c, p) in zip(columns, param_names))
+            else:
+                sql = ','.join('`%s`.`%s`=:%s' % (table_name, c, p)
+                        for (c, p) in zip(columns, param_names))
+            cls._clause_texts[key] = sql
+
+        params_dict = {}
+        for (column_name, param_name) in zip(columns, param_names):
+            val = kv_pairs_dict[column_name]
+            if column_name in json_columns:
+                # user explicitely requested the type to be JSONized
+                params_dict[param_name] = json.dumps(val)
+            else:
+                params_dict[param_name] = cls._sql_value(val)
+        return (sql, params_dict)
+
+    @classmethod
+    def _parse_column_specs(cls, accepted_columns_list):
+        '''splits a ROW_REQUIREMENT-style list into (writable column names,
+            JSON column names) frozensets. 'col*' columns are left out and
+            'col#' ones are JSON. cached per list of names
+        '''
+        names = tuple(k if isinstance(k, basestring) else k[0]
+                for k in accepted_columns_list)
+        specs = cls._column_specs.get(names)
+        if specs is None:
+            accepted = set()
+            json_columns = set()
+            for name in names:
+                if name[-1] == '*':
                     continue
-                elif col_name[-1] == '#':
-                    col_name = col_name[0:-1] 
-                    json_column_list.append(col_name)
-                    accepted_columns_list2.append(col_name)
-                else:
-                    accepted_columns_list2.append(col_name)
-
-        for column_name in kv_pairs_dict:
-            if (accepted_columns_list is None 
-                    or column_name in accepted_columns_list2 
-                    or column_name in json_column_list
-                    ): 
-                param_name = '%s_%s' % (parameter_prefix_str, par_count)
-                if table_name == '':
-                    sql_str_list.append('`%s`=:%s' % (column_name, param_name))
-                else:
-                    sql_str_list.append(
-                            '`%s`.`%s`=:%s' % (table_name, column_name, param_name))
-                    
-                # by default, just store whatever is passed, with exceptions below 
-                val = kv_pairs_dict[column_name]
-                if isinstance(val, datetime):
-                    # convert datetime type to sqlite-friendly string
-                    val.strftime('%Y-%m-%d %H:%M:%S')
-                elif column_name in json_column_list:
-                    # user explicitely requested the type to be JSONized
-                    val = json.dumps(val) 
-                else:
-                    if isinstance(val, dict) or isinstance(val, list):
-                        val = json.dumps(val)
-                        self.debug_msg('''
-                                WARNING: column %s: writing a list or dict type;
-                                encoding as JSON
-                                ''' % column_name)
-                params_dict[param_name] =val  
-                par_count+= 1
-        
-        return (','.join(sql_str_list), params_dict)
+                elif name[-1] == '#':
+                    name = name[0:-1]
+                    json_columns.add(name)
+                accepted.add(name)
+            specs = (frozenset(accepted), frozenset(json_columns))
+            cls._column_specs[names] = specs
+        return specs
+
+    @classmethod
+    def _statement(cls, table_name, operation, columns, key_columns=(),
+            json_columns=()):
+        '''returns a cached (sql, extractor) for a fixed column shape, for
+            use with q_many(). operation is 'INSERT', 'INSERT OR REPLACE',
+            'INSERT OR IGNORE' or 'UPDATE' (SET columns WHERE key_columns).
+            extractor(row_dict) returns the positional parameter list,
+            values converted by _sql_value() (json_columns by json.dumps())
+        '''
+        json_columns = frozenset(c for c in json_columns if c in columns)
+        key = (table_name, operation, tuple(columns), tuple(key_columns),
+                json_columns)
+        statement = cls._statements.get(key)
+        if statement is not None:
+            return statement
+
+        if operation == 'UPDATE':
+            columns = [c for c in columns if not c in key_columns]
+            if not columns or not key_columns:
+                raise ValueError('UPDATE needs columns and key_columns')
+            sql = 'UPDATE `%s` SET %s WHERE %s' % (table_name,
+                    ','.join('`%s`=?' % c for c in columns),
+                    ' AND '.join('`%s`=?' % c for c in key_columns))
+            params = tuple(columns) + tuple(key_columns)
+        elif operation in ('INSERT', 'INSERT OR REPLACE', 'INSERT OR IGNORE'):
+            if not columns:
+                raise ValueError('INSERT needs columns')
+            sql = '%s INTO `%s` %s' % (operation, table_name,
+                    cls._make_bulk_insert_clause(columns))
+            params = tuple(columns)
+        else:
+            raise ValueError('unknown operation: %s' % operation)
+
+        get = operator.itemgetter(*params)
+        sql_value = cls._sql_value
+        if json_columns:
+            encoders = [json.dumps if p in json_columns else sql_value
+                    for p in params]
+            extract = lambda row: [encode(row[p])
+                    for (encode, p) in zip(encoders, params)]
+        elif len(params) == 1:
+            extract = lambda row: [sql_value(get(row))]
+        else:
+            extract = lambda row: [sql_value(v) for v in get(row)]
+        statement = cls._statements[key] = (sql, extract)
+        return statement
+
+    @classmethod
+    def _sql_value(cls, data):
+        '''converts a python value into something sqlite can store'''
+        if isinstance(data, datetime):
+            return data.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(data, dict) or isinstance(data, list):
+            return json.dumps(data)
+        return data
+
+    @classmethod
+    def _make_bulk_insert_clause(cls, column_names):
+        '''generates a '(col1,col2,..) VALUES (?,?,..)' for use with q_many()'''
+        return '(%s) VALUES (%s)' % (
+                ','.join('`%s`' % c for c in column_names),
+                ','.join('?' * len(column_names)))
 
     @classmethod
     def _make_insert_clause(cls, kv_pairs_dict, parameter_prefix_str='par'):
         '''generates a '(col1,col2,..) VALUES (:par1,:par2,...)'
             and parameter dictionary
         '''
-        column_names_list=[]
-        par_names_list= []
-        params_dict= {}
-        par_count= 0
-        
-        for column_name,data in kv_pairs_dict.iteritems():
-            param_name= '%s_%d' % (parameter_prefix_str, par_count)
-            par_names_list.append(':'+param_name)
-            column_names_list.append('`%s`' % column_name)
-            if isinstance(data, datetime):
-                params_dict[param_name] = data.strftime('%y-%m-%d %H:%M:%S')
-            elif isinstance(data, dict) or isinstance(data, list): 
-                params_dict[param_name] = json.dumps(data)
-            else:
-                params_dict[param_name] = data 
-            par_count+= 1
-
-        return (
-                '(%s) VALUES (%s)' % (
-                ','.join(column_names_list),
-                ','.join(par_names_list)),
-                params_dict
-                )
+        columns = tuple(kv_pairs_dict)
+        param_names = ['%s_%d' % (parameter_prefix_str, i)
+                for i in xrange(len(columns))]
+        key = ('INSERT', parameter_prefix_str, columns)
+        sql = cls._clause_texts.get(key)
+        if sql is None:
+            sql = cls._clause_texts[key] = '(%s) VALUES (%s)' % (
+                    ','.join('`%s`' % c for c in columns),
+                    ','.join(':' + p for p in param_names))
+
+        params_dict = {}
+        for (column_name, param_name) in zip(columns, param_names):
+            params_dict[param_name] = cls._sql_value(kv_pairs_dict[column_name])
+        return (sql, params_dict)
         
     @classmethod
     def _make_where_clause(cls, criteria_dict, omit_if_null=True,
@@ -327,30 +580,30 @@ class DObject(object):
         '''
         glue_str = glue_str.strip()
 
-        criteria_list= []
-        params_dict= {}
-        par_count= 0
-
-        for col_name in criteria_dict:
-            if criteria_dict[col_name] is None:
-                if omit_if_null:
-                    continue
-                else:
-                    if table_name:
-                        criteria_list.append('`%s`.`%s` IS NULL' % (table_name, col_name))
-                    else:
-                        criteria_list.append('`%s` IS NULL' % col_name)
-                    continue
-
-            param_name= '%s_%d' % (parameter_prefix_str, par_count)
-            params_dict[param_name]= criteria_dict[col_name]
-            if table_name:
-                criteria_list.append('`%s`.`%s`=:%s' % (table_name, col_name, param_name))
-            else:
-                criteria_list.append('`%s`=:%s' % (col_name, param_name))
-            par_count+= 1
-
-        return ((' %s ' % glue_str).join(criteria_list), params_dict)
+        # the text depends on which columns are NULL, not on their values
+        columns = tuple(criteria_dict)
+        nulls = tuple(criteria_dict[c] is None for c in columns)
+        bound = [c for (c, is_null) in zip(columns, nulls) if not is_null]
+        param_names = ['%s_%d' % (parameter_prefix_str, i)
+                for i in xrange(len(bound))]
+        key = ('WHERE', parameter_prefix_str, glue_str, table_name,
+                omit_if_null, columns, nulls)
+        sql = cls._clause_texts.get(key)
+        if sql is None:
+            prefix = '`%s`.' % table_name if table_name else ''
+            names = iter(param_names)
+            criteria_list = []
+            for (col_name, is_null) in zip(columns, nulls):
+                if not is_null:
+                    criteria_list.append('%s`%s`=:%s' % (
+                        prefix, col_name, next(names)))
+                elif not omit_if_null:
+                    criteria_list.append('%s`%s` IS NULL' % (prefix, col_name))
+            sql = cls._clause_texts[key] = (' %s ' % glue_str).join(criteria_list)
+
+        params_dict = dict(zip(param_names,
+            [criteria_dict[c] for c in bound]))
+        return (sql, params_dict)
 
     @classmethod
     def _make_in_clause(cls, col_name, valu_list, parameter_prefix_str='inpar'):
@@ -363,7 +616,7 @@ class DObject(object):
             sql_list.append(':' + par_name)
             pars [par_name] = valu
             par_count += 1
-        return ('%d IN (%s)' % (col_name, ', '.join(sql_list)), pars)  
+        return ('`%s` IN (%s)' % (col_name, ', '.join(sql_list)), pars)  
 
     @classmethod
     def validate_dict(cls, subject_dict, search_for, on_extra='discard'):
@@ -400,7 +653,7 @@ class DObject(object):
                     search_for2.append(strip_trailing_star(search_for_item[0]))
                 else:
                     raise TypeError('expecting member of search_for to be either string or tuple')
-            for key in subject_dict:
+            for key in list(subject_dict):
                 if not key in search_for2:
                     if on_extra == 'fail':
                         return False
@@ -434,9 +687,9 @@ class DProfiles(DObject):
             ('auth_data#', None),
             ]
 
-    def __init__(self, directory='../var', verbose=False):
+    def __init__(self, directory='../var', verbose=False, profile=None):
         super(DProfiles,self).__init__(directory+'/'+self.DB_FILENAME,
-                self.INIT_QUERIES, verbose)
+                self.INIT_QUERIES, verbose, profile=profile)
     
     def exists(self, profile_alias):
         return 1 == self.q('''
@@ -463,13 +716,13 @@ class DProfiles(DObject):
         return res
 
     def get_access_tokens(self, profile_alias=None):
-        if profile_alis is None:
+        if profile_alias is None:
             rows = self.q('''
                     SELECT profile_alias, auth_flag, auth_data FROM profiles
                     WHERE auth_flag=:auth_flag
                     ORDER BY priority ASC
                     ''', 
-                    {'auth_flag': FLAG_AUTHENTICATED},
+                    {'auth_flag': self.FLAG_AUTHENTICATED},
                     'ALL_ROWS'
                     )
         else:
@@ -486,7 +739,7 @@ class DProfiles(DObject):
         
         result = []
         for row in rows:
-            if row['auth_flag'] != FLAG_AUTHENTICATED:
+            if row['auth_flag'] != self.FLAG_AUTHENTICATED:
                 self.debug_msg('''
                     unable to get access token: profile %s not flagged as
                     AUTHENTICATED
@@ -537,6 +790,95 @@ class DProfiles(DObject):
         return result 
 
 
+'''
+    Rate-limit snapshots (TpManager.update_api_limits) that outlive the
+    process; see TpManager.set_limit_store()
+'''
+class DRateLimits(DObject):
+    DB_FILENAME= 'tt_setup.db'
+    INIT_QUERIES= ['''
+        CREATE TABLE IF NOT EXISTS `rate_limits`(
+            profile_str TEXT NOT NULL,   /* TpManager.make_profile_str() */
+            kind TEXT NOT NULL,          /* 'tweepy' (method name) or 'api' (GET path) */
+            endpoint TEXT NOT NULL,
+            remaining INTEGER,
+            call_limit INTEGER,
+            reset_time INTEGER,          /* unix time when remaining is refilled */
+            call_time INTEGER,
+            PRIMARY KEY (profile_str, kind, endpoint)
+        )
+        ''']
+    KINDS = ('tweepy', 'api')
+
+    def __init__(self, directory='../var', verbose=False, profile=None):
+        super(DRateLimits,self).__init__(directory+'/'+self.DB_FILENAME,
+                self.INIT_QUERIES, verbose, profile=profile)
+
+    def save(self, profile_str, kind, endpoint, limit_info, auto_close=True):
+        '''stores one limit_info {'remaining':..,'limit':..,'reset_time':..,
+            'call_time':..}. snapshots without rate-limit data (reset_time -1)
+            are not kept. with auto_close, the connection is closed again so
+            the next call may come from another thread
+        '''
+        if not kind in self.KINDS:
+            raise ValueError('expecting kind to be one of: %s' % ', '.join(self.KINDS))
+        if limit_info['reset_time'] < 0:
+            return 0
+        res = self.q('''
+            INSERT OR REPLACE INTO rate_limits(profile_str, kind, endpoint,
+                remaining, call_limit, reset_time, call_time)
+            VALUES(:profile_str, :kind, :endpoint, :remaining, :call_limit,
+                :reset_time, :call_time)
+            ''', {
+                'profile_str': profile_str,
+                'kind': kind,
+                'endpoint': endpoint,
+                'remaining': limit_info['remaining'],
+                'call_limit': limit_info['limit'],
+                'reset_time': limit_info['reset_time'],
+                'call_time': limit_info['call_time'],
+                }, 'NUMBER_OF_ROWS_AFFECTED', auto_commit=True)
+        if auto_close:
+            self.close()
+        return res
+
+    def expire(self, now=None, auto_close=True):
+        '''deletes snapshots whose window has reset; returns how many'''
+        res = self.q('''
+            DELETE FROM rate_limits WHERE reset_time <= :now
+            ''', {'now': int(time.time() if now is None else now)},
+            'NUMBER_OF_ROWS_AFFECTED', auto_commit=True)
+        if auto_close:
+            self.close()
+        return res
+
+    def get_limits(self, profile_str=None, kind='tweepy', endpoint=None,
+            now=None, auto_close=True):
+        '''snapshots still in their window, as {profile_str: {endpoint:
+            limit_info}}; limit_info is shaped like TpManager's
+        '''
+        (where_str, where_dict) = self._make_where_clause({
+            'profile_str': profile_str,
+            'kind': kind,
+            'endpoint': endpoint,
+            }, omit_if_null=True)
+        rows = self.q('''
+            SELECT * FROM rate_limits WHERE %sreset_time > :now
+            ''' % (where_str + ' AND ' if where_str else ''), [where_dict,
+                {'now': int(time.time() if now is None else now)}], 'ALL_ROWS')
+        if auto_close:
+            self.close()
+        result = {}
+        for row in rows or []:
+            result.setdefault(row['profile_str'], {})[row['endpoint']] = {
+                    'remaining': row['remaining'],
+                    'limit': row['call_limit'],
+                    'reset_time': row['reset_time'],
+                    'call_time': row['call_time'],
+                    }
+        return result
+
+
 class DPeople(DObject):
     DB_FILENAME= 'tt_main.db'
     INIT_QUERIES= ['''
@@ -567,10 +909,11 @@ class DPeople(DObject):
         ''']
     FLAG_MYSELF=1
 
-    def __init__(self, directory='../var', filename=None):
+    def __init__(self, directory='../var', filename=None, profile=None):
         if filename is None:
             filename = self.DB_FILENAME
-        super(DPeople,self).__init__(directory+'/' + filename, self.INIT_QUERIES)
+        super(DPeople,self).__init__(directory+'/' + filename, self.INIT_QUERIES,
+                profile=profile)
 
     def insert(self, person_info):
         '''inserts a new person; returns person_id'''
@@ -667,16 +1010,79 @@ class DPeople(DObject):
 class DTweets(object):
     # 0=no partitioning, 1=16 parts, 2=256 parts, n=2^(4n) parts
     DEFAULT_PARTITION_SCALE = 1
+    # how tweet IDs map to partitions; see partition_function()
+    PARTITION_SCHEMES = ['md5', 'snowflake', 'monthly']
+    # schemes whose partition names sort in time order ('YYYYMM')
+    TIME_PARTITION_SCHEMES = ['monthly']
+    DEFAULT_PARTITION_SCHEME = 'md5'
+    # (partition_scale, partition_scheme) -> routing function
+    _partition_functions = {}
+    # name -> factory(partition_scale) returning a routing function; see
+    # register_partition_scheme()
+    _custom_partition_schemes = {}
+    # snowflake IDs carry milliseconds since this epoch in bits 22 and up
+    TWITTER_EPOCH_MS = 1288834974657
+    # partition connections are pooled; least recently used ones are closed
+    # beyond this count, and any left unused for IDLE_TIMEOUT seconds
+    DEFAULT_MAX_OPEN_PARTS = 16
+    DEFAULT_IDLE_TIMEOUT = 300
+    # rows fetched per round trip when streaming a partition
+    DEFAULT_BATCH_SIZE = 1000
+    # number of partitions read concurrently by q() and scatter(); 1 = serial
+    DEFAULT_PARALLELISM = 1
+    # write-behind buffer (see start_write_behind()): flush once this many
+    # tweets are buffered or the oldest one has waited FLUSH_INTERVAL
+    # seconds; insert() blocks while MAX_PENDING tweets are waiting
+    DEFAULT_FLUSH_ROWS = 1000
+    DEFAULT_FLUSH_INTERVAL = 2.0
+    DEFAULT_MAX_PENDING = 10000
+    # at most this many ids are remembered as stored; see known_ids()
+    DEFAULT_MAX_KNOWN_IDS = 1000000
     
     def __init__(self,
             isolation_mode='DEFERRED', directory='../var/tweets',
-            partition_scale=DEFAULT_PARTITION_SCALE, verbose=False):
-        '''initializes a partitioned DTweets instance'''
+            partition_scale=DEFAULT_PARTITION_SCALE, verbose=False,
+            max_open_parts=DEFAULT_MAX_OPEN_PARTS,
+            idle_timeout=DEFAULT_IDLE_TIMEOUT,
+            parallelism=DEFAULT_PARALLELISM, use_index=True,
+            partition_scheme=None, profile=None):
+        '''initializes a partitioned DTweets instance. partition_scheme is
+            one of PARTITION_SCHEMES; None means whatever the directory was
+            created with ('md5' for new and older archives). profile is a
+            DObject.CONNECTION_PROFILES key used for every partition
+        '''
         self.__directory = directory
-        self.__parts = {}
+        # LRU pool of open partitions: part_name -> DTweets_part (oldest first)
+        self.__parts = collections.OrderedDict()
+        self.__last_used = {}
         self.__verbose = verbose
         self.__isolation_mode = isolation_mode
         self.__partition_scale = partition_scale
+        self.__profile = profile
+        self.__max_open_parts = max_open_parts
+        self.__idle_timeout = idle_timeout
+        self.__parallelism = parallelism
+        # worker threads for parallel reads; each keeps its own connections
+        self.__thread_pool = None
+        self.__worker_local = threading.local()
+        # pool thread -> {part_name: last used}, and part_name -> generation
+        # (bumped to make workers reopen a partition); see __worker_parts()
+        self.__worker_lock = threading.Lock()
+        self.__worker_used = {}
+        self.__part_generation = {}
+        # user/reply -> partitions index; see DTweets_index
+        self.__use_index = use_index
+        self.__index = None
+        self.__index_checked = False
+        self.__partition_scheme = self.__check_layout(partition_scheme)
+        # tweet_id -> partition name
+        self.__route = self.partition_function(
+                self.__partition_scale, self.__partition_scheme)
+        # write-behind state; see start_write_behind()
+        self.__writer = None
+        # ids known to be stored, and lookup counters; see known_ids()
+        self.__known_ids = set()
+        self.__known_stats = {'checked': 0, 'known': 0, 'cached': 0}
 
     def __assert_dtweet_friendly(self, tweet):
         if isinstance(tweet, dict):
@@ -693,91 +1099,282 @@ class DTweets(object):
             raise TypeError('expecting tweet to be either a dict or sqlite3.Row')
 
     @classmethod
-    def compute_hash(cls, tweet, binary_out=False):
-        '''computes the MD5 hash for tweet
-            tweet may be a dict, sqlite3.Row, textual/numerical tweet ID.
-            Tweepy-returned tweet objects be processed with utils.prepare_DTweet_item() first
-        '''
-        tweet_id = None
-        if isinstance(tweet, sqlite3.Row) and 'tweet_id' in tweet:
-            tweet_id = tweet['tweet_id']
+    def extract_tweet_id(cls, tweet):
+        '''returns the tweet ID of a dict, sqlite3.Row, textual/numerical ID'''
+        if isinstance(tweet, sqlite3.Row) and 'tweet_id' in tweet.keys():
+            return tweet['tweet_id']
         elif isinstance(tweet, dict) and 'tweet_id' in tweet:
-            tweet_id = tweet['tweet_id']
+            return tweet['tweet_id']
         elif isinstance(tweet, basestring):
-            tweet_id = tweet
-        elif isinstance(tweet, int):
-            tweet_id = int(tweet)
+            return tweet
+        elif isinstance(tweet, (int, long)):
+            return tweet
         else:
             raise TypeError('expecting tweet to be an instance of sqlite3.Row, dict, basestring or int')
 
+    @classmethod
+    def compute_hash(cls, tweet, binary_out=False):
+        '''computes the MD5 hash for tweet
+            tweet may be a dict, sqlite3.Row, textual/numerical tweet ID.
+            Tweepy-returned tweet objects be processed with utils.prepare_DTweet_item() first
+        '''
         m = hashlib.md5()
-        m.update(str(tweet_id))
+        m.update(str(cls.extract_tweet_id(tweet)))
         return m.digest() if binary_out else m.hexdigest()
 
     @classmethod
-    def compute_partition_name(cls, tweet, partition_scale=DEFAULT_PARTITION_SCALE):
-        '''for a tweet, returns the N-character long partition name'''
-        if not partition_scale:
+    def partition_function(cls, partition_scale=DEFAULT_PARTITION_SCALE,
+            partition_scheme=DEFAULT_PARTITION_SCHEME):
+        '''returns a (cached) function mapping a tweet ID to its partition
+            name. schemes:
+                md5 -- first N hex digits of md5(str(tweet_id)) (the original)
+                snowflake -- low 4N bits of tweet_id XOR (tweet_id >> 22);
+                    folds the snowflake timestamp into the sequence bits so
+                    both snowflake and older sequential IDs spread evenly.
+                    integer arithmetic only
+                monthly -- 'YYYYMM' (UTC) from the snowflake timestamp; the
+                    partition scale is ignored. pre-snowflake IDs (before
+                    Nov 2010) all land in '201011'
+            plus anything added with register_partition_scheme()
+        '''
+        key = (partition_scale, partition_scheme)
+        if key in cls._partition_functions:
+            return cls._partition_functions[key]
+
+        if partition_scheme == 'monthly':
+            epoch_ms = cls.TWITTER_EPOCH_MS
+            def route(tweet_id):
+                ms = (int(tweet_id) >> 22) + epoch_ms
+                return datetime.utcfromtimestamp(ms // 1000).strftime('%Y%m')
+        elif not partition_scale:
             # 0 or None = no partition
-            return 'data'
-        hash_str = cls.compute_hash(tweet)
-        return hash_str[0:partition_scale]
+            route = lambda tweet_id: 'data'
+        elif partition_scheme == 'md5':
+            md5 = hashlib.md5
+            route = lambda tweet_id: md5(str(tweet_id)).hexdigest()[0:partition_scale]
+        elif partition_scheme == 'snowflake':
+            mask = 16 ** partition_scale - 1
+            name_format = '%%0%dx' % partition_scale
+            names = ([name_format % i for i in xrange(mask + 1)]
+                    if partition_scale <= 4 else None)
+            def route(tweet_id):
+                try:
+                    bucket = (tweet_id ^ (tweet_id >> 22)) & mask
+                except TypeError:
+                    # textual ID
+                    tweet_id = int(tweet_id)
+                    bucket = (tweet_id ^ (tweet_id >> 22)) & mask
+                return names[bucket] if names else name_format % bucket
+        elif partition_scheme in cls._custom_partition_schemes:
+            route = cls._custom_partition_schemes[partition_scheme](partition_scale)
+        else:
+            raise ValueError('unknown partition scheme: %s' % partition_scheme)
+        cls._partition_functions[key] = route
+        return route
+
+    @classmethod
+    def register_partition_scheme(cls, name, factory, time_ordered=False):
+        '''adds a partition scheme usable as DTweets(partition_scheme=name).
+            factory(partition_scale) must return a tweet_id -> name function;
+            if time_ordered, names must sort in time order (see
+            partitions_between())
+        '''
+        cls._custom_partition_schemes[name] = factory
+        if not name in cls.PARTITION_SCHEMES:
+            cls.PARTITION_SCHEMES.append(name)
+        if time_ordered and not name in cls.TIME_PARTITION_SCHEMES:
+            cls.TIME_PARTITION_SCHEMES.append(name)
+
+    @classmethod
+    def snowflake_id_at(cls, when):
+        '''smallest snowflake tweet ID created at or after datetime when (UTC)'''
+        ms = int((when - datetime(1970, 1, 1)).total_seconds() * 1000)
+        return max(ms - cls.TWITTER_EPOCH_MS, 0) << 22
+
+    @classmethod
+    def compute_partition_name(cls, tweet, partition_scale=DEFAULT_PARTITION_SCALE,
+            partition_scheme=DEFAULT_PARTITION_SCHEME):
+        '''for a tweet, returns the N-character long partition name'''
+        return cls.partition_function(partition_scale, partition_scheme)(
+                cls.extract_tweet_id(tweet))
 
     def __make_db_fullpath(self, tweet=None, partition_name=None): 
         '''generates filename for database, given tweet obj (dtweet-friendly dict)'''
         if not partition_name:
-            partition_name = self.__class__.compute_partition_name(
-                tweet, self.__partition_scale) 
+            partition_name = self.__route(self.extract_tweet_id(tweet))
         return os.path.join(self.__directory, '%s.db' % partition_name) 
 
     def __get_file_list(self):
         '''get a list of ('FFFF', 'spam/tweets/FFFF.db files') tuples'''
         file_list = []
-        for f in os.listdir(self.__directory):
-            if os.path.isfile(f):
-                f_full = os.path.abspath(f)
-                db_filename_wo_ext = os.path.splitext(os.path.basename(f_full))[0]
+        if not os.path.isdir(self.__directory):
+            return file_list
+        for f in sorted(os.listdir(self.__directory)):
+            f_full = os.path.abspath(os.path.join(self.__directory, f))
+            (db_filename_wo_ext, ext) = os.path.splitext(f)
+            # names starting with '_' are internal files (e.g. the index)
+            if os.path.isfile(f_full) and ext == '.db' and f[0] != '_':
                 file_list.append((db_filename_wo_ext, f_full))
         return file_list
 
     def __get_part_instance(self, tweet=None, part_name=None):
-        '''instantiates a DTweets_part using a tweet or a partition name; then
-            add it to the partition-instance list
+        '''returns a pooled DTweets_part for a tweet or a partition name,
+            opening it (and closing the least recently used one) if needed
         '''
-        if part_name:
-            if part_name in self.__parts:
-                return self.__parts[part_name]
-        else:
-            part_name = self.__class__.compute_partition_name(tweet)
-            if part_name in self.__parts:
-                return self.__parts[part_name]
-            
-        inst = DTweets_part(
-                filename=self.__make_db_fullpath(tweet, part_name),
-                isolation_mode=self.__isolation_mode,
-                verbose=self.__verbose)
+        if not part_name:
+            part_name = self.__route(self.extract_tweet_id(tweet))
+        self.__close_idle_parts()
+
+        inst = self.__parts.pop(part_name, None)
+        if inst is None:
+            while (self.__max_open_parts
+                    and len(self.__parts) >= self.__max_open_parts):
+                self.__close_part_instance(next(iter(self.__parts)))
+            inst = DTweets_part(
+                    filename=self.__make_db_fullpath(tweet, part_name),
+                    isolation_mode=self.__isolation_mode,
+                    verbose=self.__verbose, profile=self.__profile)
+        # (re)insert as most recently used
         self.__parts[part_name] = inst
-        return self.__parts[part_name]
+        self.__last_used[part_name] = time.time()
+        return inst
 
     def __close_part_instance(self, part_name=None):
-        '''closes currently-opened connections'''
-        if part_name:
-            self.__parts[part_name].close()
-        else:
-            for inst in self.__parts:
-                self.__parts[inst].close()
+        '''commits and closes pooled connections (all if part_name is None)'''
+        names = [part_name] if part_name else list(self.__parts)
+        for name in names:
+            inst = self.__parts.pop(name, None)
+            self.__last_used.pop(name, None)
+            if inst is not None:
+                inst.commit()
+                inst.close()
+
+    def __close_idle_parts(self):
+        '''closes connections unused for longer than idle_timeout'''
+        if not self.__idle_timeout:
+            return
+        deadline = time.time() - self.__idle_timeout
+        for name in [n for n in self.__parts if self.__last_used[n] < deadline]:
+            self.__close_part_instance(name)
+        with self.__worker_lock:
+            idle = any(t < deadline for used in self.__worker_used.values()
+                    for t in used.values())
+        if idle:
+            self.__sweep_workers()
+
+    def flush(self):
+        '''writes out the write-behind buffer (if any), then commits pending
+            transactions on every open partition
+        '''
+        if self.__writer is not None:
+            self.__flush_write_behind()
+        for inst in self.__parts.values():
+            inst.commit()
+
+    def close(self):
+        '''commits and closes every pooled partition; call on shutdown'''
+        self.stop_write_behind()
+        self.__close_part_instance()
+        if self.__index is not None:
+            self.__index.close()
+        if self.__thread_pool is not None:
+            self.__sweep_workers(close_all=True)
+            self.__thread_pool.close()
+            self.__thread_pool.join()
+            self.__thread_pool = None
+            with self.__worker_lock:
+                self.__worker_used.clear()
+
+    @property
+    def open_parts(self):
+        '''names of currently open partitions, least recently used first'''
+        return list(self.__parts)
+
+    def partitions_between(self, since=None, until=None):
+        '''existing partition names that can hold tweets created in
+            [since, until) (datetimes, UTC), oldest first. only time-ordered
+            schemes can prune; other schemes return every partition
+        '''
+        names = [tup[0] for tup in self.__get_file_list()]
+        if not self.__partition_scheme in self.TIME_PARTITION_SCHEMES:
+            return names
+        if since is not None:
+            first = self.__route(self.snowflake_id_at(since))
+            names = [n for n in names if n >= first]
+        if until is not None:
+            last = self.__route(self.snowflake_id_at(until) - 1)
+            names = [n for n in names if n <= last]
+        return names
+
+    def get_latest(self, limit=200, since=None, until=None):
+        '''latest tweets (newest first) created in [since, until). with a
+            time-ordered scheme partitions are read newest first and reading
+            stops as soon as limit tweets are found
+        '''
+        where_list = []
+        params = {}
+        if since is not None:
+            where_list.append('tweet_id >= :since_id')
+            params['since_id'] = self.snowflake_id_at(since)
+        if until is not None:
+            where_list.append('tweet_id < :until_id')
+            params['until_id'] = self.snowflake_id_at(until)
+        query = 'SELECT * FROM tweets WHERE %s' % (
+                ' AND '.join(where_list) if where_list else '1')
+        part_names = self.partitions_between(since, until)
+
+        if not self.__partition_scheme in self.TIME_PARTITION_SCHEMES:
+            return self.scatter(query, params, ('tweet_id', 'DESC'), limit,
+                    part_names)
+        rows = []
+        for part_name in reversed(part_names):
+            inst = self.__get_part_instance(part_name=part_name)
+            rows.extend(inst.q('%s ORDER BY tweet_id DESC LIMIT %d' % (
+                query, limit - len(rows)), params, 'ALL_ROWS'))
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def close_partition(self, part_name):
+        '''commits and closes one pooled partition (e.g. a cold month)'''
+        self.__close_part_instance(part_name)
+
+    def compact_partition(self, part_name):
+        '''closes a partition and rewrites its file (VACUUM)'''
+        self.__close_part_instance(part_name)
+        self.__invalidate_worker_parts(part_name)
+        inst = DTweets_part(filename=self.__make_db_fullpath(partition_name=part_name),
+                isolation_mode=None, verbose=self.__verbose)
+        inst.q('VACUUM', None, 'NUMBER_OF_ROWS_AFFECTED')
+        inst.close()
+        return True
+
+    def archive_partition(self, part_name, archive_directory):
+        '''closes a partition and moves its file to archive_directory; its
+            tweets are no longer visible through this DTweets
+        '''
+        self.__close_part_instance(part_name)
+        self.__invalidate_worker_parts(part_name)
+        if not os.path.isdir(archive_directory):
+            os.makedirs(archive_directory)
+        shutil.move(self.__make_db_fullpath(partition_name=part_name),
+                os.path.join(archive_directory, '%s.db' % part_name))
+        index = self.__get_index()
+        if index is not None:
+            index.remove_partition(part_name)
+        return True
 
     @classmethod
-    def __tidy_todo_list(cls, in_list):
-        '''groups a bunch of tweet objects/IDs by partition.
-            returns dict {'partname1':[tweet1, tweet2,...], ...}
+    def __tidy_todo_list(cls, in_list, route):
+        '''groups a bunch of tweet objects/IDs by partition, using route
+            (see partition_function()). returns dict {'partname1':[tweet1, tweet2,...], ...}
         '''
         out_dict = {}
         for in_item in in_list:
-            key = DTweets.compute_partition_name(in_item)
+            key = route(cls.extract_tweet_id(in_item))
             if not key in out_dict:
                 out_dict[key] = []
-            out_dict[key] = in_item
+            out_dict[key].append(in_item)
         return out_dict
 
     def q(self, query, params=None, result_type='ALL_ROWS', auto_commit=False,
@@ -791,94 +1388,766 @@ class DTweets(object):
             file_list = self.__get_file_list()
             for tup in file_list:
                 # example: tup = ('FFFF', 'spam/tweets/FFFF.db')
-                todo_ist.append(self.__get_part_instance(part_name=tup[0]))
+                todo_list.append(tup[0])
         elif isinstance(partition_name, list):
-            for partition_name_ in partition_name:
-                todo_list.append(
-                        self.__get_part_instance(part_name=partition_name_str))
+            todo_list = partition_name
         else:
-            todo_list = [self.__get_part_instance(part_name=partition_name)]
-        # call q() on each partition 
-        result_list = []
-        for part_inst in todo_list:
-            result_list.append(
-                    part_inst.q(query, params, result_type, auto_commit))
+            todo_list = [partition_name]
+        if auto_commit or self.__parallelism <= 1 or len(todo_list) <= 1:
+            # call q() on each partition 
+            result_list = []
+            for part_name in todo_list:
+                part_inst = self.__get_part_instance(part_name=part_name)
+                result_list.append(
+                        part_inst.q(query, params, result_type, auto_commit))
+        else:
+            result_list = self.__parallel_q(todo_list, query, params, result_type)
         # result_list = [rowset1, rowset2, 1, ...]
-        self.__close_part_instance()
         return result_list    
 
-    def insert(self, tweet_obj):
+    def __get_index_db(self):
+        '''returns the DTweets_index (which also keeps the archive layout)'''
+        if self.__index is None:
+            self.__index = DTweets_index(self.__directory, self.__verbose,
+                    self.__profile)
+        return self.__index
+
+    def __get_index(self):
+        '''returns the DTweets_index, or None if not in use'''
+        if not self.__use_index:
+            return None
+        index = self.__get_index_db()
+        if not self.__index_checked:
+            if not index.is_built() and not self.__get_file_list():
+                # a new archive: the index is complete from the first insert
+                index.set_built(True)
+            self.__index_checked = True
+        return index
+
+    def __check_layout(self, partition_scheme):
+        '''returns the partition scheme to use. the scheme and scale are
+            recorded when an archive is first opened (the scale of older
+            archives is read from their file names); opening it later with
+            different ones raises ValueError (see migrate_partitions()).
+            'monthly' ignores the scale. the layout lives in the index file,
+            so without an index (use_index False and no _index.db yet) only
+            the scale is checked, against the file names
+        '''
+        if not self.__use_index and not os.path.isfile(os.path.join(
+                self.__directory, DTweets_index.DB_FILENAME)):
+            scheme = partition_scheme or self.DEFAULT_PARTITION_SCHEME
+            if scheme != 'monthly':
+                self.__check_scale(self.__detect_scale())
+            return scheme
+        index_db = self.__get_index_db()
+        layout = index_db.get_meta('layout')
+        if layout is None:
+            # archives created before layouts were recorded are md5-based
+            scheme = partition_scheme or self.DEFAULT_PARTITION_SCHEME
+            if self.__get_file_list() and scheme != 'md5':
+                raise ValueError('%s holds an md5-partitioned archive' %
+                        self.__directory)
+            if scheme == 'monthly':
+                index_db.set_meta('layout', scheme)
+            else:
+                self.__check_scale(self.__detect_scale())
+                index_db.set_meta('layout', '%s:%d' % (
+                        scheme, self.__partition_scale or 0))
+            return scheme
+
+        (scheme, sep, scale) = layout.partition(':')
+        if partition_scheme is not None and partition_scheme != scheme:
+            raise ValueError('%s is partitioned with scheme %s, not %s' % (
+                    self.__directory, scheme, partition_scheme))
+        if scheme != 'monthly':
+            self.__check_scale(int(scale))
+        return scheme
+
+    def __detect_scale(self):
+        '''the partition scale of the existing partition files (None if
+            there are none), from the length of their names
+        '''
+        scales = set(0 if name == 'data' else len(name)
+                for (name, filename) in self.__get_file_list())
+        if len(scales) > 1:
+            raise ValueError('%s holds partitions of scales %s' % (
+                    self.__directory, ', '.join(str(n) for n in sorted(scales))))
+        return scales.pop() if scales else None
+
+    def __check_scale(self, scale):
+        '''raises ValueError unless scale (None = unknown) is the one this
+            DTweets was created with
+        '''
+        if scale is not None and scale != (self.__partition_scale or 0):
+            raise ValueError('%s is partitioned with scale %s, not %s' % (
+                    self.__directory, scale, self.__partition_scale))
+
+    def encode_partitions(self, target_directory, compression=None):
+        '''writes a DTweets_compact copy of every partition into
+            target_directory (same file names; keep it apart from live
+            partitions). compression defaults to
+            DTweets_compact.DEFAULT_COMPRESSION. returns the number of
+            tweets converted
+        '''
+        if compression is None:
+            compression = DTweets_compact.DEFAULT_COMPRESSION
+        self.flush()
+        if not os.path.isdir(target_directory):
+            os.makedirs(target_directory)
+        count = 0
+        for (part_name, filename) in self.__get_file_list():
+            count += DTweets_compact.convert(filename,
+                    os.path.join(target_directory, os.path.basename(filename)),
+                    compression)
+        return count
+
+    def migrate_partitions(self, target_directory, partition_scheme=None,
+            partition_scale=None):
+        '''copies every tweet into a new archive at target_directory, laid
+            out with another partition scheme and/or scale. the source is
+            left untouched; swap the directories once this returns.
+            returns the number of tweets copied
+        '''
+        target = DTweets(isolation_mode=self.__isolation_mode,
+                directory=target_directory,
+                partition_scale=(self.__partition_scale
+                    if partition_scale is None else partition_scale),
+                partition_scheme=partition_scheme or self.__partition_scheme,
+                verbose=self.__verbose, profile=self.__profile)
+        count = 0
+        batch = []
+        for row in self.iter_all_tweets():
+            # last_update is not carried over; it is set again on insert
+            batch.append(dict(zip(row.keys(), row)))
+            if len(batch) >= self.DEFAULT_BATCH_SIZE:
+                target.insert(batch, on_conflict='replace')
+                count += len(batch)
+                batch = []
+        if batch:
+            target.insert(batch, on_conflict='replace')
+            count += len(batch)
+        target.close()
+        return count
+
+    def __find_partitions(self, kind, ref_ids):
+        '''partitions that may hold rows for ref_ids (a value or a list);
+            None if unknown (no usable index), meaning "all partitions"
+        '''
+        index = self.__get_index()
+        if index is None or not index.is_built():
+            return None
+        return index.get_partitions(kind,
+                ref_ids if isinstance(ref_ids, list) else [ref_ids])
+
+    def rebuild_index(self):
+        '''(re)builds the user/reply index from every partition; run this
+            once on archives created before the index existed
+        '''
+        index = DTweets_index(self.__directory, self.__verbose, self.__profile)
+        index.set_built(False)
+        index.clear()
+        for tup in self.__get_file_list():
+            inst = self.__get_part_instance(part_name=tup[0])
+            batch = []
+            for row in inst.iter_all(DTweets_index.INDEXED_COLUMNS):
+                batch.append(row)
+                if len(batch) >= self.DEFAULT_BATCH_SIZE:
+                    index.add(tup[0], batch)
+                    batch = []
+            index.add(tup[0], batch)
+        index.set_built(True)
+        index.close()
+        if self.__index is not None:
+            self.__index.close()
+            self.__index = None
+        return True
+
+    def __worker_parts(self):
+        '''returns the calling thread's (parts, generations, last_used);
+            pool threads register last_used so idle sweeps can find them
+        '''
+        local = self.__worker_local
+        if getattr(local, 'parts', None) is None:
+            local.parts = collections.OrderedDict()
+            local.generations = {}
+            local.last_used = {}
+            if threading.current_thread() is not self.__writer:
+                with self.__worker_lock:
+                    self.__worker_used[threading.current_thread().ident] = \
+                            local.last_used
+        return (local.parts, local.generations, local.last_used)
+
+    def __close_worker_parts(self, close_all=False):
+        '''closes the calling thread's connections that are idle or were
+            invalidated (all of them if close_all)
+        '''
+        (parts, generations, last_used) = self.__worker_parts()
+        deadline = (time.time() - self.__idle_timeout
+                if self.__idle_timeout else None)
+        with self.__worker_lock:
+            names = [n for n in parts if close_all
+                    or generations[n] != self.__part_generation.get(n, 0)
+                    or (deadline is not None and last_used[n] < deadline)]
+            for name in names:
+                del last_used[name]
+        for name in names:
+            del generations[name]
+            parts.pop(name).close()
+
+    def __get_worker_part_instance(self, part_name):
+        '''like __get_part_instance(), but for the calling worker thread'''
+        self.__close_worker_parts()
+        (parts, generations, last_used) = self.__worker_parts()
+        inst = parts.pop(part_name, None)
+        if inst is None:
+            while self.__max_open_parts and len(parts) >= self.__max_open_parts:
+                (name, oldest) = parts.popitem(last=False)
+                del generations[name]
+                with self.__worker_lock:
+                    del last_used[name]
+                oldest.close()
+            with self.__worker_lock:
+                generations[part_name] = self.__part_generation.get(part_name, 0)
+            inst = DTweets_part(
+                    filename=self.__make_db_fullpath(partition_name=part_name),
+                    isolation_mode=self.__isolation_mode,
+                    verbose=self.__verbose, profile=self.__profile)
+        parts[part_name] = inst
+        with self.__worker_lock:
+            last_used[part_name] = time.time()
+        return inst
+
+    def __sweep_workers(self, close_all=False):
+        '''makes every pool thread close its idle and invalidated
+            connections (all of them if close_all); sqlite connections can
+            only be closed by the thread that opened them
+        '''
+        if self.__thread_pool is None:
+            return
+        cond = threading.Condition()
+        started = [0]
+        def run(_):
+            self.__close_worker_parts(close_all)
+            # hold this thread until each pool thread got a task of its own
+            with cond:
+                started[0] += 1
+                cond.notify_all()
+                while started[0] < self.__parallelism:
+                    cond.wait()
+        self.__thread_pool.map(run, range(self.__parallelism), chunksize=1)
+
+    def __invalidate_worker_parts(self, part_name):
+        '''makes worker threads drop their connections to part_name (e.g.
+            after the file was moved or rewritten)
+        '''
+        with self.__worker_lock:
+            self.__part_generation[part_name] = \
+                    self.__part_generation.get(part_name, 0) + 1
+        self.__sweep_workers()
+
+    def __parallel_q(self, part_names, query, params, result_type):
+        '''runs a read-only query on part_names using the thread pool;
+            returns results in the order of part_names
+        '''
+        if self.__thread_pool is None:
+            self.__thread_pool = ThreadPool(self.__parallelism)
+        def run(part_name):
+            inst = self.__get_worker_part_instance(part_name)
+            return inst.q(query, params, result_type)
+        return self.__thread_pool.map(run, part_names)
+
+    def map_partitions(self, callback, partition_name=None):
+        '''calls callback(part_name, part_inst) for every partition (or the
+            partition names given), on the thread pool if parallelism > 1,
+            and returns the results in partition order. callback must only
+            read; parallel workers get connections of their own
+        '''
+        if partition_name is None:
+            part_names = [tup[0] for tup in self.__get_file_list()]
+        elif isinstance(partition_name, list):
+            part_names = partition_name
+        else:
+            part_names = [partition_name]
+        if self.__parallelism > 1 and len(part_names) > 1:
+            if self.__thread_pool is None:
+                self.__thread_pool = ThreadPool(self.__parallelism)
+            def run(part_name):
+                return callback(part_name,
+                        self.__get_worker_part_instance(part_name))
+            return self.__thread_pool.map(run, part_names)
+        return [callback(part_name, self.__get_part_instance(part_name=part_name))
+                for part_name in part_names]
+
+    def scatter(self, query, params=None, order_by=None, limit=None,
+            partition_name=None):
+        '''runs a SELECT on partitions (in parallel if enabled) and merges the
+            rows into one list. order_by='col' or ('col', 'DESC'); limit=N.
+            ORDER BY / LIMIT are pushed down to each partition (the query is
+            wrapped, so it may have its own), then applied to the merged rows
+            so a top-N reads at most N rows per partition
+        '''
+        if order_by is not None or limit is not None:
+            query = 'SELECT * FROM (%s)' % query
+        if order_by is not None:
+            (order_col, direction) = (order_by if isinstance(order_by, tuple)
+                    else (order_by, 'ASC'))
+            direction = direction.upper()
+            if not direction in ('ASC', 'DESC'):
+                raise ValueError('expecting order direction to be ASC or DESC')
+            query = '%s ORDER BY `%s` %s' % (query, order_col, direction)
+        if limit is not None:
+            query = '%s LIMIT %d' % (query, int(limit))
+        if partition_name == []:
+            # nothing to read (e.g. every partition was pruned)
+            return []
+
+        rows = []
+        for part_rows in self.q(query, params, 'ALL_ROWS',
+                partition_name=partition_name):
+            rows.extend(part_rows)
+
+        if order_by is None:
+            return rows if limit is None else rows[0:limit]
+        key = lambda row: row[order_col]
+        if limit is None:
+            return sorted(rows, key=key, reverse=(direction == 'DESC'))
+        elif direction == 'DESC':
+            return heapq.nlargest(limit, rows, key=key)
+        else:
+            return heapq.nsmallest(limit, rows, key=key)
+
+    def get_by_user(self, user_id, order_by=('tweet_id', 'DESC'), limit=None):
+        '''get tweets of one user or more users (give a list in user_id)
+            from all partitions; returns list of sqlite3.Row instance
+        '''
+        part_names = self.__find_partitions(DTweets_index.REF_USER, user_id)
+        if part_names == []:
+            return []
+        if isinstance(user_id, list):
+            (sql, par) = DTweets_part._make_in_clause('user', user_id)
+        else:
+            (sql, par) = ('user=:user_id', {'user_id': user_id})
+        return self.scatter('SELECT * FROM tweets WHERE %s' % sql, par,
+                order_by, limit, part_names)
+
+    def get_replies_of(self, tweet_id=None, user_id=None,
+            order_by=('tweet_id', 'DESC'), limit=None):
+        '''get reply-tweets given one tweet_id or one user_id from all
+            partitions; returns list of sqlite3.Row instance
+        '''
+        if tweet_id is not None: 
+            (col_name, valu) = ('in_reply_to_tweet', tweet_id)
+            kind = DTweets_index.REF_REPLY_TO_TWEET
+        elif user_id is not None:
+            (col_name, valu) = ('in_reply_to_user', user_id)
+            kind = DTweets_index.REF_REPLY_TO_USER
+        else:
+            raise ValueError('expecting tweet_id or user_id to be non-None')
+        part_names = self.__find_partitions(kind, valu)
+        if part_names == []:
+            return []
+        return self.scatter('SELECT * FROM tweets WHERE %s=:valu' % col_name,
+                {'valu': valu}, order_by, limit, part_names)
+
+    def insert(self, tweet_obj, on_conflict='refresh'):
         '''inserts one or more tweets into the partitoned database.
-            returns 1 or list of 1 on success
+            returns 1 (0 on failure) per tweet: one value, or a list in the
+            order of tweet_obj. tweets already stored only get their counters
+            refreshed unless on_conflict='replace' (see
+            DTweets_part.insert()). with write-behind on, the tweets are only
+            buffered and always refreshed (see start_write_behind());
+            on_conflict='replace' raises ValueError then
         '''
+        if on_conflict not in ('replace', 'refresh'):
+            raise ValueError('expecting on_conflict to be "replace" or "refresh"')
         todo_list = []
         if isinstance(tweet_obj, list):
             todo_list = tweet_obj
         else:
            todo_list = [tweet_obj]
+        if self.__writer is not None:
+            if on_conflict == 'replace':
+                raise ValueError('write-behind only refreshes known tweets; '
+                        'stop_write_behind() before inserting with replace')
+            self.__buffer_tweets(todo_list)
+            self.__remember_ids(self.extract_tweet_id(t) for t in todo_list)
+            return [1] * len(todo_list) if isinstance(tweet_obj, list) else 1
         # group tweets by partitions 
-        todo_dict = self.__class__.__tidy_todo_list(todo_list)
+        todo_dict = self.__class__.__tidy_todo_list(
+                todo_list, self.__route)
         # execute each query
-        result_list = [] 
+        index = self.__get_index()
+        part_results = {}
         for partition_name, tweet_list in todo_dict.iteritems():
+            if index is not None:
+                # index first: a stale entry only costs an extra partition
+                # read, a missing one would hide tweets
+                index.add(partition_name, tweet_list)
             part = self.__get_part_instance(part_name=partition_name)
-            res = part.insert(tweet_list)
-            # important! close the connection or you will get random OperationalError
-            result_list.append(res)
-        
-        self.__close_part_instance()
-        return result_list if isinstance(tweet_obj, list) else result_list[0]   
+            res = part.insert(tweet_list, on_conflict=on_conflict)
+            if res:
+                self.__remember_ids(
+                        self.extract_tweet_id(t) for t in tweet_list)
+            part_results[partition_name] = 1 if res else 0
+
+        result_list = [part_results[self.__route(self.extract_tweet_id(t))]
+                for t in todo_list]
+        return result_list if isinstance(tweet_obj, list) else result_list[0]
+
+    def __remember_ids(self, tweet_ids):
+        '''adds to the known-id set; it is emptied when it grows too big'''
+        if len(self.__known_ids) >= self.DEFAULT_MAX_KNOWN_IDS:
+            self.__known_ids.clear()
+        self.__known_ids.update(int(i) for i in tweet_ids)
+
+    def known_ids(self, tweet_ids):
+        '''returns the set of tweet_ids (as ints) already stored, or queued
+            by write-behind. ids are looked up in memory first, then with one
+            IN (..) query per partition; see known_id_stats for the hit ratio
+        '''
+        ids = [int(i) for i in tweet_ids]
+        known = set(i for i in ids if i in self.__known_ids)
+        cached = len(known)
+        if self.__writer is not None:
+            with self.__wb_cond:
+                known.update(i for i in ids
+                        if i in self.__wb_pending or i in self.__wb_inflight)
+        rest = [i for i in ids if not i in known]
+        todo_dict = self.__class__.__tidy_todo_list(rest, self.__route)
+        existing = set(tup[0] for tup in self.__get_file_list())
+        for partition_name, id_list in todo_dict.iteritems():
+            if not partition_name in existing:
+                # don't create empty partition files just to look
+                continue
+            part = self.__get_part_instance(part_name=partition_name)
+            for row in part.get_by_ids(id_list, ['tweet_id']):
+                known.add(row['tweet_id'])
+        self.__remember_ids(known)
+        self.__known_stats['checked'] += len(ids)
+        self.__known_stats['known'] += sum(1 for i in ids if i in known)
+        self.__known_stats['cached'] += cached
+        return known
+
+    def seed_known_ids(self, limit=None):
+        '''loads stored tweet_ids into memory so that known_ids() can answer
+            without queries; returns the number of ids loaded
+        '''
+        if limit is None:
+            limit = self.DEFAULT_MAX_KNOWN_IDS
+        count = 0
+        tweets = self.iter_all_tweets(['tweet_id'])
+        for row in tweets:
+            if count >= limit:
+                tweets.close()
+                break
+            self.__known_ids.add(row['tweet_id'])
+            count += 1
+        return count
 
-    def get_by_id(self, tweet_id):
-        '''get tweet details of one or more tweet ids
-            returns sqlite3.Row or list of sqlite3.Row's 
-        ''' 
-        todo_list = tweet_id if isinstance(tweet_obj, list) else [tweet_id]
-        todo_dict = self.__class__.__tidy_todo_list(todo_list)
-        result_list = []
+    @property
+    def known_id_stats(self):
+        '''known_ids() counters: ids checked, ids found to be known, ids
+            answered from memory, and hit_ratio = known / checked
+        '''
+        stats = dict(self.__known_stats)
+        stats['hit_ratio'] = (float(stats['known']) / stats['checked']
+                if stats['checked'] else 0.0)
+        return stats
+
+    def refresh_counters(self, items):
+        '''updates the DTweets_part.PERSPECTIVE_COLUMNS of stored tweets;
+            items is a list of dicts holding tweet_id and all of these
+            columns. only changed rows are written. returns the number of
+            rows updated (queued tweets are updated in memory)
+        '''
+        count = 0
+        if self.__writer is not None:
+            rest = []
+            with self.__wb_cond:
+                for item in items:
+                    tweet_id = int(item['tweet_id'])
+                    # an in-flight copy may land after a direct UPDATE;
+                    # queue an updated copy behind it instead
+                    tweet = self.__wb_pending.get(tweet_id,
+                            self.__wb_inflight.get(tweet_id))
+                    if tweet is None:
+                        rest.append(item)
+                        continue
+                    tweet = dict(tweet)
+                    for col_name in DTweets_part.PERSPECTIVE_COLUMNS:
+                        tweet[col_name] = item[col_name]
+                    self.__wb_pending[tweet_id] = tweet
+                    count += 1
+            items = rest
+        todo_dict = self.__class__.__tidy_todo_list(items, self.__route)
+        for partition_name, item_list in todo_dict.iteritems():
+            part = self.__get_part_instance(part_name=partition_name)
+            try:
+                count += part.refresh_counters(item_list)
+            except sqlite3.Error:
+                part.get_db().rollback()
+                raise
+            part.commit()
+        return count
+
+    def start_write_behind(self, flush_rows=DEFAULT_FLUSH_ROWS,
+            flush_interval=DEFAULT_FLUSH_INTERVAL,
+            max_pending=DEFAULT_MAX_PENDING):
+        '''turns on the write-behind buffer: insert() only queues tweets
+            (a later copy of a tweet_id replaces a queued one) and a
+            background thread writes them out, one transaction per
+            partition, once flush_rows are queued or the oldest has waited
+            flush_interval seconds. insert() blocks while max_pending
+            tweets are queued (back-pressure). get_by_id() sees queued
+            tweets (returned as the dicts given to insert()).
+
+            crash semantics: a tweet is durable once flush() or
+            stop_write_behind() returns. until then it is only in memory
+            and is lost if the process dies. a partition batch is
+            committed as a whole or not at all; the index is written
+            before the partitions, so a crash never hides written tweets.
+            a batch that fails to write is queued again (malformed tweets
+            are dropped) and the error is raised by the next flush() or
+            stop_write_behind()
+        '''
+        if self.__writer is not None:
+            return False
+        # initialize the index from this thread; the writer opens its own
+        self.__get_index()
+        self.__wb_pending = collections.OrderedDict()
+        self.__wb_inflight = {}
+        self.__wb_since = None
+        self.__wb_flush_rows = flush_rows
+        self.__wb_flush_interval = flush_interval
+        self.__wb_max_pending = max_pending
+        self.__wb_flush_requested = False
+        self.__wb_running = True
+        self.__wb_error = None
+        self.__wb_cond = threading.Condition()
+        self.__writer = threading.Thread(target=self.__write_behind_loop,
+                name='DTweets-writer')
+        self.__writer.daemon = True
+        self.__writer.start()
+        return True
 
+    def stop_write_behind(self):
+        '''writes out whatever is buffered and stops the writer thread;
+            insert() writes directly again
+        '''
+        if self.__writer is None:
+            return False
+        with self.__wb_cond:
+            self.__wb_running = False
+            self.__wb_cond.notify_all()
+        self.__writer.join()
+        self.__writer = None
+        if self.__wb_error is not None:
+            (error, self.__wb_error) = (self.__wb_error, None)
+            raise error
+        return True
+
+    @property
+    def pending_count(self):
+        '''number of tweets buffered but not yet committed'''
+        if self.__writer is None:
+            return 0
+        with self.__wb_cond:
+            return len(self.__wb_pending) + len(self.__wb_inflight)
+
+    def __buffer_tweets(self, todo_list):
+        '''queues tweets for the writer thread, blocking while it is behind'''
+        # reject malformed tweets now rather than in the writer thread
+        for tweet in todo_list:
+            self.__assert_dtweet_friendly(tweet)
+            if isinstance(tweet, dict) and not DTweets_part.validate_dict(
+                    tweet, DTweets_part.ROW_REQUIREMENT, on_extra='discard'):
+                raise ValueError('expected keys not found in tweet_dict')
+        with self.__wb_cond:
+            while (len(self.__wb_pending) >= self.__wb_max_pending
+                    and self.__writer.is_alive()):
+                self.__wb_cond.wait(1.0)
+            was_empty = not self.__wb_pending
+            if was_empty:
+                self.__wb_since = time.time()
+            for tweet in todo_list:
+                tweet_id = int(self.extract_tweet_id(tweet))
+                # dedupe: keep the newest copy, in its original slot
+                self.__wb_pending[tweet_id] = tweet
+            if was_empty or len(self.__wb_pending) >= self.__wb_flush_rows:
+                # (re)arms the writer's timer, or makes it flush now
+                self.__wb_cond.notify_all()
+
+    def __flush_write_behind(self):
+        '''blocks until everything buffered so far is committed'''
+        with self.__wb_cond:
+            self.__wb_flush_requested = True
+            self.__wb_cond.notify_all()
+            while ((self.__wb_pending or self.__wb_inflight)
+                    and self.__writer.is_alive() and self.__wb_error is None):
+                self.__wb_cond.wait(1.0)
+            if self.__wb_error is not None:
+                (error, self.__wb_error) = (self.__wb_error, None)
+                raise error
+
+    def __write_behind_loop(self):
+        '''writer thread: takes the whole buffer and writes it out'''
+        index = None
+        if self.__get_index() is not None:
+            # sqlite connections belong to the thread that opened them
+            index = DTweets_index(self.__directory, self.__verbose,
+                    self.__profile)
+        try:
+            while True:
+                with self.__wb_cond:
+                    while (self.__wb_running and not self.__wb_flush_requested
+                            and len(self.__wb_pending) < self.__wb_flush_rows):
+                        if self.__wb_pending:
+                            wait = (self.__wb_since + self.__wb_flush_interval
+                                    - time.time())
+                            if wait <= 0:
+                                break
+                        else:
+                            wait = None
+                        self.__wb_cond.wait(wait)
+                    if not self.__wb_pending:
+                        self.__wb_flush_requested = False
+                        self.__wb_cond.notify_all()
+                        if not self.__wb_running:
+                            break
+                        continue
+                    batch = self.__wb_inflight = self.__wb_pending
+                    self.__wb_pending = collections.OrderedDict()
+                    self.__wb_since = None
+                    # wakes producers blocked on back-pressure
+                    self.__wb_cond.notify_all()
+
+                failed = self.__write_batch(batch, index)
+
+                with self.__wb_cond:
+                    for (tweet_id, tweet) in failed.iteritems():
+                        # newer copies queued meanwhile win
+                        if not tweet_id in self.__wb_pending:
+                            self.__wb_pending[tweet_id] = tweet
+                    if failed and self.__wb_since is None:
+                        self.__wb_since = time.time()
+                    self.__wb_inflight = {}
+                    if failed:
+                        # do not spin on a persistent error; retry later
+                        self.__wb_flush_requested = False
+                        if not self.__wb_running:
+                            break
+                    self.__wb_cond.notify_all()
+        finally:
+            self.__close_worker_parts(close_all=True)
+            if index is not None:
+                index.close()
+            with self.__wb_cond:
+                self.__wb_cond.notify_all()
+
+    def __write_batch(self, batch, index):
+        '''writes {tweet_id: tweet} with one commit per partition (plus one
+            for the index); returns {tweet_id: tweet} of partitions that
+            failed
+        '''
+        todo_dict = self.__class__.__tidy_todo_list(
+                batch.values(), self.__route)
+        failed = {}
+        try:
+            if index is not None:
+                for partition_name, tweet_list in todo_dict.iteritems():
+                    index.add(partition_name, tweet_list, auto_commit=False)
+                index.commit()
+        except sqlite3.Error as e:
+            index.get_db().rollback()
+            self.__wb_error = e
+            return batch
         for partition_name, tweet_list in todo_dict.iteritems():
+            try:
+                part = self.__get_worker_part_instance(partition_name)
+                res = part.insert(tweet_list, on_conflict='refresh')
+            except sqlite3.Error as e:
+                res = e
+            except Exception as e:
+                # malformed tweets would fail forever; drop them
+                sys.stderr.write('write-behind: dropping %d tweets: %s\n'
+                        % (len(tweet_list), str(e)))
+                self.__wb_error = e
+                continue
+            if res is not True:
+                sys.stderr.write('write-behind: unable to write partition %s\n'
+                        % partition_name)
+                self.__wb_error = (res if isinstance(res, Exception) else
+                        IOError('unable to write partition %s' % partition_name))
+                for tweet in tweet_list:
+                    failed[int(self.extract_tweet_id(tweet))] = tweet
+        return failed
+
+    def get_by_id(self, tweet_id):
+        '''get tweet details of one or more tweet ids; ids are grouped by
+            partition and fetched with one IN (..) query per partition.
+            returns sqlite3.Row (or None), or for a list of ids a list of
+            sqlite3.Row in the same order, with None for ids not found
+        ''' 
+        todo_list = tweet_id if isinstance(tweet_id, list) else [tweet_id]
+        found = {}
+        if self.__writer is not None:
+            # buffered tweets are newer than anything on disk
+            with self.__wb_cond:
+                for i in todo_list:
+                    i = int(i)
+                    tweet = self.__wb_pending.get(i, self.__wb_inflight.get(i))
+                    if tweet is not None:
+                        found[i] = tweet
+        todo_dict = self.__class__.__tidy_todo_list(
+                [i for i in todo_list if not int(i) in found], self.__route)
+        for partition_name, id_list in todo_dict.iteritems():
             part = self.__get_part_instance(part_name=partition_name)
-            res = part.insert(tweet_list)
-            result_list.append(res)      
-            
-        self.__close_part_instance()
-        return result_list if isinstance(tweet_obj, list) else result_list[0]   
+            for row in part.get_by_ids(id_list):
+                found[row['tweet_id']] = row
+
+        result_list = [found.get(int(i)) for i in todo_list]
+        return result_list if isinstance(tweet_id, list) else result_list[0]   
+
+    def iter_all_tweets(self, columns=None,
+            batch_size=DEFAULT_BATCH_SIZE):
+        '''yields every tweet (sqlite3.Row) in every partition. rows are read
+            batch_size at a time so memory stays bounded; columns (a list of
+            column names) limits what is read, e.g. ['tweet_id', 'user']
+        '''
+        for tup in self.__get_file_list():
+            # example: tup = ('FFFF', 'spam/tweets/FFFF.db')
+            inst = self.__get_part_instance(part_name=tup[0])
+            for tweet in inst.iter_all(columns, batch_size):
+                yield tweet
 
     def apply_to_all_tweets(self, callback, *args, **kwargs):
         '''callback will be called with params: (tweet_obj, *args, **kwargs).
             return values of callbacks are stored in a list then finally
-            returned. to stop iteration, have callback return False
+            returned. to stop iteration, have callback return False.
+            tweets are streamed; the keyword argument columns limits the
+            columns read (default all) and is not passed to callback
         '''
         if not hasattr(callback, '__call__'):
             raise TypeError('expecting callback to be callable')
 
-        give_up = False
+        columns = kwargs.pop('columns', None)
         result_list = []
-        for tup in self.__get_file_list():
-            # example: tup = ('FFFF', 'spam/tweets/FFFF.db')
-            if give_up:
+        tweets = self.iter_all_tweets(columns)
+        for tweet in tweets:
+            result = callback(tweet, *args, **kwargs)
+            if not result:
+                # stop reading right away (closes the open cursor)
+                tweets.close()
                 break
-            inst = self.__get_part_instance(part_name=tup[0])
-            tweet_list = inst.get_all()
-            inst.close()
-
-            if isinstance(tweet_list, list):
-                for tweet in tweet_list:
-                    result = callback(tweet, *args, **kwargs)
-                    if not result:
-                        give_up = True
-                        break
-                    else:
-                        result_list.append(result)
             else:
-                raise Exception('unable to get a list of tweets')
+                result_list.append(result)
         return result_list        
 
-    def apply_to_all_partitions(self, callback, auto_close=True, *args, **kwargs):
+    def apply_to_all_partitions(self, callback, auto_close=False, *args, **kwargs):
         '''callback will be called with params: (part_name, part_inst, *args, **kwargs).
             return values of callbacks are stored in a list then finally
-            returned. to stop iteration, have callback return False
+            returned. to stop iteration, have callback return False.
+            connections stay pooled unless auto_close is set
         '''
         if not hasattr(callback, '__call__'):
             raise TypeError('expecting callback to be callable')
@@ -888,7 +2157,6 @@ class DTweets(object):
             # example: tup = ('FFFF', 'spam/tweets/FFFF.db')
             inst = self.__get_part_instance(part_name=tup[0])
             result = callback(tup[0], inst, *args, **kwargs)
-            inst.close()
             if not result:
                 break
             else:
@@ -938,24 +2206,38 @@ class DTweets_part(DObject):
         CREATE INDEX IF NOT EXISTS tweets__in_reply_to_tweet ON tweets(
             in_reply_to_tweet
         )
-        ''','''
-        CREATE TRIGGER IF NOT EXISTS tweets_last_updated
-        AFTER UPDATE ON tweets 
+        ''']
+    # applied in order on existing files; see DObject.__run_migrations()
+    MIGRATIONS = [[
+        # 1: last_update triggers used to rewrite every row in the partition
+        'DROP TRIGGER IF EXISTS tweets_last_updated',
+        'DROP TRIGGER IF EXISTS tweets_last_updated2',
+        '''
+        CREATE TRIGGER IF NOT EXISTS tweets__last_update_on_insert
+        AFTER INSERT ON tweets FOR EACH ROW
         BEGIN
-            UPDATE tweets SET last_update = DATETIME('now');
+            UPDATE tweets SET last_update = DATETIME('now')
+            WHERE tweet_id = NEW.tweet_id;
         END;
         ''','''
-        CREATE TRIGGER IF NOT EXISTS tweets_last_updated2
-        AFTER INSERT ON tweets 
+        CREATE TRIGGER IF NOT EXISTS tweets__last_update_on_update
+        AFTER UPDATE ON tweets FOR EACH ROW
+        WHEN NEW.last_update IS OLD.last_update
         BEGIN
-            UPDATE tweets SET last_update = DATETIME('now');
+            UPDATE tweets SET last_update = DATETIME('now')
+            WHERE tweet_id = NEW.tweet_id;
         END;
-        ''']
+        '''], [
+        # 2: raw entities JSON; rows stored with html_text/xml_text NULL are
+        # rendered on read (see utils.render_stored_tweets())
+        'ALTER TABLE tweets ADD COLUMN entities TEXT',
+        ]]
     ROW_REQUIREMENT = [
             'tweet_id*',
             'plain_text',
             ('html_text', ''),
             ('xml_text', ''),
+            ('entities#', None),
             ('coordinates#', ''),
             'date', 
             ('in_reply_to_tweet', None),
@@ -968,13 +2250,18 @@ class DTweets_part(DObject):
             ('is_my_fav', 0),
             # `last_update` is automatically updated and does not require input
             ]
+    DATETIME_COLUMNS = ['date', 'last_update']
+    # columns that change when a known tweet is fetched again; the rest of
+    # a tweet is written once (see insert(on_conflict='refresh'))
+    PERSPECTIVE_COLUMNS = ['retweeted_count', 'fav_count', 'is_my_fav']
         
     def __init__(self, filename='../var/tweets/data.db', isolation_mode='DEFERRED',
-            verbose=False):
+            verbose=False, profile=None):
         init_queries = self.INIT_QUERIES
         
         super(DTweets_part, self).__init__(
-                (filename, isolation_mode), init_queries, verbose)
+                (filename, isolation_mode), init_queries, verbose,
+                self.MIGRATIONS, profile)
 
     def get_by_id(self, tweet_id):
         '''get one tweet given one tweet_id; returns one sqlite3.Row instance'''
@@ -984,6 +2271,21 @@ class DTweets_part(DObject):
         return self.q('SELECT * FROM tweets WHERE tweet_id=:tweet_id',
                {'tweet_id': tweet_id}, 'ONE_ROW')
 
+    def get_by_ids(self, tweet_ids, columns=None):
+        '''get tweets for a list of tweet_ids, in chunks that stay under
+            sqlite's parameter limit; returns a list of sqlite3.Row (in no
+            particular order; ids not found are simply missing). columns
+            limits the columns read, e.g. ['tweet_id']
+        '''
+        result = []
+        select_list = self._make_select_list(columns)
+        for i in range(0, len(tweet_ids), self.MAX_SQL_VARIABLES):
+            (sql, par) = self._make_in_clause('tweet_id',
+                    tweet_ids[i:i + self.MAX_SQL_VARIABLES])
+            result.extend(self.q('SELECT %s FROM tweets WHERE %s' % (
+                select_list, sql), par, 'ALL_ROWS'))
+        return result
+
     def get_by_user(self, user_id):
         '''get tweets given one user or more users (give a list in user_id)
             returns list of sqlite3.Row instance
@@ -1021,6 +2323,36 @@ class DTweets_part(DObject):
         '''gets a list of sqlite3.Row objects for everything in the table'''
         return self.q('SELECT * FROM tweets', result_type='ALL_ROWS')
 
+    @classmethod
+    def _make_select_list(cls, columns=None):
+        '''returns '*' or a checked '`col1`,`col2`' list for a SELECT'''
+        if not columns:
+            return '*'
+        known_columns = set(
+                (k[0] if isinstance(k, tuple) else k).rstrip('*#')
+                for k in cls.ROW_REQUIREMENT)
+        known_columns.add('last_update')
+        for col_name in columns:
+            if not col_name in known_columns:
+                raise ValueError('unknown column: %s' % col_name)
+        return ','.join('`%s`' % col_name for col_name in columns)
+
+    def iter_all(self, columns=None, batch_size=1000):
+        '''yields sqlite3.Row objects for everything in the table, fetching
+            batch_size rows at a time. columns limits the columns read
+        '''
+        cursor = self.q('SELECT %s FROM tweets' % self._make_select_list(columns),
+                None, 'CURSOR')
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
     def __preflight_tweet_list(self, tweet_list):
         '''make sure the tweet list is OK; raises exception if not'''
         # preflight
@@ -1037,28 +2369,49 @@ class DTweets_part(DObject):
         self.__preflight_tweet_list(lst)
         result = []
 
-        # update one by one; but do everything in one transaction to maintain speed 
-        failed = False
+        # rows with the same columns share one cached UPDATE statement; do
+        # everything in one transaction to maintain speed
+        (accepted, json_columns) = self._parse_column_specs(self.ROW_REQUIREMENT)
         for tweet_dict in lst:
-            tweet_id = tweet_dict['tweet_id']
-            (set_clause, params) = self._make_set_clause(
-                    tweet_dict, self.ROW_REQUIREMENT)
-            this_result = self.q(
-                    'UPDATE tweets SET %s WHERE tweet_id=:tweet_id' % set_clause,
-                    [params, {'tweet_id': tweet_id}], 
-                    result_type='NUMBER_OF_ROWS_AFFECTED', auto_commit=False)
-            result.append('this_result')
-        
+            columns = tuple(sorted(c for c in tweet_dict if c in accepted))
+            (sql, extract) = self._statement('tweets', 'UPDATE',
+                    columns, ('tweet_id',), json_columns)
+            cursor = self.get_db().execute(sql, extract(tweet_dict))
+            result.append(cursor.rowcount > 0)
+        self.get_db().commit()
+
         if auto_close:
             self.close()
         return result if isinstance(tweets, list) else result[0]
 
+    def refresh_counters(self, tweets):
+        '''writes the PERSPECTIVE_COLUMNS of known tweets (dicts holding all
+            of them) without committing. rows whose counters did not change
+            are left alone. returns the number of rows updated
+        '''
+        columns = self.PERSPECTIVE_COLUMNS
+        sql = self._clause_texts.get('refresh_counters')
+        if sql is None:
+            sql = self._clause_texts['refresh_counters'] = '''
+                UPDATE tweets SET %s WHERE tweet_id=? AND (%s)
+                ''' % (','.join('`%s`=?' % c for c in columns),
+                    ' OR '.join('`%s` IS NOT ?' % c for c in columns))
+        get = operator.itemgetter(*columns)
+        params_list = []
+        for tweet in tweets:
+            counters = list(get(tweet))
+            params_list.append(counters + [tweet['tweet_id']] + counters)
+        if not params_list:
+            return 0
+        return self.q_many(sql, params_list)
+
     def update_perspective_fields(self, tweet_id=None, retweeted_count=None,
             fav_count=None, is_my_fav=None, items=None, auto_close=True):
         '''updates perspective fields in one or more rows. only provided fields
             are updated. to update multiple rows, set items = {'tweet_id1': {..}}
             returns a dict of {'tweet_id1':True,..} if items set, or just bool
         '''
+        multiple = bool(items)
         if not items:
             items = {tweet_id: {}}
             if retweeted_count is not None:
@@ -1068,63 +2421,57 @@ class DTweets_part(DObject):
             if is_my_fav is not None:
                 items[tweet_id]['is_my_fav'] = is_my_fav 
 
-        sql = 'UPDATE tweets SET %s WHERE tweet_id=:tweet_id'
-        result_dict = {} 
+        # items with the same fields share one cached UPDATE statement
+        result_dict = {}
         for k, v in items.iteritems():
-            (set_clause, params_dict) = self._make_set_clause(v)
-            this_result = self.q(
-                    'UPDATE tweets SET %s WHERE tweet_id=:tweet_id' % set_clause,
-                    [params, {'tweet_id': k}],
-                    result_type='NUMBER_OF_ROWS_AFFECTED', auto_commit=False)
-            result_dict[k] = this_result
-        #
+            v = dict((c, v[c]) for c in self.PERSPECTIVE_COLUMNS if c in v)
+            if not v:
+                result_dict[k] = False
+                continue
+            v['tweet_id'] = k
+            (sql, extract) = self._statement('tweets', 'UPDATE',
+                    tuple(sorted(v)), ('tweet_id',))
+            result_dict[k] = self.get_db().execute(sql, extract(v)).rowcount > 0
+        self.get_db().commit()
         if auto_close:
             self.close()
-        return result_dict if items else result_dict[tweet_id]    
+        return result_dict if multiple else result_dict[tweet_id]
 
-    def insert(self, tweets, on_operational_error='fail'):
+    def insert(self, tweets, on_operational_error='fail', on_conflict='replace'):
         '''inserts one or more tweets into the table. returns True if 
             all items are properly inserted.
             on_operational_error = 'fail' or 'continue'
+            on_conflict = 'replace' (rewrite known tweets entirely) or
+                'refresh' (known tweets only get their PERSPECTIVE_COLUMNS
+                updated, and only if these changed)
             Note: Please close the connection after finished inserting!
         '''
+        if on_conflict not in ('replace', 'refresh'):
+            raise ValueError('expecting on_conflict to be "replace" or "refresh"')
         lst = tweets if isinstance(tweets, list) else [tweets]
         self.__preflight_tweet_list(lst)
         
-        # add one by one; but do everything in one transaction to maintain speed 
-        failed = False
-        for tweet_dict in lst:
-            insert_tuple = self._make_insert_clause(tweet_dict)
-            insert_res = False
-            try:
-                insert_res = self.q(
-                        '''INSERT OR REPLACE INTO tweets %s''' % insert_tuple[0], 
-                        insert_tuple[1], 'NUMBER_OF_ROWS_AFFECTED',
-                        auto_commit=False
-                        )
-            except sqlite3.OperationalError as e:
-                sys.stderr.write('unable to insert: %s\n' % str(e))
-                if on_operational_error == 'continue':
-                    sys.stderr.write('...ignoring and continue\n')
-                    continue
-                elif on_operational_error == 'fail':
-                    failed = True
-                    break
-                else:
-                    raise ValueError('''
-                        expecting on_operational_error to be "continue" or "fail"
-                        ''')
-            except Exception as e:
-                sys.stderr.write('exception: ' + str(e))
-                failed = True
-                break
+        # rows with the same columns share one prepared statement; everything
+        # runs in one transaction
+        try:
+            if on_conflict == 'replace':
+                written = self.insert_many('tweets', lst, on_operational_error)
+            else:
+                written = self.insert_many('tweets', lst, on_operational_error,
+                        verb='INSERT OR IGNORE')
+                if written is not False:
+                    self.refresh_counters(lst)
+        except sqlite3.OperationalError as e:
+            sys.stderr.write('unable to insert: %s\n' % str(e))
+            written = False
+        except ValueError:
+            raise
+        except Exception as e:
+            sys.stderr.write('exception: ' + str(e))
+            written = False
 
-            if not insert_res:
-                failed = True
-                break
-            
         # end of transaction
-        if failed:
+        if written is False:
             self.get_db().rollback()
             return False
         else:
@@ -1132,6 +2479,337 @@ class DTweets_part(DObject):
             return True
 
 
+'''internal index: user / in_reply_to ids -> partitions that contain them;
+    also records the archive layout (partition scheme and scale)'''
+class DTweets_index(DObject):
+    # leading underscore keeps it out of DTweets' partition list
+    DB_FILENAME = '_index.db'
+    INIT_QUERIES = ['''
+        CREATE TABLE IF NOT EXISTS refs(
+            kind INTEGER,
+            ref_id INTEGER,
+            part_name TEXT,
+            PRIMARY KEY (kind, ref_id, part_name)
+        ) WITHOUT ROWID
+        ''','''
+        CREATE TABLE IF NOT EXISTS meta(
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''']
+    REF_USER = 1
+    REF_REPLY_TO_USER = 2
+    REF_REPLY_TO_TWEET = 3
+    # tweet column -> kind of reference stored in the index
+    INDEXED_COLUMNS = ['user', 'in_reply_to_user', 'in_reply_to_tweet']
+    REF_KINDS = {
+            'user': REF_USER,
+            'in_reply_to_user': REF_REPLY_TO_USER,
+            'in_reply_to_tweet': REF_REPLY_TO_TWEET,
+            }
+
+    def __init__(self, directory='../var/tweets', verbose=False, profile=None):
+        super(DTweets_index, self).__init__(
+                os.path.join(directory, self.DB_FILENAME),
+                self.INIT_QUERIES, verbose, profile=profile)
+
+    def get_meta(self, key):
+        '''returns a value from the meta table, or None'''
+        return self.q('SELECT value FROM meta WHERE key=:key',
+                {'key': key}, 'NUMBER')
+
+    def set_meta(self, key, value):
+        return self.q('''
+            INSERT OR REPLACE INTO meta (key, value) VALUES (:key, :value)
+            ''', {'key': key, 'value': value},
+            'NUMBER_OF_ROWS_AFFECTED', auto_commit=True)
+
+    def is_built(self):
+        '''True once the index covers every tweet in the archive'''
+        return '1' == self.get_meta('built')
+
+    def set_built(self, built=True):
+        return self.set_meta('built', '1' if built else '0')
+
+    def clear(self):
+        return self.q('DELETE FROM refs', None, 'NUMBER_OF_ROWS_AFFECTED',
+                auto_commit=True)
+
+    def add(self, part_name, tweets, auto_commit=True):
+        '''records that part_name holds tweets (dicts or sqlite3.Row)'''
+        refs = set()
+        for tweet in tweets:
+            is_dict = isinstance(tweet, dict)
+            for col_name in self.INDEXED_COLUMNS:
+                ref_id = tweet.get(col_name) if is_dict else tweet[col_name]
+                if ref_id is not None:
+                    refs.add((self.REF_KINDS[col_name], ref_id, part_name))
+        if not refs:
+            return 0
+        return self.q_many('''
+            INSERT OR IGNORE INTO refs (kind, ref_id, part_name) VALUES (?,?,?)
+            ''', list(refs), auto_commit=auto_commit)
+
+    def remove_partition(self, part_name):
+        '''forgets every reference into part_name'''
+        return self.q('DELETE FROM refs WHERE part_name=:part_name',
+                {'part_name': part_name}, 'NUMBER_OF_ROWS_AFFECTED',
+                auto_commit=True)
+
+    def get_partitions(self, kind, ref_ids):
+        '''returns a sorted list of partition names holding any of ref_ids'''
+        (in_sql, params) = self._make_in_clause('ref_id', ref_ids)
+        params['kind'] = kind
+        rows = self.q('''
+            SELECT DISTINCT part_name FROM refs WHERE kind=:kind AND %s
+            ''' % in_sql, params, 'ALL_ROWS')
+        return sorted(row['part_name'] for row in rows)
+
+
+'''compact, typed copy of a DTweets_part file for archives: integer epoch
+    dates, packed coordinates, flag bits and compressed text blobs'''
+class DTweets_compact(DObject):
+    DB_FILENAME = None
+    INIT_QUERIES = ['''
+        CREATE TABLE IF NOT EXISTS tweets(
+            tweet_id INTEGER PRIMARY KEY,
+            user INTEGER,
+            in_reply_to_tweet INTEGER,
+            in_reply_to_user INTEGER,
+            date INTEGER,               /* seconds since epoch, UTC */
+            flags INTEGER,              /* FLAG_* bits */
+            retweeted_count INTEGER,
+            fav_count INTEGER,
+            coordinates BLOB,           /* packed point, or JSON text */
+            source TEXT,
+            plain_text TEXT,
+            html_text BLOB,             /* compressed; see meta */
+            xml_text BLOB,
+            entities BLOB,
+            last_update INTEGER
+        )
+        ''','''
+        CREATE INDEX IF NOT EXISTS tweets__user ON tweets(
+            user
+        )
+        ''','''
+        CREATE TABLE IF NOT EXISTS meta(
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''']
+    # tweets columns in the order of encode_row() / decode_row()
+    COLUMNS = ['tweet_id', 'user', 'in_reply_to_tweet', 'in_reply_to_user',
+            'date', 'flags', 'retweeted_count', 'fav_count', 'coordinates',
+            'source', 'plain_text', 'html_text', 'xml_text', 'entities',
+            'last_update']
+    FLAG_IS_RETWEET = 1
+    FLAG_IS_MY_FAV = 2
+    # GeoJSON point -> little-endian (longitude, latitude) doubles
+    POINT_FORMAT = '<dd'
+    # how html_text/xml_text/entities are stored; 'zstd' needs the optional
+    # zstandard module
+    COMPRESSIONS = ['none', 'zlib', 'zstd']
+    DEFAULT_COMPRESSION = 'zlib'
+
+    def __init__(self, filename, verbose=False, profile=None):
+        super(DTweets_compact, self).__init__((filename, 'DEFERRED'),
+                self.INIT_QUERIES, verbose, profile=profile)
+        self.__codec = None
+
+    @classmethod
+    def get_codec(cls, compression):
+        '''returns (compress, decompress) functions for compression'''
+        if compression == 'none':
+            # still a BLOB, so reads give back the same bytes
+            return (lambda data: buffer(data), lambda data: str(data))
+        elif compression == 'zlib':
+            return (lambda data: buffer(zlib.compress(data, 6)),
+                    lambda data: zlib.decompress(data))
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ValueError('zstd compression needs the zstandard module')
+            compressor = zstandard.ZstdCompressor(level=3)
+            decompressor = zstandard.ZstdDecompressor()
+            return (lambda data: buffer(compressor.compress(data)),
+                    lambda data: decompressor.decompress(bytes(data)))
+        raise ValueError('expecting compression to be one of %s' %
+                ', '.join(cls.COMPRESSIONS))
+
+    @property
+    def compression(self):
+        return self.q("SELECT value FROM meta WHERE key='compression'",
+                None, 'NUMBER') or 'none'
+
+    def __get_codec(self):
+        if self.__codec is None:
+            self.__codec = self.get_codec(self.compression)
+        return self.__codec
+
+    @classmethod
+    def encode_date(cls, value):
+        '''datetime or 'YYYY-MM-DD HH:MM:SS' / Twitter created_at string
+            (UTC) -> seconds since epoch
+        '''
+        if value is None or value == '':
+            return None
+        if isinstance(value, basestring):
+            try:
+                value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                value = datetime.strptime(value.replace('+0000 ', ''),
+                        '%a %b %d %H:%M:%S %Y')
+        return calendar.timegm(value.utctimetuple())
+
+    @classmethod
+    def encode_coordinates(cls, value):
+        '''GeoJSON point -> packed bytes; anything else stays JSON text'''
+        if value is None or value == '':
+            return None
+        if isinstance(value, basestring):
+            value = json.loads(value)
+        if (isinstance(value, dict) and value.get('type') == 'Point'
+                and len(value.get('coordinates') or []) == 2):
+            return buffer(struct.pack(cls.POINT_FORMAT,
+                *value['coordinates']))
+        return json.dumps(value)
+
+    @classmethod
+    def decode_coordinates(cls, value):
+        if value is None:
+            return None
+        if isinstance(value, buffer):
+            return {'type': 'Point',
+                    'coordinates': list(struct.unpack(cls.POINT_FORMAT, value))}
+        return json.loads(value)
+
+    def encode_row(self, row):
+        '''DTweets_part row (sqlite3.Row or dict) -> compact column tuple,
+            in the order of COLUMNS
+        '''
+        (compress, decompress) = self.__get_codec()
+        def blob(value):
+            if value is None:
+                return None
+            if not isinstance(value, basestring):
+                value = json.dumps(value)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            return compress(value)
+        keys = row.keys()
+        return (
+                row['tweet_id'],
+                row['user'],
+                row['in_reply_to_tweet'],
+                row['in_reply_to_user'],
+                self.encode_date(row['date']),
+                ((self.FLAG_IS_RETWEET if row['is_retweet'] else 0)
+                    | (self.FLAG_IS_MY_FAV if row['is_my_fav'] else 0)),
+                row['retweeted_count'],
+                row['fav_count'],
+                self.encode_coordinates(row['coordinates']),
+                row['source'],
+                row['plain_text'],
+                blob(row['html_text']),
+                blob(row['xml_text']),
+                blob(row['entities'] if 'entities' in keys else None),
+                self.encode_date(row['last_update']
+                    if 'last_update' in keys else None),
+                )
+
+    def decode_row(self, row):
+        '''compact row (in COLUMNS order) -> dict shaped like a DTweets_part
+            ONE_DICT row (datetimes, decoded coordinates and entities)
+        '''
+        (compress, decompress) = self.__get_codec()
+        def text(value):
+            if value is None:
+                return None
+            return decompress(value).decode('utf-8')
+        (tweet_id, user, in_reply_to_tweet, in_reply_to_user, date, flags,
+                retweeted_count, fav_count, coordinates, source, plain_text,
+                html_text, xml_text, entities, last_update) = row
+        entities = text(entities)
+        return {
+                'tweet_id': tweet_id,
+                'user': user,
+                'in_reply_to_tweet': in_reply_to_tweet,
+                'in_reply_to_user': in_reply_to_user,
+                'date': None if date is None else datetime.utcfromtimestamp(date),
+                'is_retweet': 1 if flags & self.FLAG_IS_RETWEET else 0,
+                'is_my_fav': 1 if flags & self.FLAG_IS_MY_FAV else 0,
+                'retweeted_count': retweeted_count,
+                'fav_count': fav_count,
+                'coordinates': self.decode_coordinates(coordinates),
+                'source': source,
+                'plain_text': plain_text,
+                'html_text': text(html_text),
+                'xml_text': text(xml_text),
+                'entities': None if entities is None else json.loads(entities),
+                'last_update': (None if last_update is None
+                    else datetime.utcfromtimestamp(last_update)),
+                }
+
+    def insert(self, rows):
+        '''encodes and stores DTweets_part rows; commits once'''
+        written = self.q_many('INSERT OR REPLACE INTO tweets (%s) VALUES (%s)'
+                % (','.join(self.COLUMNS), ','.join('?' * len(self.COLUMNS))),
+                [self.encode_row(row) for row in rows])
+        self.commit()
+        return written
+
+    def get_by_ids(self, tweet_ids):
+        '''decoded dicts for a list of tweet_ids (ids not found are missing)'''
+        result = []
+        for i in range(0, len(tweet_ids), self.MAX_SQL_VARIABLES):
+            (sql, par) = self._make_in_clause('tweet_id',
+                    tweet_ids[i:i + self.MAX_SQL_VARIABLES])
+            rows = self.q('SELECT %s FROM tweets WHERE %s' % (
+                ','.join(self.COLUMNS), sql), par, 'ALL_ROWS')
+            result.extend(self.decode_row(row) for row in rows)
+        return result
+
+    def iter_all(self, batch_size=1000):
+        '''yields every tweet as a decoded dict, batch_size rows per fetch'''
+        cursor = self.q('SELECT %s FROM tweets' % ','.join(self.COLUMNS),
+                None, 'CURSOR')
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self.decode_row(row)
+        finally:
+            cursor.close()
+
+    @classmethod
+    def convert(cls, source_filename, target_filename,
+            compression=DEFAULT_COMPRESSION, batch_size=1000):
+        '''writes a compact copy of the DTweets_part file source_filename;
+            the source is left untouched. returns the number of tweets
+        '''
+        cls.get_codec(compression)
+        if os.path.isfile(target_filename):
+            raise ValueError('%s already exists' % target_filename)
+        source = DTweets_part(filename=source_filename)
+        target = cls(target_filename)
+        target.q("INSERT OR REPLACE INTO meta (key, value) VALUES ('compression', :c)",
+                {'c': compression}, 'NUMBER_OF_ROWS_AFFECTED', auto_commit=True)
+        count = 0
+        batch = []
+        for row in source.iter_all(None, batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                count += target.insert(batch)
+                batch = []
+        if batch:
+            count += target.insert(batch)
+        target.q('VACUUM', None, 'NUMBER_OF_ROWS_AFFECTED')
+        source.close()
+        target.close()
+        return count
+
 class DThread(DObject):
     DB_FILENAME= 'tt_main.db'
     INIT_QUERIES= ['''
@@ -1182,8 +2860,9 @@ class DSchedules(DObject):
             action, target, interval 
         ''']
 
-    def __init__(self, directory='../var'):
-        super(DSchedules,self).__init__(directory+'/'+self.DB_FILENAME, self.INIT_QUERIES)
+    def __init__(self, directory='../var', profile=None):
+        super(DSchedules,self).__init__(directory+'/'+self.DB_FILENAME, self.INIT_QUERIES,
+                profile=profile)
 
     def insert(self, schedule_info):
         insert_tuple= self._make_insert_clause(schedule_info,['interval','profile_id','action','target','priority'])
@@ -1263,13 +2942,37 @@ class DTimelines(DObject):
         CREATE INDEX IF NOT EXISTS timelines__mentions_timeline ON timelines(
            mentions_timeline 
         )
+        ''']
+    MIGRATIONS = [[
+        # 1: per-row last_update (the old trigger touched the whole table)
+        'DROP TRIGGER IF EXISTS timelines_last_updated',
+        '''
+        CREATE TRIGGER IF NOT EXISTS timelines__last_update_on_insert
+        AFTER INSERT ON timelines FOR EACH ROW
+        BEGIN
+            UPDATE timelines SET last_update = DATETIME('now')
+            WHERE tweet_id = NEW.tweet_id;
+        END;
         ''','''
-        CREATE TRIGGER IF NOT EXISTS timelines_last_updated
-        AFTER UPDATE ON timelines 
+        CREATE TRIGGER IF NOT EXISTS timelines__last_update_on_update
+        AFTER UPDATE ON timelines FOR EACH ROW
+        WHEN NEW.last_update IS OLD.last_update
         BEGIN
-            UPDATE timelines SET last_update = DATETIME('now');
+            UPDATE timelines SET last_update = DATETIME('now')
+            WHERE tweet_id = NEW.tweet_id;
         END;
-        ''']
+        '''], [
+        # 2: newest tweet_id fetched per (profile, timeline, owner)
+        '''
+        CREATE TABLE IF NOT EXISTS cursors(
+            profile_alias TEXT NOT NULL, /* '' (ANY_PROFILE) for user_timeline */
+            timeline TEXT NOT NULL,      /* home_timeline, user_timeline, .. */
+            owner INTEGER NOT NULL,      /* owner user ID; 0 unless user_timeline */
+            newest_id INTEGER NOT NULL,
+            last_update TEXT,
+            PRIMARY KEY (profile_alias, timeline, owner)
+        )
+        ''']]
     ROW_REQUIREMENT = [
             'tweet_id',
             ('home_timeline', None),
@@ -1277,21 +2980,115 @@ class DTimelines(DObject):
             ('mentions_timeline', None),
             # last_update is automatically updated and does not require input
             ]
+    TIMELINE_COLUMNS = ('home_timeline', 'user_timeline', 'mentions_timeline')
+    # cursor profile_alias of timelines that read the same with any profile
+    # (user timelines)
+    ANY_PROFILE = ''
 
-    def __init__(self, directory='../var', verbose=False):
+    def __init__(self, directory='../var', verbose=False, profile=None):
         super(DTimelines, self).__init__(
                 os.path.join(directory, self.DB_FILENAME),
                 self.INIT_QUERIES, 
-                verbose)
-    
+                verbose,
+                self.MIGRATIONS,
+                profile)
+
+    @classmethod
+    def __check_timeline(cls, timeline):
+        if not timeline in cls.TIMELINE_COLUMNS:
+            raise ValueError('expecting timeline to be one of: %s' %
+                    ', '.join(cls.TIMELINE_COLUMNS))
+
+    def known_ids(self, tweet_ids, timeline='home_timeline', owner=None):
+        '''returns the set of tweet_ids (as int) already stored on timeline
+            ('home_timeline', 'user_timeline' or 'mentions_timeline') of owner
+            (the authenticating user ID for home and mentions; any owner if
+            None); TpTimeline.iter_timeline_pages() stops paging on these
+        '''
+        self.__check_timeline(timeline)
+        tweet_ids = list(tweet_ids)
+        known = set()
+        for i in range(0, len(tweet_ids), self.MAX_SQL_VARIABLES):
+            (sql, par) = self._make_in_clause('tweet_id',
+                    tweet_ids[i:i + self.MAX_SQL_VARIABLES])
+            if owner is None:
+                sql = '%s AND %s IS NOT NULL' % (sql, timeline)
+            else:
+                sql = '%s AND %s=:owner' % (sql, timeline)
+                par['owner'] = owner
+            rows = self.q('''
+                SELECT tweet_id FROM timelines WHERE %s
+                ''' % sql, par, 'ALL_ROWS')
+            known.update(int(row['tweet_id']) for row in rows or [])
+        return known
+
+    def get_newest_id(self, timeline='home_timeline', owner=None):
+        '''the newest tweet_id stored on timeline (of owner, if given), to be
+            used as since_id; None if there is none
+        '''
+        self.__check_timeline(timeline)
+        if owner is None:
+            return self.q('''
+                SELECT MAX(tweet_id) FROM timelines WHERE %s IS NOT NULL
+                ''' % timeline, None, 'NUMBER')
+        return self.q('''
+            SELECT MAX(tweet_id) FROM timelines WHERE %s=:owner
+            ''' % timeline, {'owner': owner}, 'NUMBER')
+
+    def get_cursor(self, profile_alias, timeline='home_timeline', owner=None):
+        '''the newest tweet_id fetched by profile_alias on timeline (owner is
+            the user ID of a user_timeline), to be passed as since_id.
+            None if that timeline was never fetched
+        '''
+        self.__check_timeline(timeline)
+        return self.q('''
+            SELECT newest_id FROM cursors WHERE profile_alias=:profile_alias
+            AND timeline=:timeline AND owner=:owner
+            ''', {
+                'profile_alias': profile_alias,
+                'timeline': timeline,
+                'owner': owner or 0,
+                }, 'NUMBER')
+
+    def get_cursors(self, profile_alias=None):
+        '''all cursors (of profile_alias, if given) as a list of dicts'''
+        if profile_alias is None:
+            return self.q('SELECT * FROM cursors', None, 'ALL_DICTS')
+        return self.q('''
+            SELECT * FROM cursors WHERE profile_alias=:profile_alias
+            ''', {'profile_alias': profile_alias}, 'ALL_DICTS')
+
+    def advance_cursor(self, profile_alias, timeline, owner, newest_id,
+            auto_commit=True):
+        '''moves the cursor to newest_id; a cursor never moves backwards'''
+        self.__check_timeline(timeline)
+        params = {
+                'profile_alias': profile_alias,
+                'timeline': timeline,
+                'owner': owner or 0,
+                'newest_id': newest_id,
+                }
+        self.q('''
+            INSERT OR REPLACE INTO cursors(profile_alias, timeline, owner,
+                newest_id, last_update)
+            VALUES(:profile_alias, :timeline, :owner,
+                MAX(:newest_id, IFNULL((SELECT newest_id FROM cursors
+                    WHERE profile_alias=:profile_alias AND timeline=:timeline
+                    AND owner=:owner), 0)),
+                DATETIME('now'))
+            ''', params, 'NUMBER_OF_ROWS_AFFECTED', auto_commit)
+
     def insert(self, tweet_ids, home_timeline=1, user_timeline=None,
-            mentions_timeline=None, auto_close=True):
+            mentions_timeline=None, auto_close=True, profile_alias=None,
+            newest_id=None):
         '''insert one or more tweet_ids; do not pass a tweet-dict list directly.
-            call utils.extract_tweet_id() to preprocess a tweet-dict list
+            call utils.extract_tweet_id() to preprocess a tweet-dict list.
+            timelines given as None are left as stored. with profile_alias, the cursor of each timeline given is advanced
+            to newest_id (default: the largest of tweet_ids) in the same
+            transaction (see get_cursor())
         '''
         lst = tweet_ids if isinstance(tweet_ids, list) else [tweet_ids]
         result_dict = {}
-        fail_count = 0
         
         kv = make_dict([
             ('tweet_id', 0),
@@ -1300,22 +3097,47 @@ class DTimelines(DObject):
             ('mentions_timeline', mentions_timeline),
             ], omit_if_none=True)
 
+        rows = []
         for tweet_id in lst:
             if isinstance(tweet_id, int) or isinstance(tweet_id, str): 
-                kv['tweet_id'] = tweet_id
+                row = kv.copy()
+                row['tweet_id'] = tweet_id
+                rows.append(row)
             else:
                 raise TypeError('expecting tweet_id to be int or str')
-            (columns_clause, params) = self.__class__._make_insert_clause(kv)
-            res = self.q('INSERT OR REPLACE INTO timelines %s' % columns_clause, 
-                    params, 'NUMBER_OF_ROWS_AFFECTED', auto_commit=False)
-            if not res:
-                fail_count += 1
-            result_dict[tweet_id] = res
-        
-        if fail_count:
-            self.get_db().rollback
+
+        # upsert with one executemany() each: a tweet on several timelines
+        # keeps the columns written for the others (INSERT OR REPLACE would
+        # reset them)
+        res = self.insert_many('timelines',
+                [{'tweet_id': row['tweet_id']} for row in rows],
+                verb='INSERT OR IGNORE')
+        columns = tuple(sorted(kv))
+        if res is not False and rows and len(columns) > 1:
+            (sql, extract) = self._statement('timelines', 'UPDATE', columns,
+                    ('tweet_id',))
+            try:
+                self.q_many(sql, map(extract, rows))
+            except sqlite3.OperationalError as e:
+                sys.stderr.write('unable to insert: %s\n' % str(e))
+                res = False
+        if res is not False and profile_alias is not None and lst:
+            if newest_id is None:
+                newest_id = max(int(tweet_id) for tweet_id in lst)
+            for (timeline, value) in [
+                    ('home_timeline', home_timeline),
+                    ('user_timeline', user_timeline),
+                    ('mentions_timeline', mentions_timeline)]:
+                if value is not None:
+                    self.advance_cursor(profile_alias, timeline,
+                            value if timeline == 'user_timeline' else None,
+                            newest_id, auto_commit=False)
+        if res is False:
+            self.get_db().rollback()
         else:
             self.get_db().commit()
+        for tweet_id in lst:
+            result_dict[tweet_id] = 0 if res is False else 1
         if auto_close:
             self.close()
 
@@ -1336,21 +3158,17 @@ class DTimelines(DObject):
             ('mentions_timeline', mentions_timeline),
             ], omit_if_none=True)
 
+        (sql, extract) = self._statement('timelines', 'UPDATE',
+                tuple(sorted(kv)), ('tweet_id',))
         for tweet_id in lst:
             kv['tweet_id'] = tweet_id
-            (set_clause, params) = self.__class__._make_set_clause(kv,
-                    self.ROW_REQUIREMENT)
-            res = self.q('''
-                    UPDATE timelines SET %s WHERE tweet_id=:tweet_id
-                    ''' % columns_clause, 
-                    params, 'NUMBER_OF_ROWS_AFFECTED',
-                    auto_commit=False)
+            res = self.get_db().execute(sql, extract(kv)).rowcount
             if not res:
                 fail_count += 1
             result_dict[tweet_id] = res
         
         if fail_count:
-            self.get_db().rollback
+            self.get_db().rollback()
         else:
             self.get_db().commit()
         if auto_close:
@@ -1360,16 +3178,24 @@ class DTimelines(DObject):
         return result_dict if isinstance(tweet_ids, list) else (
                 result_dict[tweet_ids])
     
-    def get_home_timeline(self):
-        '''gets a list of tweet_IDs corresponding to the home timeline.
-            returns False on failure
+    def get_home_timeline(self, user_id=None):
+        '''gets a list of tweet_IDs corresponding to user_id's home timeline
+            (any home timeline if None). returns False on failure. pass the
+            list to DTweets.get_by_id() to fetch the tweets with one query per
+            partition
         '''
-        rows = self.q('SELECT tweet_id FROM timelines WHERE home_timeline=1',
-                None, 'ALL_ROWS')
+        if user_id is None:
+            rows = self.q('''
+                SELECT tweet_id FROM timelines WHERE home_timeline IS NOT NULL
+                ''', None, 'ALL_ROWS')
+        else:
+            rows = self.q('''
+                SELECT tweet_id FROM timelines WHERE home_timeline=:user_id
+                ''', {'user_id': user_id}, 'ALL_ROWS')
         if rows:
             res_list = []
             for row in rows:
-                res_list.append(rows['tweet_id'])
+                res_list.append(row['tweet_id'])
             return res_list    
         else:
             return False
@@ -1384,7 +3210,7 @@ class DTimelines(DObject):
         if rows:
             res_list = []
             for row in rows:
-                res_list.append(rows['tweet_id'])
+                res_list.append(row['tweet_id'])
             return res_list    
         else:
             return False
@@ -1399,7 +3225,7 @@ class DTimelines(DObject):
         if rows:
             res_list = []
             for row in rows:
-                res_list.append(rows['tweet_id'])
+                res_list.append(row['tweet_id'])
             return res_list    
         else:
             return False
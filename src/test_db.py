@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 import sys
+import os
+import time
 from datetime import datetime
 import random
 from pprint import pprint
-from db import DTweets, DTimelines
+from db import DTweets, DTimelines, DTweets_part, DTweets_compact, zstandard
 import utils
 import timeit
 
@@ -180,7 +182,560 @@ def add_tweets_to(dbtweet_obj, tl, count=20):
     dbtweet_obj.insert(lst)
     tl.insert(utils.extract_tweet_id(lst), home_timeline=1)
     sys.stdout.write('...round done\n')    
+
+def make_sample_row(tweet_id):
+    '''a DTweets_part-ready row; cheaper than prepare_DTweet_item() for bulk fills'''
+    text = make_random_text()
+    return {
+            'tweet_id': tweet_id,
+            'plain_text': text,
+            'html_text': text,
+            'xml_text': text,
+            'coordinates': None,
+            'date': '2014-01-01 00:00:00',
+            'in_reply_to_tweet': None,
+            'in_reply_to_user': None,
+            'user': random.randint(1, 10000),
+            'is_retweet': 0,
+            'source': 'web',
+            'retweeted_count': 0,
+            'fav_count': 0,
+            'is_my_fav': 0,
+            }
+
+def bench_last_update(filename='/tmp/tt_bench/last_update.db',
+        checkpoints=(1000, 10000, 100000, 1000000), sample_size=1000):
+    '''insert cost per row should stay flat as the partition grows'''
+    if os.path.isfile(filename):
+        os.remove(filename)
+    part = DTweets_part(filename=filename)
+    columns = make_sample_row(0).keys()
+    fill_sql = 'INSERT INTO tweets (%s) VALUES (%s)' % (
+            ','.join(columns), ','.join('?' * len(columns)))
+    row_count = 0
+    next_id = 1
+    for checkpoint in checkpoints:
+        # fill up to the checkpoint, then time a fresh batch of inserts
+        fill = []
+        while row_count + len(fill) < checkpoint:
+            row = make_sample_row(next_id)
+            fill.append([row[c] for c in columns])
+            next_id += 1
+        part.get_db().executemany(fill_sql, fill)
+        part.get_db().commit()
+        row_count = checkpoint
+
+        sample = [make_sample_row(next_id + i) for i in range(sample_size)]
+        next_id += sample_size
+        start = time.time()
+        part.insert(sample)
+        elapsed = time.time() - start
+        row_count += sample_size
+        print '%8d rows: %.1f usec/insert' % (checkpoint, elapsed * 1e6 / sample_size)
+    part.close()
+
+def bench_row_decoder(filename='/tmp/tt_bench/row_decoder.db', row_count=100000):
+    '''fetch throughput of ALL_DICTS and ONE_DICT (decoded rows)'''
+    if os.path.isfile(filename):
+        os.remove(filename)
+    part = DTweets_part(filename=filename)
+    part.insert([make_sample_row(i) for i in range(1, row_count + 1)])
+
+    start = time.time()
+    rows = part.q('SELECT * FROM tweets', None, 'ALL_DICTS')
+    elapsed = time.time() - start
+    print 'ALL_DICTS: %d rows, %.0f rows/sec' % (len(rows), len(rows) / elapsed)
+
+    start = time.time()
+    for tweet_id in xrange(1, row_count + 1):
+        part.q('SELECT * FROM tweets WHERE tweet_id=:tweet_id',
+                {'tweet_id': tweet_id}, 'ONE_DICT')
+    elapsed = time.time() - start
+    print 'ONE_DICT: %d queries, %.0f rows/sec' % (row_count, row_count / elapsed)
+    part.close()
+
+def bench_routing(count=1000000, partition_scale=2):
+    '''partition routing speed per scheme: compute_partition_name() per
+        tweet vs. one partition_function() applied over a batch of IDs
+    '''
+    ids = [random.randint(10 ** 17, 10 ** 18) for i in xrange(count)]
+    for scheme in DTweets.PARTITION_SCHEMES:
+        start = time.time()
+        for tweet_id in ids:
+            DTweets.compute_partition_name(tweet_id, partition_scale, scheme)
+        per_call = time.time() - start
+
+        route = DTweets.partition_function(partition_scale, scheme)
+        start = time.time()
+        names = map(route, ids)
+        batched = time.time() - start
+
+        counts = {}
+        for name in names:
+            counts[name] = counts.get(name, 0) + 1
+        print '%s: %.2f usec/id (per call), %.2f usec/id (batch), %d..%d ids/partition' % (
+                scheme, per_call * 1e6 / count, batched * 1e6 / count,
+                min(counts.values()), max(counts.values()))
+
+def bench_profiles(directory='/tmp/tt_bench', batch_count=200, batch_size=50):
+    '''ingest (small batches, one commit each) and read throughput per
+        connection profile
+    '''
+    for profile in [None] + sorted(DTweets_part.CONNECTION_PROFILES):
+        filename = os.path.join(directory, 'profile_%s.db' % profile)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.isfile(filename + suffix):
+                os.remove(filename + suffix)
+        part = DTweets_part(filename=filename, profile=profile)
+        start = time.time()
+        for i in xrange(batch_count):
+            part.insert([make_sample_row(i * batch_size + j + 1)
+                    for j in xrange(batch_size)])
+        ingest = time.time() - start
+
+        row_count = batch_count * batch_size
+        start = time.time()
+        for tweet_id in xrange(1, row_count + 1):
+            part.q('SELECT * FROM tweets WHERE tweet_id=:tweet_id',
+                    {'tweet_id': tweet_id}, 'ONE_ROW')
+        read = time.time() - start
+        print '%-12s ingest: %.0f rows/sec, read: %.0f rows/sec' % (
+                profile, row_count / ingest, row_count / read)
+        part.close()
+
+def bench_statements(count=100000):
+    '''per-row cost of building SQL parameters: named-parameter clause
+        builder vs. the cached positional extractor of _statement()
+    '''
+    rows = [make_sample_row(i) for i in xrange(1, count + 1)]
+    start = time.time()
+    for row in rows:
+        DTweets_part._make_insert_clause(row)
+    named = time.time() - start
+
+    start = time.time()
+    for row in rows:
+        (sql, extract) = DTweets_part._statement('tweets', 'INSERT OR REPLACE',
+                tuple(sorted(row)))
+        extract(row)
+    positional = time.time() - start
+    print '_make_insert_clause: %.2f usec/row, _statement: %.2f usec/row' % (
+            named * 1e6 / count, positional * 1e6 / count)
+
+def bench_write_behind(directory='/tmp/tt_bench/write_behind', bursts=300,
+        burst_size=10):
+    '''ingest of small bursts: DTweets.insert() per burst vs. the
+        write-behind buffer (group commit)
+    '''
+    import shutil
+    for write_behind in (False, True):
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        t = DTweets(directory=directory, partition_scale=1)
+        if write_behind:
+            t.start_write_behind()
+        start = time.time()
+        for b in xrange(bursts):
+            t.insert([make_sample_row(b * burst_size + i + 1)
+                    for i in xrange(burst_size)])
+        t.flush()
+        elapsed = time.time() - start
+        t.close()
+        print 'write-behind %-5s: %.0f tweets/sec' % (write_behind,
+                bursts * burst_size / elapsed)
+
+def bench_refresh(directory='/tmp/tt_bench/refresh', tweet_count=20000,
+        poll_size=200, polls=100, changed_ratio=0.1):
+    '''re-polling known tweets: rows written by sqlite (total_changes) and
+        time per poll, replace vs. refresh
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rows = [make_sample_row(i) for i in xrange(1, tweet_count + 1)]
+    for on_conflict in ('replace', 'refresh'):
+        filename = os.path.join(directory, '%s.db' % on_conflict)
+        if os.path.isfile(filename):
+            os.remove(filename)
+        part = DTweets_part(filename=filename)
+        part.insert([dict(r) for r in rows])
+        db = part.get_db()
+        changes = db.total_changes
+        start = time.time()
+        for p in xrange(polls):
+            poll = [dict(r) for r in random.sample(rows, poll_size)]
+            for r in poll[:int(poll_size * changed_ratio)]:
+                r['fav_count'] += 1
+            part.insert(poll, on_conflict=on_conflict)
+        elapsed = time.time() - start
+        print '%-7s: %.0f rows written/poll, %.1f msec/poll' % (on_conflict,
+                float(db.total_changes - changes) / polls,
+                elapsed * 1e3 / polls)
+        part.close()
+
+def bench_known_ids(directory='/tmp/tt_bench/known_ids', polls=50,
+        poll_size=200, new_per_poll=20):
+    '''overlapping timeline polls: rendering and writing every status vs.
+        utils.store_tweets() skipping known ones
+    '''
+    import shutil
+    statuses = [make_sample_tweet_dict() for i in xrange(
+        poll_size + polls * new_per_poll)]
+    for skip_known in (False, True):
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        t = DTweets(directory=directory, partition_scale=1)
+        start = time.time()
+        for p in xrange(polls):
+            # newest first, most of it already seen in the previous poll
+            poll = statuses[p * new_per_poll:p * new_per_poll + poll_size]
+            if skip_known:
+                utils.store_tweets(t, poll)
+            else:
+                t.insert([utils.prepare_DTweet_item(s) for s in poll])
+        elapsed = time.time() - start
+        print 'skip known %-5s: %.1f msec/poll, hit ratio %.2f' % (skip_known,
+                elapsed * 1e3 / polls, t.known_id_stats['hit_ratio'])
+        t.close()
+
+def bench_lazy(directory='/tmp/tt_bench/lazy', tweet_count=20000,
+        hot_count=200, reads=20):
+    '''eager vs. lazy html/xml storage: partition size, ingest speed and
+        read latency (cold = first render, hot = LRU hit)
+    '''
+    import shutil
+    statuses = [make_sample_tweet_dict() for i in xrange(tweet_count)]
+    hot_ids = [s['id'] for s in statuses[:hot_count]]
+    for lazy in (False, True):
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+        t = DTweets(directory=directory, partition_scale=0)
+        start = time.time()
+        for i in xrange(0, tweet_count, 200):
+            t.insert(utils.prepare_DTweet_items(statuses[i:i + 200],
+                lazy=lazy)[0])
+        ingest = time.time() - start
+        t.close()
+        size = sum(os.path.getsize(os.path.join(directory, f))
+                for f in os.listdir(directory) if f.endswith('.db')
+                and not f.startswith('_'))
+
+        t = DTweets(directory=directory, partition_scale=0)
+        utils._render_cache.clear()
+        latencies = []
+        for r in xrange(reads):
+            start = time.time()
+            utils.render_stored_tweets(t.get_by_id(hot_ids))
+            latencies.append(time.time() - start)
+        t.close()
+        print ('lazy %-5s: %.0f bytes/tweet, ingest %.0f tweets/sec, '
+                'read %d: cold %.1f msec, hot %.1f msec') % (lazy,
+                float(size) / tweet_count, tweet_count / ingest, hot_count,
+                latencies[0] * 1e3, min(latencies[1:]) * 1e3)
+
+def bench_compact(directory='/tmp/tt_bench/compact', tweet_count=20000):
+    '''bytes/tweet and full-scan throughput (decoded rows/sec) of a
+        DTweets_part file vs. its DTweets_compact copies
+    '''
+    import shutil
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    source = os.path.join(directory, 'part.db')
+    part = DTweets_part(filename=source)
+    for i in xrange(0, tweet_count, 1000):
+        part.insert([utils.prepare_DTweet_item(make_sample_tweet_dict())
+            for j in xrange(1000)])
+    part.q('VACUUM', None, 'NUMBER_OF_ROWS_AFFECTED')
+
+    start = time.time()
+    count = len(part.q('SELECT * FROM tweets', None, 'ALL_DICTS'))
+    elapsed = time.time() - start
+    part.close()
+    print '%-13s: %.0f bytes/tweet, scan %.0f tweets/sec' % ('DTweets_part',
+            float(os.path.getsize(source)) / count, count / elapsed)
+
+    compressions = ['none', 'zlib'] + (['zstd'] if zstandard else [])
+    for compression in compressions:
+        target = os.path.join(directory, 'compact_%s.db' % compression)
+        DTweets_compact.convert(source, target, compression)
+        compact = DTweets_compact(target)
+        start = time.time()
+        count = sum(1 for row in compact.iter_all())
+        elapsed = time.time() - start
+        compact.close()
+        print '%-13s: %.0f bytes/tweet, scan %.0f tweets/sec' % (
+                'compact/' + compression,
+                float(os.path.getsize(target)) / count, count / elapsed)
+
+def bench_analytics(directory='/tmp/tt_bench/analytics', tweet_count=200000):
+    '''tweets per user per day: apply_to_all_tweets() callback vs. the
+        NumPy columnar scan of analytics (serial and parallel)
+    '''
+    import shutil
+    import analytics
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    t = DTweets(directory=directory, partition_scale=1)
+    for i in xrange(0, tweet_count, 10000):
+        rows = [make_sample_row(i + j + 1) for j in xrange(10000)]
+        for row in rows:
+            # created_at format, as stored from raw API statuses
+            row['date'] = datetime(2014, random.randint(1, 12),
+                    random.randint(1, 28), 12).strftime(
+                    '%a %b %d %H:%M:%S +0000 %Y')
+        t.insert(rows, on_conflict='replace')
+    t.close()
+
+    t = DTweets(directory=directory)
+    counts = {}
+    def count(tweet):
+        # 'Wed May 23 .. 2014' -> 'May 23 2014'
+        key = (tweet['user'], tweet['date'][4:10] + tweet['date'][-5:])
+        counts[key] = counts.get(key, 0) + 1
+        return True
+    start = time.time()
+    t.apply_to_all_tweets(count, columns=['user', 'date'])
+    print 'apply_to_all_tweets: %.2f sec, %d groups' % (
+            time.time() - start, len(counts))
+    t.close()
+
+    for parallelism in (1, 4):
+        t = DTweets(directory=directory, parallelism=parallelism)
+        start = time.time()
+        (keys, group_counts) = analytics.tweets_per_user_per_day(t)
+        print 'analytics, parallelism %d: %.2f sec, %d groups' % (
+                parallelism, time.time() - start, len(group_counts))
+        t.close()
+
+    t = DTweets(directory=directory, parallelism=4)
+    start = time.time()
+    arrays = analytics.scan_columns(t)
+    (users, tweet_counts) = analytics.top_k(arrays['user'], 10)
+    (values, value_counts) = analytics.histogram(arrays['retweeted_count'])
+    print 'scan_columns + top_k + histogram: %.2f sec for %d tweets' % (
+            time.time() - start, len(arrays['tweet_id']))
+    t.close()
+
+def open_db_files(directory):
+    '''number of file handles this process has open on directory/*.db'''
+    directory = os.path.abspath(directory)
+    count = 0
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            target = os.readlink(os.path.join('/proc/self/fd', fd))
+        except OSError:
+            continue
+        if target.startswith(directory) and target.endswith('.db'):
+            count += 1
+    return count
+
+def bench_scatter(directory='/tmp/tt_bench/scatter', tweet_count=20000,
+        user_count=50, limit=20):
+    '''get_by_user()/scatter() merged ORDER BY/LIMIT across partitions vs.
+        one sorted list, serial and parallel; worker connections after the
+        idle timeout and close()
+    '''
+    import shutil
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    rows = [make_sample_row(random.randint(1, 1 << 60))
+            for i in xrange(tweet_count)]
+    for row in rows:
+        row['user'] = random.randint(1, user_count)
+        row['fav_count'] = random.randint(0, 100)
+    t = DTweets(directory=directory, partition_scale=1)
+    t.insert([dict(r) for r in rows], on_conflict='replace')
+    t.close()
+
+    for parallelism in (1, 4):
+        t = DTweets(directory=directory, partition_scale=1,
+                parallelism=parallelism, idle_timeout=1)
+        start = time.time()
+        mismatches = 0
+        for user in xrange(1, user_count + 1):
+            expected = sorted(r['tweet_id'] for r in rows
+                    if r['user'] == user)[:limit]
+            got = [r['tweet_id'] for r in t.get_by_user(user,
+                    order_by='tweet_id', limit=limit)]
+            mismatches += got != expected
+        elapsed = time.time() - start
+        # the query has its own ORDER BY/LIMIT: scatter must wrap it
+        got = [r['tweet_id'] for r in t.scatter(
+                'SELECT * FROM tweets WHERE fav_count=:f ORDER BY user LIMIT 1000',
+                {'f': 50}, ('tweet_id', 'DESC'), limit)]
+        expected = sorted((r['tweet_id'] for r in rows if r['fav_count'] == 50),
+                reverse=True)[:limit]
+        mismatches += got != expected
+        handles = open_db_files(directory)
+        time.sleep(1.5)
+        # any main-thread partition access sweeps idle workers
+        t.get_by_id(rows[0]['tweet_id'])
+        idle_handles = open_db_files(directory)
+        t.close()
+        print ('parallelism %d: %.1f msec/user, %d mismatches, db handles: '
+                'open %d, after idle %d, after close %d') % (parallelism,
+                elapsed * 1e3 / user_count, mismatches, handles,
+                idle_handles, open_db_files(directory))
+
+def bench_monthly(directory='/tmp/tt_bench/monthly', per_month=2000,
+        limit=200):
+    '''monthly scheme: partitions_between() pruning, get_latest() reading
+        newest months first (partitions opened), and archive_partition()
+        with parallel workers holding connections to the archived month
+    '''
+    import shutil
+    for d in (directory, directory + '_archive'):
+        if os.path.isdir(d):
+            shutil.rmtree(d)
+    os.makedirs(directory)
+    rows = []
+    for month in xrange(1, 13):
+        first = DTweets.snowflake_id_at(datetime(2015, month, 1))
+        last = DTweets.snowflake_id_at(datetime(2015, month, 28))
+        rows.extend(make_sample_row(random.randint(first, last))
+                for i in xrange(per_month))
+    t = DTweets(directory=directory, partition_scheme='monthly')
+    t.insert([dict(r) for r in rows], on_conflict='replace')
+    t.close()
+    stored = len(set(r['tweet_id'] for r in rows))
+
+    t = DTweets(directory=directory, parallelism=2)
+    print 'pruning: Mar-May 2015 -> %s' % t.partitions_between(
+            datetime(2015, 3, 1), datetime(2015, 6, 1))
+    start = time.time()
+    latest = [r['tweet_id'] for r in t.get_latest(limit)]
+    elapsed = time.time() - start
+    expected = sorted(set(r['tweet_id'] for r in rows), reverse=True)[:limit]
+    print 'get_latest(%d): %.1f msec, %s, partitions opened %s' % (limit,
+            elapsed * 1e3, 'ok' if latest == expected else 'MISMATCH',
+            t.open_parts)
+
+    # parallel reads first, so worker threads hold connections to 201502
+    for i in xrange(4):
+        before = t.q('SELECT COUNT(*) FROM tweets', None, 'NUMBER')
+    archived = sum(len(r) for r in t.q('SELECT * FROM tweets', None,
+            'ALL_ROWS', partition_name=['201502']))
+    t.archive_partition('201502', directory + '_archive')
+    t.insert(make_sample_row(DTweets.snowflake_id_at(datetime(2015, 2, 14))))
+    after = sum(len(r) for r in t.q('SELECT * FROM tweets'))
+    print 'archive 201502: %d rows before, %d after (expecting %d)' % (
+            sum(before), after, stored - archived + 1)
+    t.close()
+
+def bench_poller(directory='/tmp/tt_bench/poller', token_count=3,
+        user_count=10, latency=0.05, workers=4):
+    '''Tt_Poller against a fake API (latency sec per call): first pass,
+        calls per token, caught-up second pass, a page that cannot be
+        stored (must count as an error, not stall the poller), and a home
+        timeline sharing its tweets with a user timeline
+    '''
+    import shutil
+    import threading
+    import collections
+    import tp
+    import tt_poll
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    calls = []
+
+    def make_status(tweet_id, user_id):
+        return {'id': tweet_id, 'text': 'tweet %d' % tweet_id, 'entities': {},
+                'created_at': 'Wed Aug 27 13:08:45 +0000 2008',
+                'user': {'id': user_id}, 'retweeted': False, 'source': 'web',
+                'retweet_count': 0, 'favorite_count': 0, 'favorited': False}
+
+    class FakeTimeline(tp.TpTimeline):
+        '''serves 1000 tweets per timeline; user 0 is the home timeline'''
+        broken_users = set()
+        # user whose tweets the home timeline serves
+        home_serves = 0
+
+        def __init__(self, token_dict, api_opts=None):
+            super(FakeTimeline, self).__init__([])
+            self.key = token_dict['key']
+
+        def _api(self, tweepy_method_name, **kwargs):
+            time.sleep(latency)
+            calls.append(self.key)
+            user_id = kwargs.get('user_id', self.home_serves)
+            newest = (user_id + 1) * 100000
+            result = []
+            for tweet_id in xrange(min(newest, kwargs.get('max_id', newest)),
+                    max(newest - 1000, kwargs.get('since_id', 0)), -1):
+                if len(result) == kwargs['count']:
+                    break
+                result.append(make_status(tweet_id, user_id))
+                if user_id in self.broken_users:
+                    # no 'user': utils.store_tweets() fails on this page
+                    del result[-1]['user']
+            return result
+
+    class FakePoller(tt_poll.Tt_Poller):
+        TIMELINE_CLASS = FakeTimeline
+
+    tokens = [('profile%d' % i, {'key': 'key%d' % i, 'secret': 'secret'},
+        1000 + i) for i in xrange(token_count)]
+    user_ids = range(1, user_count + 1)
+    for label in ('first pass', 'second pass'):
+        del calls[:]
+        poller = FakePoller(tokens, user_ids, workers=workers,
+                directory=directory)
+        start = time.time()
+        poller.run(once=True)
+        print '%s: %.2f sec, %s' % (label, time.time() - start, poller.stats)
+        print '  calls per token: %s' % dict(collections.Counter(calls))
+
+    FakeTimeline.broken_users.add(user_count + 1)
+    poller = FakePoller(tokens, [user_count + 1], home_timelines=False,
+            workers=workers, directory=directory)
+    runner = threading.Thread(target=poller.run, kwargs={'once': True})
+    runner.daemon = True
+    runner.start()
+    runner.join(30)
+    print 'unstorable page: %s, %s' % (
+            'stalled' if runner.is_alive() else 'returned', poller.stats)
+
+    # both walks store the same ids; neither may wipe the other's column
+    shutil.rmtree(directory)
+    FakeTimeline.home_serves = 1
+    for label in ('shared, first pass', 'shared, second pass'):
+        poller = FakePoller(tokens[:1], [1], workers=workers,
+                directory=directory)
+        poller.run(once=True)
+        timelines = DTimelines(directory)
+        print '%s: %s, on both timelines: %d' % (label, poller.stats,
+                timelines.q('''SELECT COUNT(*) FROM timelines
+                    WHERE home_timeline=:owner AND user_timeline=1''',
+                    {'owner': tokens[0][2]}, 'NUMBER'))
+        timelines.close()
+    FakeTimeline.home_serves = 0
+
+BENCHMARKS = {
+        'last_update': bench_last_update,
+        'row_decoder': bench_row_decoder,
+        'routing': bench_routing,
+        'profiles': bench_profiles,
+        'statements': bench_statements,
+        'write_behind': bench_write_behind,
+        'refresh': bench_refresh,
+        'known_ids': bench_known_ids,
+        'lazy': bench_lazy,
+        'compact': bench_compact,
+        'analytics': bench_analytics,
+        'poller': bench_poller,
+        'scatter': bench_scatter,
+        'monthly': bench_monthly,
+        }
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        BENCHMARKS[sys.argv[1]]()
+        sys.exit(0)
 
     t = DTweets(directory='/tmp/tt/', verbose=False, partition_scale=1)
     tl = DTimelines() 
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import sys
+import os
+import time
+import utils
+try:
+    import simplejson as json
+except:
+    import json
+
+# inputs and expected output of process_entities(); rendered by the original
+# string-concatenating implementation, which the current one must match
+GOLDEN_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        '..', 'etc', 'entities_golden.json')
+
+def load_golden(filename=GOLDEN_FILENAME):
+    '''list of {'tweet':.., 'options':.., 'html_text':.., 'xml_text':..}'''
+    with open(filename) as f:
+        return json.load(f)
+
+def test_golden():
+    '''process_entities() output must be identical to the golden corpus'''
+    cases = load_golden()
+    failed = 0
+    for i, case in enumerate(cases):
+        (html_text, xml_text) = utils.process_entities(case['tweet'],
+                case['options'])
+        if html_text != case['html_text'] or xml_text != case['xml_text']:
+            failed += 1
+            print 'case %d (options %s) differs:' % (i, case['options'])
+            print '  expected html: %r' % case['html_text']
+            print '  got html:      %r' % html_text
+            print '  expected xml:  %r' % case['xml_text']
+            print '  got xml:       %r' % xml_text
+    print '%d/%d golden cases OK' % (len(cases) - failed, len(cases))
+    return failed == 0
+
+def bench_entities(rounds=500):
+    '''process_entities() throughput over the golden corpus, in tweets/sec'''
+    cases = load_golden()
+    for label, selected in [
+            ('all', cases),
+            ('media', [c for c in cases
+                if 'media' in (c['tweet'].get('entities') or {})]),
+            ]:
+        start = time.time()
+        for i in xrange(rounds):
+            for case in selected:
+                utils.process_entities(case['tweet'], case['options'])
+        elapsed = time.time() - start
+        print '%-5s: %.0f tweets/sec' % (label, rounds * len(selected) / elapsed)
+
+def bench_batch(tweet_count=50000, processes=4):
+    '''process_entities() per tweet vs. process_entities_batch(), in
+        process and with a process pool
+    '''
+    cases = load_golden()
+    tweets = [cases[i % len(cases)]['tweet'] for i in xrange(tweet_count)]
+    options = {'html_photo_link': 'thumb'}
+
+    start = time.time()
+    expected = [utils.process_entities(tweet, options) for tweet in tweets]
+    print 'per tweet: %.0f tweets/sec' % (tweet_count / (time.time() - start))
+
+    for label, kwargs in [
+            ('batch', {}),
+            ('batch, %d processes' % processes, {'processes': processes}),
+            ]:
+        start = time.time()
+        rendered = utils.process_entities_batch(tweets, options, **kwargs)
+        elapsed = time.time() - start
+        print '%s: %.0f tweets/sec%s' % (label, tweet_count / elapsed,
+                '' if rendered == expected else ' (OUTPUT DIFFERS)')
+
+BENCHMARKS = {
+        'entities': bench_entities,
+        'batch': bench_batch,
+        }
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        BENCHMARKS[sys.argv[1]]()
+        sys.exit(0)
+
+    sys.exit(0 if test_golden() else 1)
@@ -4,6 +4,8 @@ sys.path.append('../lib/tweepy')
 import tweepy
 import time
 import re
+import threading
+import sqlite3
 import utils
 from httplib import HTTPResponse
 from datetime import datetime
@@ -28,6 +30,12 @@ class TpManager(object):
     _tweepy_limits= None
     # tuple ('GET','api/path'). if not initialized then None
     _last_api= None
+    # guards the limit dicts above; TpObjects in several threads update them
+    _limits_lock= threading.Lock()
+    # persists limit snapshots across processes (e.g. db.DRateLimits); see set_limit_store()
+    _limit_store= None
+    # sec until a rate-limited window resets, when the API does not say
+    RATE_LIMIT_WINDOW = 900
 
     @classmethod
     def set_api_credentials(cls, credential_dict):
@@ -129,20 +137,130 @@ class TpManager(object):
                 'call_time': int(time.time()) 
                 }
 
-        # update api limit info
-        if api_method_path_str is not None:
-            if cls._api_limits is None:
-                cls._api_limits = {}
-            if not profile_str in cls._api_limits:
-                    cls._api_limits[profile_str]= {}
-            cls._api_limits[profile_str][api_method_path_str]= limit_info 
-
-        # update "tweepy call" limit info 
-        if cls._tweepy_limits is None:
-            cls._tweepy_limits = {}
-        if not profile_str in cls._tweepy_limits:
-                cls._tweepy_limits[profile_str]= {}
-        cls._tweepy_limits[profile_str][tweepy_method_str]= limit_info
+        with cls._limits_lock:
+            # update api limit info
+            if api_method_path_str is not None:
+                if cls._api_limits is None:
+                    cls._api_limits = {}
+                if not profile_str in cls._api_limits:
+                        cls._api_limits[profile_str]= {}
+                cls._api_limits[profile_str][api_method_path_str]= limit_info 
+
+            # update "tweepy call" limit info 
+            if cls._tweepy_limits is None:
+                cls._tweepy_limits = {}
+            if not profile_str in cls._tweepy_limits:
+                    cls._tweepy_limits[profile_str]= {}
+            cls._tweepy_limits[profile_str][tweepy_method_str]= limit_info
+            store = cls._limit_store
+
+        # best effort, and outside the lock: other threads must not wait on sqlite
+        if store is not None:
+            try:
+                store.save(profile_str, 'tweepy', tweepy_method_str, limit_info)
+                if api_method_path_str is not None:
+                    store.save(profile_str, 'api', api_method_path_str, limit_info)
+            except sqlite3.Error as e:
+                sys.stderr.write('unable to persist rate limits of %s: %s\n'
+                        % (tweepy_method_str, str(e)))
+
+    @classmethod
+    def set_limit_store(cls, store):
+        """persists every limit snapshot from now on into store (a db.DRateLimits, or
+            anything with its save()/get_limits()/expire()) and loads the snapshots
+            other processes left there; None stops persisting
+        """
+        with cls._limits_lock:
+            cls._limit_store = store
+        if store is not None:
+            store.expire()
+            cls.reload_limits()
+
+    @classmethod
+    def reload_limits(cls):
+        """merges the stored snapshots still in their window into memory; a stored
+            snapshot wins if it is more recent. call it now and then to see
+            what other processes spent
+        """
+        store = cls._limit_store
+        if store is None:
+            return
+        try:
+            stored = dict((kind, store.get_limits(kind=kind)) for kind in ['tweepy', 'api'])
+        except sqlite3.Error as e:
+            sys.stderr.write('unable to load rate limits: %s\n' % str(e))
+            return
+        with cls._limits_lock:
+            for (kind, attr) in [('tweepy', '_tweepy_limits'), ('api', '_api_limits')]:
+                if getattr(cls, attr) is None:
+                    setattr(cls, attr, {})
+                limits = getattr(cls, attr)
+                for (profile_str, endpoints) in stored[kind].iteritems():
+                    mine = limits.setdefault(profile_str, {})
+                    for (endpoint, limit_info) in endpoints.iteritems():
+                        if (not endpoint in mine
+                                or mine[endpoint]['call_time'] < limit_info['call_time']):
+                            mine[endpoint] = limit_info
+
+    @classmethod
+    def mark_rate_limited(cls, profile_str, tweepy_method_str, reset_time=None, limit=None):
+        """records that a profile has no calls left for a tweepy call until reset_time
+            (default: RATE_LIMIT_WINDOW from now), e.g. after a 429
+        """
+        now = int(time.time())
+        try:
+            reset_time = int(reset_time)
+        except (TypeError, ValueError):
+            reset_time = now + cls.RATE_LIMIT_WINDOW
+        cls.update_api_limits(profile_str, tweepy_method_str, None, {
+            'x-rate-limit-remaining': 0,
+            'x-rate-limit-limit': -1 if limit is None else limit,
+            # never in the past; a skewed clock must not cause a retry storm
+            'x-rate-limit-reset': max(reset_time, now + 1),
+            })
+
+    @classmethod
+    def count_call(cls, profile_str, tweepy_method_str):
+        """spends one call of a known budget ahead of the response headers"""
+        with cls._limits_lock:
+            info = ((cls._tweepy_limits or {}).get(profile_str) or {}).get(tweepy_method_str)
+            if info and info['remaining'] > 0 and info['reset_time'] > time.time():
+                info['remaining'] -= 1
+
+    @classmethod
+    def get_headroom(cls, profile_str, tweepy_method_str, now=None):
+        """(calls left, reset_time) of a tweepy call for a profile. calls left is None if
+            unknown (not called yet, or no rate-limit headers); a window whose reset_time
+            has passed is full again
+        """
+        now = time.time() if now is None else now
+        info = ((cls._tweepy_limits or {}).get(profile_str) or {}).get(tweepy_method_str)
+        if not info or info['remaining'] < 0:
+            return (None, None)
+        if info['reset_time'] <= now:
+            return (None if info['limit'] < 0 else info['limit'], None)
+        return (max(info['remaining'], 0), info['reset_time'])
+
+    @classmethod
+    def pick_profile(cls, profile_strs, tweepy_method_str, now=None):
+        """returns (profile_str, None) for the profile with the most calls left for a
+            tweepy call (unknown counts as most; ties go to the first in profile_strs),
+            or (None, earliest reset_time) if all of them are exhausted
+        """
+        best = None
+        best_left = 0
+        earliest_reset = None
+        for profile_str in profile_strs:
+            (left, reset_time) = cls.get_headroom(profile_str, tweepy_method_str, now)
+            if left is None:
+                left = sys.maxint
+            if left > best_left:
+                (best, best_left) = (profile_str, left)
+            elif left <= 0 and (earliest_reset is None or reset_time < earliest_reset):
+                earliest_reset = reset_time
+        if best is not None:
+            return (best, None)
+        return (None, earliest_reset)
 
 """TpObject is a wrapper around tweepy API objects but provides multi-profile (access_token) facilities at runtime"""
 class TpObject(object):
@@ -152,14 +270,12 @@ class TpObject(object):
     # time to wait (sec) between each 500 retry
     RETRY_SLEEP = 10
 
-    # yes, we want to recycle tokens (maybe they will become available while we wait)
-    RETRY_RECYCLE_TOKENS = True
-
-    # 60 seconds minimum required before all tokens are recycled; if not met then will stop retrying 
-    RETRY_RECYCLE_TOKENS_MIN_TIME = 60
+    # when every token is rate-limited, sleep until the earliest reset if it is at most
+    # this many sec away (None = always); otherwise give up with ERROR_RATE_LIMIT
+    RATE_LIMIT_MAX_WAIT = 900
 
-    # recycle at most three rounds
-    RETRY_RECYCLE_COUNT_MAX = 3
+    # sec added to a reset time before calling again (clock skew)
+    RATE_LIMIT_SLACK = 2
 
     # can be 'RAW', 'MODEL', 'JSON' (default=None=Model Parser)
     TWEEPY_PARSER = None 
@@ -187,42 +303,20 @@ class TpObject(object):
             # token_dict seems to be invalid
             return False
 
-    def __try_another_access_token(self):
-        """go to the next access token in the list; returns False if no more tokens are available"""
-        if not isinstance(self.__access_tokens, list):
-            return False
-
-        found_current_token = False
-
-        # find current position
-        for token_dict in self.__access_tokens:
-            if TpManager.make_profile_str(token_dict) == self.__profile_str:
-                found_current_token = True
-            else:
-                if found_current_token:
-                    # the next position after the current token is what we need
-                    return self.__set_access_token(token_dict)
-
-        # if we arrive at here, then we have no more tokens
-        if not self.RETRY_RECYCLE_TOKENS:
-            # no recycling; quit
-            return False
-        if self.__last_recycle_time is not None:
-            time_between_recycles = datetime.time(datetime.now()) - self.__last_recycle_time
-            if time_between_recycles < self.RETRY_RECYCLE_TOKENS_MIN_TIME:
-                return False
-        # recycle
-        self.__set_access_token(self.__access_tokens[0])
-
-        self.__last_recycle_time = datetime.time(datetime.now()) 
-        if self.__recycle_count is None: 
-            self.__recycle_count = 1
-        else:
-            self.__recycle_count += 1
-
-        if self.RETRY_RECYCLE_COUNT_MAX and self.__recycle_count > self.RETRY_RECYCLE_COUNT_MAX:
-            # maximum recycling count reached
-            return False
+    def __choose_access_token(self, tweepy_method_str):
+        """switches to the token with the most calls left for tweepy_method_str (the
+            current one on a tie); returns None, or the earliest reset time if every
+            token is exhausted
+        """
+        profile_strs = [self.__profile_str] + [TpManager.make_profile_str(token_dict)
+                for token_dict in self.__access_tokens]
+        (profile_str, reset_time) = TpManager.pick_profile(profile_strs, tweepy_method_str)
+        if profile_str is None:
+            return reset_time
+        if profile_str != self.__profile_str:
+            print '[debug] switching access token for', tweepy_method_str
+            self.__set_access_token(self.__token_by_profile[profile_str])
+        return None
 
     def add_token(self, tokens):
         """adds an access token to the current access_token list for subsequent consumption"""
@@ -230,8 +324,10 @@ class TpObject(object):
             for token in tokens:
                 self.add_token(token)
         elif isinstance(tokens, dict):
-            # TODO: check if this token is already in the list
-            self.__access_tokens.append(tokens)
+            profile_str = TpManager.make_profile_str(tokens)
+            if profile_str and not profile_str in self.__token_by_profile:
+                self.__access_tokens.append(tokens)
+                self.__token_by_profile[profile_str] = tokens
         else:
             raise TypeError('expecting tokens to be of list or dict type')
 
@@ -241,6 +337,8 @@ class TpObject(object):
         self.__api= None 
         self.__api_opts= {} if not api_opts else api_opts
         self.__access_tokens=[]
+        # profile_str -> token_dict
+        self.__token_by_profile= {}
         self.add_token(tokens)
         
         # initially use the first token
@@ -344,12 +442,25 @@ class TpObject(object):
             give_up = False
             retry_count= 0
            
-            # dynamically call the Tweepy API; if API not found; throws AttributeError 
-            print "[debug] getting function: ", tweepy_method_name
-            func= getattr(self.__api, tweepy_method_name)
-            print '[debug] found function: ', func
-
             while not give_up:
+                # call with whichever token has the most calls left
+                reset_time = self.__choose_access_token(tweepy_method_name)
+                if reset_time is not None:
+                    wait = reset_time - time.time() + self.RATE_LIMIT_SLACK
+                    if self.RATE_LIMIT_MAX_WAIT is not None and wait > self.RATE_LIMIT_MAX_WAIT:
+                        # no call was made: the last call info (if any) is not ours
+                        return (self.ERROR_RATE_LIMIT, 429, {
+                            'limit': None, 'remaining': 0, 'time_reset': reset_time})
+                    print '[debug] all tokens rate-limited; sleeping %d sec' % wait
+                    time.sleep(max(wait, 0))
+                    continue
+                TpManager.count_call(self.__profile_str, tweepy_method_name)
+
+                # dynamically call the Tweepy API (of the token chosen); if API not
+                # found; throws AttributeError 
+                print "[debug] getting function: ", tweepy_method_name
+                func= getattr(self.__api, tweepy_method_name)
+                print '[debug] found function: ', func
                 try:
                     print "[debug] running"
                     api_result = func(*args, **kwargs)
@@ -367,7 +478,7 @@ class TpObject(object):
                             api_result = (self.ERROR_SERVER_DOWN, te.response.status)
                         else:
                             if self.RETRY_SLEEP:
-                                sleep(self.RETRY_SLEEP)
+                                time.sleep(self.RETRY_SLEEP)
                     elif te.response and te.response.status in (400, 401):
                         # unauthorized; credential error; or trying to open a protected account 
                         give_up = True
@@ -388,18 +499,19 @@ class TpObject(object):
                         api_result = (self.ERROR_BAD_UPLOAD, te.response.status)
 
                     elif te.response and te.response.status in (429, 420):
-                        # rate-limited; API 1.0 gives 420; API 1.1 gives 429
-                        rate_limit_info = {
-                                'limit': te.response.getheader('X-Rate-Limit-Limit', None),
-                                'remaining': te.response.getheader('X-Rate-Limit-Remaining', None),
-                                'time_reset': te.response.getheader('X-Rate-Limit-Reset', None),
-                        }
-           
-                        # all subsequent calls will be done using this "next token"
-                        if not self.__try_another_access_token():
-                            # no more access tokens available
-                            give_up = True
-                            api_result = (self.ERROR_RATE_LIMIT, te.response.status, rate_limit_info)
+                        # rate-limited; API 1.0 gives 420; API 1.1 gives 429. the next
+                        # round calls with another token, or sleeps until the earliest reset
+                        TpManager.mark_rate_limited(self.__profile_str, tweepy_method_name,
+                                te.response.getheader('X-Rate-Limit-Reset', None),
+                                te.response.getheader('X-Rate-Limit-Limit', None))
+                        retry_count += 1
+                        if retry_count >= self.RETRY_MAX:
+                            # the limits just marked must not be overwritten by the
+                            # headers of this response
+                            return (self.ERROR_RATE_LIMIT, te.response.status, {
+                                'limit': None, 'remaining': 0,
+                                'time_reset': TpManager.get_headroom(
+                                    self.__profile_str, tweepy_method_name)[1]})
                     else:
                         # unknown status code 
                         print "[debug] error ", te.response.status
@@ -427,6 +539,16 @@ class TpMyself(TpObject):
 class TpTimeline(TpObject):
     TWEEPY_PARSER= 'JSON'
 
+    # tweets per API call (the API maximum)
+    PAGE_SIZE = 200
+
+    # how far back each timeline can be paged through with max_id
+    TIMELINE_WINDOW = {
+            'home_timeline': 800,
+            'user_timeline': 3200,
+            'mentions_timeline': 800,
+            }
+
     def __init__(self, tokens, api_opts=None):
         super(TpTimeline,self).__init__(tokens, api_opts)
 
@@ -436,56 +558,122 @@ class TpTimeline(TpObject):
             raise TypeError('expecting tl_list to be of type list')
 
         for status_obj in tl_list:
-            if isinstance(status_obj, dict):
-                if html_opts or isinstance(html_opts, dict):
-                    # useable: status_obj['text'], status_obj['user']['screen_name'], ...
-                    (html_text, xml_text) = process_html(status_obj, html_opts)
-                    status_obj['html_text'] = html_text
-                    status_obj['xml_text'] = xml_text
-            else:
+            if not isinstance(status_obj, dict):
                 raise TypeError('expecting a dict in status_obj') 
+        if not (html_opts or isinstance(html_opts, dict)):
+            return
 
+        # useable: status_obj['text'], status_obj['user']['screen_name'], ...
+        rendered = utils.process_entities_batch(tl_list, html_opts)
+        for (status_obj, (html_text, xml_text)) in zip(tl_list, rendered):
+            status_obj['html_text'] = html_text
+            status_obj['xml_text'] = xml_text
 
-    def get_my_mentions(self, opts_dict={}, html_opts_dict={}):
+
+    def __make_timeline_call(self, user=None, opts_dict={}, mentions=False):
+        """returns (tweepy_method_name, opts_dict_) for the timeline call"""
         # TODO: validate opts_dict
         opts_dict_= opts_dict.copy()
-        if not 'count' in opts_dict:
-            opts_dict['count'] = 200
+
+        if mentions:
+            tweepy_method_name= 'mentions_timeline'
+        elif user is None: 
+            tweepy_method_name= 'home_timeline'
+        else:
+            tweepy_method_name= 'user_timeline'
+            if isinstance(user, int):
+                opts_dict_['user_id'] = user
+                if 'screen_name' in opts_dict_:
+                    opts_dict_.pop('screen_name')
+            elif isinstance(user, basestring):
+                opts_dict_['screen_name'] = user
+        if not 'count' in opts_dict_:
+            opts_dict_['count'] = self.PAGE_SIZE
+        return (tweepy_method_name, opts_dict_)
+
+    def get_my_mentions(self, opts_dict={}, html_opts_dict={}):
+        (tweepy_method_name, opts_dict_)= self.__make_timeline_call(
+                opts_dict=opts_dict, mentions=True)
 
         # call API; if fail then it may return a tuple
-        api_result= self._api('mentions_timeline', **opts_dict_)
+        api_result= self._api(tweepy_method_name, **opts_dict_)
         if isinstance(api_result, list):
-            self.__process_timeline(api_result)
+            self.__process_timeline(api_result, html_opts_dict)
     
-        retur api_result
+        return api_result
 
     def get_timeline(self, user=None, opts_dict={}, html_opts_dict={}):
         """get timeline as list of dict. user may be (int)userID or (str)screenName
             may return (BAD_CREDENTIALS, 401) if trying to open a protected account
         """
-        # TODO: validate opts_dict
-        opts_dict_= opts_dict.copy()
-
-        if user is None: 
-            tweepy_method_name= 'home_timeline'
-        else:
-            tweepy_method_name= 'user_timeline'
-            if isinstance(user, int):
-                opts_dict['user_id'] = user
-                if 'screen_name' in opts_dict:
-                    opts_dict.pop('screen_name')
-            elif isinstance(user, basestring):
-                opts_dict['screen_name'] = user
-        if not 'count' in opts_dict:
-            opts_dict['count'] = 200
+        (tweepy_method_name, opts_dict_)= self.__make_timeline_call(user,
+                opts_dict)
 
         # call API; if fail then it may return a tuple
         api_result= self._api(tweepy_method_name, **opts_dict_)
         if isinstance(api_result, list):
-            self.__process_timeline(api_result)
+            self.__process_timeline(api_result, html_opts_dict)
     
         return api_result
 
+    def iter_timeline_pages(self, user=None, opts_dict={}, html_opts_dict={},
+            since_id=None, max_id=None, known_ids=None, mentions=False):
+        """yields pages (lists of dict, newest first) of a timeline as they
+            arrive, walking back with max_id until since_id (e.g. the stored
+            high-water mark), the end of the API's window (TIMELINE_WINDOW) or
+            a page overlapping tweets already stored is reached.
+            user is as in get_timeline(); mentions=True pages the mentions.
+            known_ids(tweet_ids) should return the set of ids already stored
+            (e.g. DTimelines.known_ids); those are dropped from the last page.
+            html_opts_dict=None skips rendering (e.g. for utils.store_tweets)
+            on failure the error tuple (ERROR_xx, response_code, ..) is
+            yielded as the last item
+        """
+        (tweepy_method_name, opts_dict_)= self.__make_timeline_call(user,
+                opts_dict, mentions)
+        if since_id is not None:
+            opts_dict_['since_id'] = since_id
+        if max_id is not None:
+            opts_dict_['max_id'] = max_id
+        window = self.TIMELINE_WINDOW.get(tweepy_method_name)
+        fetched = 0
+
+        while True:
+            api_result= self._api(tweepy_method_name, **opts_dict_)
+            if not isinstance(api_result, list):
+                yield api_result
+                return
+            if not api_result:
+                return
+            fetched += len(api_result)
+            # max_id is inclusive; continue below the oldest tweet seen
+            oldest_id = min(int(status_obj['id']) for status_obj in api_result)
+
+            page = api_result
+            if since_id is not None:
+                page = [status_obj for status_obj in page
+                        if int(status_obj['id']) > int(since_id)]
+            overlapped = False
+            if known_ids is not None and page:
+                known = known_ids([status_obj['id'] for status_obj in page])
+                if known:
+                    overlapped = True
+                    page = [status_obj for status_obj in page
+                            if not int(status_obj['id']) in known]
+            if page:
+                self.__process_timeline(page, html_opts_dict)
+                yield page
+
+            if overlapped or len(page) < len(api_result):
+                # reached tweets we already have
+                return
+            if window is not None and fetched >= window:
+                return
+            if since_id is not None and len(api_result) < opts_dict_['count']:
+                # a short page above since_id: caught up, save the empty call
+                return
+            opts_dict_['max_id'] = oldest_id - 1
+
 
 class TpFriends(TpObject):
     # having Tweepy returning a JSON object is more efficient
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# polls many timelines of many profiles concurrently
+import sys
+import os
+import time
+import json
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+from tt import Tt_ConsoleApp, Tt_UserError
+import utils
+from db import DProfiles, DTweets, DTimelines, DRateLimits
+from tp import TpManager, TpTimeline
+
+
+class Tt_Poller(object):
+    """polls home timelines of profiles and user timelines concurrently.
+        a thread pool fetches pages (at most one request in flight per access
+        token; tweepy API objects are shared per token and not thread-safe),
+        picking the idle token with the most rate-limit budget left. pages go
+        to one storage thread: tweets are stored as they arrive, DTimelines
+        rows and the cursor once a timeline's walk is complete
+    """
+    DEFAULT_WORKERS = 8
+    # sec between two polls of the same timeline
+    DEFAULT_INTERVAL = 300
+    # sec before retrying a timeline whose poll failed
+    RETRY_DELAY = 60
+    # longest sleep of the scheduler between checks
+    MAX_SLEEP = 30
+    # sec between reloads of the rate limits other processes stored
+    LIMITS_RELOAD_INTERVAL = 60
+    # TpObject used per access token
+    TIMELINE_CLASS = TpTimeline
+
+    def __init__(self, tokens, user_ids=None, home_timelines=True,
+            workers=DEFAULT_WORKERS, interval=DEFAULT_INTERVAL, lazy=False,
+            api_opts=None, directory='../var', verbose=False):
+        """tokens is a list of (profile_alias, access_token_dict, user ID of
+            the profile); user_ids lists the owners of user timelines to follow.
+            directory holds DTimelines and the DTweets archive (in tweets/)
+        """
+        if not tokens:
+            raise ValueError('expecting at least one access token')
+        self.__verbose = verbose
+        self.__workers = workers
+        self.__interval = interval
+        self.__lazy = lazy
+        self.__directory = directory
+        self.__tokens = []
+        self.__targets = []
+        for (alias, token_dict, profile_user_id) in tokens:
+            timeline = self.TIMELINE_CLASS(token_dict, api_opts)
+            # a rate-limited token returns at once; the scheduler waits, not a worker
+            timeline.RATE_LIMIT_MAX_WAIT = 0
+            token = {
+                    'alias': alias,
+                    'user_id': profile_user_id,
+                    'profile_str': TpManager.make_profile_str(token_dict),
+                    'timeline': timeline,
+                    'busy': False,
+                    'last_used': 0,
+                    }
+            self.__tokens.append(token)
+            if home_timelines and not profile_user_id:
+                self.debug_msg('no user ID for profile', alias,
+                        '; not polling its home timeline')
+            elif home_timelines:
+                self.__targets.append(self.__make_target(token, None))
+        for user_id in user_ids or []:
+            self.__targets.append(self.__make_target(None, int(user_id)))
+
+        self.__lock = threading.Lock()
+        self.__changed = threading.Condition(self.__lock)
+        self.__in_flight = 0
+        self.__stopping = False
+        self.__store_queue = Queue.Queue()
+        self.__readers = threading.local()
+        self.__stats = {'polls': 0, 'pages': 0, 'tweets': 0, 'errors': 0}
+
+    def debug_msg(self, *args):
+        if not self.__verbose:
+            return True
+        sys.stdout.write('[%s] ' % self.__class__.__name__)
+        for stuff in args:
+            sys.stdout.write('%s ' % str(stuff))
+        sys.stdout.write('\n')
+
+    @classmethod
+    def __make_target(cls, token, user_id):
+        """a home timeline (of token's profile) or user_id's user timeline"""
+        if user_id is None:
+            return {
+                    'name': 'home_timeline of %s' % token['alias'],
+                    'timeline': 'home_timeline',
+                    'tweepy_method': 'home_timeline',
+                    # the API reads the authenticating user's home timeline;
+                    # DTimelines rows are owned by that user
+                    'user': None,
+                    'owner': token['user_id'],
+                    'cursor_owner': None,
+                    # home timelines can only be read with their own token
+                    'token': token,
+                    'cursor_alias': token['alias'],
+                    'columns': {'home_timeline': token['user_id']},
+                    'state': 'idle',
+                    'next_due': 0,
+                    }
+        return {
+                'name': 'user_timeline of %d' % user_id,
+                'timeline': 'user_timeline',
+                'tweepy_method': 'user_timeline',
+                'user': user_id,
+                'owner': user_id,
+                'cursor_owner': user_id,
+                'token': None,
+                'cursor_alias': DTimelines.ANY_PROFILE,
+                'columns': {'home_timeline': None, 'user_timeline': user_id},
+                'state': 'idle',
+                'next_due': 0,
+                }
+
+    @property
+    def stats(self):
+        return self.__stats.copy()
+
+    def __token_budget(self, token, tweepy_method, now):
+        """(calls left, time when more become available) for a token. a token
+            without rate-limit data yet counts as having the most budget
+        """
+        (left, reset_time) = TpManager.get_headroom(token['profile_str'],
+                tweepy_method, now)
+        if left is None:
+            return (sys.maxint, now)
+        return (left, now if left else reset_time)
+
+    def __pick_token(self, target, now):
+        """(idle token with the most budget for target, None) or (None, time
+            to check again); call with the lock held
+        """
+        candidates = [target['token']] if target['token'] else self.__tokens
+        best = None
+        best_key = None
+        retry_at = None
+        for token in candidates:
+            if token['busy']:
+                continue
+            (budget, available_at) = self.__token_budget(token,
+                    target['tweepy_method'], now)
+            # equal budgets: the least recently used token
+            key = (budget, -token['last_used'])
+            if budget > 0 and (best_key is None or key > best_key):
+                (best, best_key) = (token, key)
+            elif budget <= 0:
+                retry_at = available_at if retry_at is None else min(
+                        retry_at, available_at)
+        if best is not None:
+            return (best, None)
+        return (None, retry_at)
+
+    def __get_reader(self):
+        """DTimelines of the calling worker thread (for cursors and overlap)"""
+        if not hasattr(self.__readers, 'timelines'):
+            self.__readers.timelines = DTimelines(self.__directory,
+                    verbose=self.__verbose, profile='read-mostly')
+        return self.__readers.timelines
+
+    def __fetch(self, target, token):
+        """runs in a worker thread: walks one timeline and queues its pages"""
+        error = None
+        try:
+            timelines = self.__get_reader()
+            since_id = timelines.get_cursor(target['cursor_alias'],
+                    target['timeline'], target['cursor_owner'])
+            if since_id is None:
+                since_id = timelines.get_newest_id(target['timeline'],
+                        target['owner'])
+            self.debug_msg('polling', target['name'], 'as', token['alias'],
+                    'since', since_id)
+            for page in token['timeline'].iter_timeline_pages(target['user'],
+                    since_id=since_id, html_opts_dict=None,
+                    known_ids=lambda ids: timelines.known_ids(ids,
+                        target['timeline'], target['owner'])):
+                if not isinstance(page, list):
+                    error = page
+                    break
+                self.__store_queue.put(('page', target, page))
+        except Exception as e:
+            error = e
+        finally:
+            with self.__lock:
+                token['busy'] = False
+                self.__in_flight -= 1
+                self.__changed.notify_all()
+        self.__store_queue.put(('done', target, error))
+
+    def __store_loop(self):
+        """runs in the storage thread: the only writer of DTweets/DTimelines"""
+        tweets = DTweets(directory=os.path.join(self.__directory, 'tweets'),
+                verbose=self.__verbose, profile='ingest')
+        timelines = DTimelines(self.__directory, verbose=self.__verbose,
+                profile='ingest')
+        # id(target) -> tweet ids of the walk in progress
+        walk_ids = {}
+        # id(target) of walks with a page that could not be stored
+        failed = set()
+        try:
+            while True:
+                item = self.__store_queue.get()
+                if item is None:
+                    break
+                (kind, target, data) = item
+                if kind == 'page':
+                    try:
+                        utils.store_tweets(tweets, data, lazy=self.__lazy)
+                    except Exception as e:
+                        # the walk must not advance its cursor past this page
+                        failed.add(id(target))
+                        sys.stderr.write('unable to store a page of %s: %s\n' % (
+                            target['name'], e))
+                        continue
+                    walk_ids.setdefault(id(target), []).extend(
+                            status_obj['id'] for status_obj in data)
+                    self.__stats['pages'] += 1
+                    self.__stats['tweets'] += len(data)
+                    continue
+
+                ids = walk_ids.pop(id(target), [])
+                if data is None and id(target) in failed:
+                    data = 'a page could not be stored'
+                failed.discard(id(target))
+                if data is None and ids:
+                    try:
+                        written = timelines.insert(ids, auto_close=False,
+                                profile_alias=target['cursor_alias'],
+                                **target['columns'])
+                        if not all(written.values()):
+                            data = 'timeline rows could not be written'
+                    except Exception as e:
+                        timelines.get_db().rollback()
+                        data = e
+                if data is not None:
+                    self.__stats['errors'] += 1
+                    sys.stderr.write('polling %s failed: %s\n' % (
+                        target['name'], data))
+                self.debug_msg(target['name'], ':', len(ids), 'new tweets')
+                with self.__lock:
+                    self.__stats['polls'] += 1
+                    target['state'] = 'idle'
+                    target['next_due'] = time.time() + (
+                            self.__interval if data is None
+                            else self.RETRY_DELAY)
+                    self.__changed.notify_all()
+        finally:
+            tweets.close()
+            timelines.close()
+
+    def run(self, once=False):
+        """polls until stop() is called (or, with once, until every timeline
+            has been polled once)
+        """
+        pool = ThreadPool(self.__workers)
+        store_thread = threading.Thread(target=self.__store_loop,
+                name='tt-poll-store')
+        store_thread.daemon = True
+        store_thread.start()
+        reload_at = time.time() + self.LIMITS_RELOAD_INTERVAL
+        try:
+            with self.__lock:
+                while not self.__stopping:
+                    if once and all(target['state'] == 'idle'
+                            and target['next_due'] > 0
+                            for target in self.__targets):
+                        break
+                    if time.time() >= reload_at:
+                        # budgets spent by other processes (see TpManager.set_limit_store)
+                        TpManager.reload_limits()
+                        reload_at = time.time() + self.LIMITS_RELOAD_INTERVAL
+                    wake_at = self.__dispatch(pool, once)
+                    self.__changed.wait(max(0, min(wake_at - time.time(),
+                        self.MAX_SLEEP)))
+        finally:
+            pool.close()
+            pool.join()
+            self.__store_queue.put(None)
+            store_thread.join()
+
+    def __dispatch(self, pool, once):
+        """starts due polls that have a token; returns when to look again.
+            call with the lock held
+        """
+        now = time.time()
+        wake_at = now + self.MAX_SLEEP
+        for target in sorted(self.__targets, key=lambda t: t['next_due']):
+            if target['state'] != 'idle' or (once and target['next_due'] > 0):
+                continue
+            if target['next_due'] > now:
+                wake_at = min(wake_at, target['next_due'])
+                break
+            if self.__in_flight >= self.__workers:
+                break
+            (token, retry_at) = self.__pick_token(target, now)
+            if token is None:
+                if retry_at is not None:
+                    wake_at = min(wake_at, retry_at)
+                continue
+            target['state'] = 'fetching'
+            token['busy'] = True
+            token['last_used'] = now
+            self.__in_flight += 1
+            pool.apply_async(self.__fetch, (target, token))
+        return wake_at
+
+    def stop(self):
+        """makes run() return once the polls in flight are stored"""
+        with self.__lock:
+            self.__stopping = True
+            self.__changed.notify_all()
+
+
+class Tt_Poll(Tt_ConsoleApp):
+    def __load_tokens(self, aliases=None):
+        """[(profile_alias, access_token_dict, user_id), ..] of authenticated profiles"""
+        profiles = self._get_DProfiles()
+        rows = profiles.get(auth_flag=DProfiles.FLAG_AUTHENTICATED) or []
+        tokens = []
+        for row in sorted(rows, key=lambda row: row['priority']):
+            if aliases and not row['profile_alias'] in aliases:
+                continue
+            try:
+                tokens.append((row['profile_alias'], json.loads(row['auth_data']),
+                    row['user_id']))
+            except ValueError:
+                self.debug_msg('ignoring profile with bad auth_data:',
+                        row['profile_alias'])
+        profiles.close()
+        return tokens
+
+    def __load_user_ids(self, users_str=None, filename=None):
+        user_ids = []
+        if users_str:
+            user_ids.extend(users_str.split(','))
+        if filename:
+            with open(filename) as f:
+                user_ids.extend(line.split('#')[0].strip() for line in f)
+        try:
+            return [int(user_id) for user_id in user_ids if user_id]
+        except ValueError:
+            raise Tt_UserError('expecting numerical twitter user IDs')
+
+    def poll(self):
+        aliases = self.arg('profiles', None)
+        tokens = self.__load_tokens(aliases.split(',') if aliases else None)
+        if not tokens:
+            raise Tt_UserError('no authenticated profiles to poll with')
+        TpManager.set_api_credentials(self.api_credentials)
+        TpManager.set_limit_store(DRateLimits(verbose=self.verbosity>=3))
+        poller = Tt_Poller(tokens,
+                user_ids=self.__load_user_ids(self.arg('users', None),
+                    self.arg('users_file', None)),
+                home_timelines=not self.arg('no_home', False),
+                workers=int(self.arg('workers', None) or Tt_Poller.DEFAULT_WORKERS),
+                interval=int(self.arg('interval', None) or Tt_Poller.DEFAULT_INTERVAL),
+                lazy=self.arg('lazy', False),
+                api_opts={'secure': self.arg('secure', True)},
+                verbose=self.verbosity>=2)
+        try:
+            poller.run(once=self.arg('once', False))
+        except KeyboardInterrupt:
+            self.output('stopping...')
+            poller.stop()
+        stats = poller.stats
+        self.output('%(polls)d polls, %(pages)d pages, %(tweets)d tweets, %(errors)d errors' % stats)
+
+    def __init__(self):
+        super(Tt_Poll, self).__init__(
+                description_str='polls home and user timelines concurrently',
+                output_type='text',
+                args={
+                    '-p,--profiles': {'help': 'comma-separated profile aliases to poll with (default: all authenticated)', 'required': False},
+                    '-u,--users': {'help': 'comma-separated user IDs whose timelines to follow', 'required': False},
+                    '-f,--users-file': {'help': 'file with one user ID per line', 'required': False, 'dest': 'users_file'},
+                    '-n,--no-home': {'help': 'do not poll the home timelines of the profiles', 'action': 'store_true', 'dest': 'no_home'},
+                    '-w,--workers': {'help': 'requests in flight (default %d)' % Tt_Poller.DEFAULT_WORKERS, 'required': False},
+                    '-i,--interval': {'help': 'sec between polls of a timeline (default %d)' % Tt_Poller.DEFAULT_INTERVAL, 'required': False},
+                    '-l,--lazy': {'help': 'store raw entities and render on read', 'action': 'store_true'},
+                    '-o,--once': {'help': 'poll every timeline once, then exit', 'action': 'store_true'},
+                    '-s,--secure': {'help': 'requests HTTPs connection', 'default': True, 'action': 'store_true'},
+                    }
+            )
+        try:
+            self.poll()
+            self.print_output()
+        except Tt_UserError as e:
+            self.output("[Error] %s" % e.message, error=True)
+
+
+#
+# main
+#
+if __name__ == '__main__':
+    Tt_Poll()
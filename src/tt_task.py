@@ -3,8 +3,9 @@
 import re 
 import sys
 from tt import Tt_ConsoleApp, Tt_UserError
-from db import DPeople, DTweets 
-from tp import TpManager, TpTimeLine 
+import utils
+from db import DPeople, DTweets, DTimelines, DRateLimits
+from tp import TpManager, TpTimeline 
 
 class Tt_Task(Tt_ConsoleApp):
     def __force_user_id(self, screen_name):
@@ -19,13 +20,103 @@ class Tt_Task(Tt_ConsoleApp):
         # call users/show API for expired or empty entries
 
     def get_home_timeline(self, alias_str, timeline_owner=None, since_id=None, max_id=None, secure_bool=True):
-        access_token_dict = self.get_access_token(alias_str)
-        if not isinstance(access_token_dict, dict):
+        """fetches the home timeline (or timeline_owner's timeline) page by page into
+            DTweets and DTimelines; each page is stored as it arrives. paging stops at
+            since_id (default: the profile's cursor for that timeline, see
+            DTimelines.get_cursor()) or at the first page overlapping stored tweets
+        """
+        access_tokens = self.get_access_tokens(alias_str)
+        if not access_tokens:
             raise Tt_UserError('unable to authenticate')
+        TpManager.set_api_credentials(self.api_credentials)
+        TpManager.set_limit_store(DRateLimits(verbose=self.verbosity>=3))
+        timeline = TpTimeline(access_tokens, {'secure': secure_bool})
 
-        timeline = TpTimeLine(access_token_dict, {'secure': secure_bool})
+        user = None
+        user_id = None
+        timeline_name = 'home_timeline'
+        if timeline_owner is None:
+            # home timeline rows and overlap checks belong to the authenticating user
+            profiles = self._get_DProfiles()
+            profile_row = profiles.get(profile_alias=alias_str)
+            profiles.close()
+            if not profile_row or not profile_row['user_id']:
+                raise Tt_UserError('profile %s has no user ID; authenticate it again' % alias_str)
+            user_id = profile_row['user_id']
+            timeline_kwargs = {'home_timeline': user_id}
+        else:
+            user_id = self.__force_user_id(timeline_owner)
+            if user_id is not None:
+                user_id = int(user_id)
+            user = timeline_owner if user_id is None else user_id
+            timeline_kwargs = {'home_timeline': None, 'user_timeline': user_id}
+            timeline_name = 'user_timeline'
+
+        tweets = DTweets(verbose=self.verbosity>=3)
+        timelines = DTimelines(verbose=self.verbosity>=3)
+        # a --max walk does not start at the newest tweet; leave the cursor alone
+        cursor_alias = None
+        if max_id is None:
+            cursor_alias = alias_str if user is None else DTimelines.ANY_PROFILE
+        if since_id is None and user_id is not None:
+            since_id = timelines.get_cursor(
+                    alias_str if user is None else DTimelines.ANY_PROFILE,
+                    timeline_name, None if user is None else user_id)
+            if since_id is None:
+                # never polled with a cursor; fall back to what is stored
+                since_id = timelines.get_newest_id(timeline_name, user_id)
+        self.debug_msg('paging', timeline_name, 'since', since_id)
+
+        # tweets are stored page by page; the DTimelines rows and the cursor are
+        # written together once the walk is complete, so an interrupted walk
+        # leaves nothing that would stop the next one short
+        walk_ids = []
+        try:
+            for page in timeline.iter_timeline_pages(user,
+                    since_id=since_id, max_id=max_id, html_opts_dict=None,
+                    known_ids=lambda ids: timelines.known_ids(ids, timeline_name,
+                        user_id)):
+                if not isinstance(page, list):
+                    raise Tt_UserError('API call failed after %d tweets: %s' % (
+                        len(walk_ids), page))
+                if timeline_name == 'user_timeline' and timeline_kwargs['user_timeline'] is None:
+                    # a screen name was given; the page tells whose timeline it is
+                    timeline_kwargs['user_timeline'] = page[0]['user']['id']
+                utils.store_tweets(tweets, page)
+                walk_ids.extend(status_obj['id'] for status_obj in page)
+                self.debug_msg('stored page of', len(page), 'tweets')
+            if walk_ids:
+                timelines.insert(walk_ids, auto_close=False,
+                        profile_alias=cursor_alias, **timeline_kwargs)
+        finally:
+            tweets.close()
+            timelines.close()
+        self.output('%d tweets stored' % len(walk_ids))
+
+    def reindex_tweets(self):
+        """rebuilds the user/reply -> partition index of the tweet archive"""
+        tweets = DTweets(verbose=self.verbosity>=3)
+        tweets.rebuild_index()
+        tweets.close()
         self.output('done') 
 
+    def repartition_tweets(self, target_dir, scheme=None, scale=None):
+        """copies the tweet archive into target_dir using another partition scheme/scale"""
+        tweets = DTweets(verbose=self.verbosity>=3)
+        count = tweets.migrate_partitions(target_dir,
+                partition_scheme=scheme,
+                partition_scale=None if scale is None else int(scale))
+        tweets.close()
+        self.output('%d tweets copied to %s; swap the directories to use it' % (
+            count, target_dir))
+
+    def encode_tweets(self, target_dir, compression=None):
+        """writes a compact archive copy (DTweets_compact) of every partition into target_dir"""
+        tweets = DTweets(verbose=self.verbosity>=3)
+        count = tweets.encode_partitions(target_dir, compression)
+        tweets.close()
+        self.output('%d tweets encoded into %s' % (count, target_dir))
+
     def __init__(self):
         common_args = {
                 'secure': ('-s,--secure', {
@@ -38,7 +129,7 @@ class Tt_Task(Tt_ConsoleApp):
                     'help': 'profile to use for making the request',
                     'required': True,
                     }),
-                'id': ('-i,--id': {'help': 
+                'id': ('-i,--id', {'help': 
                     'twitter screen name or numerical twitter ID (e.g. @cocoa_box), leave blank for authenticating user', 
                     'required': False,
                     }),
@@ -51,12 +142,31 @@ class Tt_Task(Tt_ConsoleApp):
                 'timeline': {
                     'help': 'fetches timeline',
                     'args': {
-                        '-s,--since': {'help': 'since tweet ID', 'required': False},
+                        '-n,--since': {'help': 'since tweet ID', 'required': False},
                         '-x,--max': {'help': 'max tweet ID', 'required': False},
+                        common_args['alias'][0]: common_args['alias'][1],
                         common_args['id'][0]: common_args['id'][1],
                         common_args['secure'][0]: common_args['secure'][1],
                         }
                     },
+                'reindex': {
+                    'help': 'rebuilds the index used to find tweets by user or reply',
+                    },
+                'repartition': {
+                    'help': 'copies the tweet archive into a new partition layout',
+                    'args': {
+                        '-t,--target': {'help': 'directory for the new archive', 'required': True},
+                        '-m,--scheme': {'help': 'partition scheme: %s' % ', '.join(DTweets.PARTITION_SCHEMES), 'required': False},
+                        '-c,--scale': {'help': 'partition scale (1=16 files, 2=256 files)', 'required': False},
+                        }
+                    },
+                'encode': {
+                    'help': 'writes a compact copy of the tweet archive',
+                    'args': {
+                        '-t,--target': {'help': 'directory for the compact archive', 'required': True},
+                        '-z,--compression': {'help': 'none, zlib (default) or zstd', 'required': False},
+                        }
+                    },
                 'followers': {
                     'help': 'gets list of followers',
                     'args': {
@@ -70,10 +180,21 @@ class Tt_Task(Tt_ConsoleApp):
         try:
             if self.command == 'timeline':
                 self.get_home_timeline(self.arg('alias'),
+                        timeline_owner=self.arg('id', None),
                         max_id=self.arg('max', None),
                         since_id=self.arg('since', None),
                         secure_bool=self.arg('secure', True)
                         )
+            elif self.command == 'reindex':
+                self.reindex_tweets()
+            elif self.command == 'repartition':
+                self.repartition_tweets(self.arg('target'),
+                        scheme=self.arg('scheme', None),
+                        scale=self.arg('scale', None)
+                        )
+            elif self.command == 'encode':
+                self.encode_tweets(self.arg('target'),
+                        compression=self.arg('compression', None))
             else:
                 raise Tt_UserError('UNIMPLEMENTED COMMAND: %s' % self.command)
             self.print_output()
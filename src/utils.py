@@ -5,11 +5,87 @@ from datetime import datetime
 from db import DTweets
 import urllib
 import sqlite3
+import re
+import collections
+import threading
+try:
+    import simplejson as json
+except:
+    import json
 
 def parse_timestamp(timestamp_int):
     """convert unix timestamp to a datetime instance; raises TypeError"""
     return datetime.fromtimestamp(int(timestamp_int))
 
+# -- entity rendering; see process_entities() --
+_HTML_ESCAPE_TABLE = {
+    ord(u'&'): u'&amp;',
+    ord(u'"'): u'&quot;',
+    ord(u"'"): u'&apos;',
+    ord(u'>'): u'&gt;',
+    ord(u'<'): u'&lt;',
+}
+
+# unicode.translate() is slow even when nothing maps; most text needs none
+_HTML_ESCAPE_NEEDED = re.compile(u'[&"\'<>]')
+
+def _html_escape(text):
+    """convert some html entities; http://bit.ly/ZlOkFX"""
+    if isinstance(text, unicode):
+        if _HTML_ESCAPE_NEEDED.search(text) is None:
+            return text
+        return text.translate(_HTML_ESCAPE_TABLE)
+    elif isinstance(text, str):
+        # str.translate() only maps to single characters
+        return text.replace('&', '&amp;').replace('"', '&quot;').replace(
+                "'", '&apos;').replace('>', '&gt;').replace('<', '&lt;')
+    return text
+
+# attribute order of each tag. it is the iteration order of the dict
+# literals the renderer used to build, so these literals must keep the
+# same keys in the same order for the output to stay byte-identical
+_TAG_ATTRIBUTES = dict((tag_name, [(key, ' %s="' % key) for key in attrib_dict])
+        for (tag_name, attrib_dict) in [
+    ('size', {'key': 0, 'width': 0, 'height': 0, 'resize': 0, 'url': 0,
+        'url_https': 0}),
+    ('media', {'type': 0, 'id': 0, 'url': 0, 'display_url': 0,
+        'expanded_url': 0}),
+    ('img', {'src': 0, 'alt': 0}),
+    ('a.media', {'class': 0, 'href': 0, 'title': 0}),
+    ('link', {'url': 0, 'display_url': 0, 'expanded_url': 0}),
+    ('a.link', {'class': 0, 'href': 0, 'alt': 0}),
+    ('mention', {'user_id': 0, 'screen_name': 0, 'name': 0}),
+    ('a.mention', {'class': 0, 'href': 0, 'alt': 0}),
+    ('hashtag', {'text': 0}),
+    ('a.hashtag', {'class': 0, 'href': 0}),
+    ('entity', {'type': 0, 'content': 0}),
+    ])
+
+def _render_tag(out, tag_name, attributes, attrib_dict, text='',
+        escape_text=True, short_tags=False):
+    """appends a tag to the list out; attributes is a _TAG_ATTRIBUTES list
+        and None values are left out
+    """
+    out.append('<' + tag_name)
+    empty = True
+    for (key, prefix) in attributes:
+        value = attrib_dict[key]
+        if value is None:
+            continue
+        out.append(prefix)
+        out.append(_html_escape(value) if isinstance(value, basestring)
+                else '%s' % (value,))
+        out.append('"')
+        empty = False
+    if empty:
+        out.append(' ')
+    if not text:
+        out.append(' />' if short_tags else '></%s>' % tag_name)
+    else:
+        out.append('>')
+        out.append(_html_escape(text) if escape_text else text)
+        out.append('</%s>' % tag_name)
+
 def process_entities(tweet_dict, options={}):
     """processes tweet_dict['text'] and tweet_dict['entities']. returns (html_text, xml_text) 
         see https://dev.twitter.com/docs/tweet-entities. available options are:
@@ -17,214 +93,209 @@ def process_entities(tweet_dict, options={}):
             html_photo_size: 'large', 'small', 'thumb', etc
             html_prefer_http': True | False
             xml_full: True | False
+        to render many tweets, use process_entities_batch()
     """
-    def html_escape(text):
-        """convert some html entities; http://bit.ly/ZlOkFX"""
-        if not isinstance(text, basestring):
-            return text
-        html_escape_table = {
-            '&': '&amp;',
-            '"': '&quot;',
-            "'": '&apos;',
-            '>': '&gt;',
-            '<': '&lt;',
-        }
-        return ''.join(html_escape_table.get(c,c) for c in text)
-    
-    def make_tag(tag_name, attrib_dict, text='', escape_text=True, short_tags=False):
-        """generates a tag with or without content"""
-        attrib_list = []
-        for attrib in attrib_dict:
-            if attrib_dict[attrib] is not None:
-                attrib_list.append('%s="%s"' % (attrib, html_escape(attrib_dict[attrib])))
-        attrib_string = ' ' + ' '.join(attrib_list)            
-        if not text:
-            if short_tags:
-                return '<%s%s />' % (tag_name, attrib_string)
-            else:
-                return '<%s%s></%s>' % (tag_name, attrib_string, tag_name)
-        else:
-            text_inside= text if not escape_text else html_escape(text)
-            return '<%s%s>%s</%s>' % (
-                    tag_name, attrib_string, text_inside, tag_name
+    return _render_entities(tweet_dict, _resolve_entity_options(options))
+
+def _resolve_entity_options(options):
+    """process_entities() options as a tuple: (html_photo_link,
+        html_photo_size, html_prefer_https, xml_full, url scheme)
+    """
+    html_opts_prefer_https = options.get('html_prefer_https',True)        
+    return (
+            options.get('html_photo_link','text'),
+            options.get('html_photo_size','large'),
+            html_opts_prefer_https,
+            options.get('xml_full',False),
+            'https' if html_opts_prefer_https else 'http',
             )
 
-    # -- begin: __process_entities --
+def _render_entities_chunk(args):
+    """process pool worker of process_entities_batch()"""
+    (tweet_dicts, resolved_options) = args
+    return [_render_entities(tweet_dict, resolved_options)
+            for tweet_dict in tweet_dicts]
+
+def process_entities_batch(tweet_dicts, options={}, processes=None,
+        chunk_size=500):
+    """process_entities() over a list of tweets with one set of options;
+        returns a list of (html_text, xml_text) in the order of tweet_dicts.
+        with processes > 1 (for large backfills), chunks of chunk_size
+        tweets are rendered by a pool of that many processes
+    """
+    resolved = _resolve_entity_options(options)
+    if not processes or processes < 2 or len(tweet_dicts) <= chunk_size:
+        return [_render_entities(tweet_dict, resolved)
+                for tweet_dict in tweet_dicts]
+
+    import multiprocessing
+    chunks = [(tweet_dicts[i:i + chunk_size], resolved)
+            for i in xrange(0, len(tweet_dicts), chunk_size)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        # map() keeps the chunks in order
+        rendered = pool.map(_render_entities_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for chunk in rendered for result in chunk]
+
+def _render_entities(tweet_dict, resolved_options):
+    """process_entities() with options from _resolve_entity_options()"""
     text = tweet_dict['text']
-    xml_text = ''
-    html_text = ''
-    html_opts_photo_link = options.get('html_photo_link','text')  
-    html_opts_photo_size = options.get('html_photo_size','large')  
-    html_opts_prefer_https = options.get('html_prefer_https',True)        
-    xml_opts_full_xml =  options.get('xml_full',False)        
-
-    if 'entities' in tweet_dict and isinstance(tweet_dict['entities'], dict):
-        output_list = []
-        # create a flattened entities list so we can sort later
-        ent_list= []
-        for ent_type in tweet_dict['entities']:
-            for ent_item in tweet_dict['entities'][ent_type]:
-                ent_list.append({
-                    'type': ent_type,
-                    'item': ent_item,
-                    'pos': ent_item['indices'][0] if 'indices' in ent_item else 0,
-                    'pos_next': ent_item['indices'][1] if 'indices' in ent_item else 0,
-                    'text': ''
-                })
-
-        # sort the list
-        ent_list.sort(key=lambda x: x['pos'])
-       
-        # prepare content_list, which will be the final output in list format
-        content_list= []
-        idx = ent_idx = 0
-        max_element_count = 99999
-        while idx < len(text) and len(content_list) <= max_element_count: 
-            if ent_idx < len(ent_list) and ent_list[ent_idx]['pos'] == idx:
-                # next segment is an entity
-                ent_list[ent_idx]['text'] = text[idx : ent_list[ent_idx]['pos_next']]
-                content_list.append(ent_list[ent_idx])
-                idx = ent_list[ent_idx]['pos_next']  
-                ent_idx += 1
-            else:
-                # next segment is a string (by default, the segment spans till end of the text)
-                string_end_idx = len(text) 
-                if ent_idx < len(ent_list):
-                    string_end_idx = ent_list[ent_idx]['pos'] 
-                content_list.append(text[idx : string_end_idx])
-                idx = string_end_idx 
-
-        # concatenate each member in content_list 
-        for content_list_item in content_list:
-            if isinstance(content_list_item,basestring):
-                html_text += content_list_item
-                xml_text += content_list_item
+    entities = tweet_dict.get('entities')
+    if not isinstance(entities, dict):
+        # no entities found
+        return (text, text)
+
+    (html_opts_photo_link, html_opts_photo_size, html_opts_prefer_https,
+            xml_opts_full_xml, scheme) = resolved_options
+
+    # create a flattened entities list: (pos, pos_next, type, item)
+    ent_list = []
+    for ent_type in entities:
+        for ent_item in entities[ent_type]:
+            if 'indices' in ent_item:
+                ent_list.append((ent_item['indices'][0], ent_item['indices'][1],
+                    ent_type, ent_item))
             else:
-                # is an entity
-                entity = content_list_item['item']
-
-                if content_list_item['type'] == 'media':
-                    html_link_target = ''
-                    thumb_img_src = ''
-
-                    size_html_list= []
-                    for size in entity.get('sizes', {}):
-                        size_dict = entity['sizes'][size] 
-                        url_https = '%s:%s' % (entity.get('media_url_https', ''), size)
-                        url_http = '%s:%s' % (entity.get('media_url', ''), size)
-
-                        size_html_list.append(make_tag('size', {
-                            'key': size, 
-                            'width': size_dict.get('w', 0), 
-                            'height': size_dict.get('h', 0), 
-                            'resize': size_dict.get('resize',''), 
-                            'url': url_http,
-                            'url_https': url_https,
-                        }))
-                        if size == html_opts_photo_size:
-                            html_link_target = url_https if html_opts_prefer_https else url_http
-                        if size == 'thumb':
-                            thumb_img_src= url_https if html_opts_prefer_https else url_http
-
-                    xml_text += make_tag('media', {
-                        'type': entity.get('type', ''),
-                        'id': entity.get('id', ''),
-                        'url': entity.get('url', ''),
-                        'display_url': entity.get('display_url', ''),
-                        'expanded_url': entity.get('expanded_url', ''),
-                    }, ''.join(size_html_list), escape_text=False)
-                    
-                    default_link = entity.get('media_url_https' if html_opts_prefer_https else 'media_url','#')
-                    link_title = None 
-                    link_text = None
-                    escape_text = True 
-                    if 'thumb' == html_opts_photo_link:
-                        if thumb_img_src:
-                            link_text = make_tag('img', {
-                                'src': thumb_img_src,
-                                'alt': entity.get('display_url', 'preview'),
-                            }, short_tags=True)
-                            escape_text = False 
-                        else:
-                            # no thumbnail image available
-                            link_text = entity.get('display_url','')
-                            link_title = 'no thumbnail available'
-                    else:
-                        link_text = entity.get('display_url','')
-
-                    html_text += make_tag('a', {
-                        'class': ('media %s' % entity.get('type','')).strip(),
-                        'href': html_link_target if html_link_target else default_link,
-                        'title': link_title,
-                    }, link_text, escape_text)
-
-                elif content_list_item['type'] == 'urls':
-                    xml_text += make_tag('link', {
-                        'url': entity.get('url', ''),
-                        'display_url': entity.get('display_url', ''),
-                        'expanded_url': entity.get('expanded_url', ''),
-                    }, content_list_item['text'])
-                    
-                    html_text += make_tag('a', {
-                        'class': 'link',
-                        'href': entity.get('url', ''),
-                        'alt': entity.get('expanded_url', ''),
-                    }, content_list_item['text']);
-
-                elif content_list_item['type'] == 'user_mentions':
-                    xml_text += make_tag('mention', {
-                        'user_id': entity.get('id', ''),
-                        'screen_name': entity.get('screen_name', ''),
-                        'name': entity.get('name', ''),
-                    }, content_list_item['text'])
-                    
-                    html_text += make_tag('a', {
-                        'class': 'mention',    
-                        # the safest way to link to a user is by user ID (user can change screen names)
-                        'href': '%s://twitter.com/account/redirect_by_id?id=%s' % (
-                            'https' if html_opts_prefer_https else 'http', entity.get('id', '')
-                        ),
-                        'alt': '%s://twitter.com/%s' % (
-                            'https' if html_opts_prefer_https else 'http', urllib.quote(entity.get('screen_name', ''))
-                        )                                
-                    }, content_list_item['text'])
-
-                elif content_list_item['type'] == 'hashtags':
-                    xml_text += make_tag('hashtag', {
-                        'text': entity.get('text', ''),
-                    }, content_list_item['text'])
-                    
-                    html_text += make_tag('a', {
-                        'class': 'hashtag',    
-                        'href': '%s://twitter.com/search?%s' % (
-                            'https' if html_opts_prefer_https else 'http', 
-                            urllib.urlencode([(
-                                'q',('#'+entity.get('text','')).encode('utf-8')
-                            )])
-                        )
-                    }, content_list_item['text'])
+                ent_list.append((0, 0, ent_type, ent_item))
+    ent_list.sort(key=lambda x: x[0])
 
+    html_out = []
+    xml_out = []
+    ent_count = len(ent_list)
+    text_len = len(text)
+    idx = ent_idx = element_count = 0
+    max_element_count = 99999
+    while idx < text_len and element_count <= max_element_count: 
+        element_count += 1
+        if ent_idx < ent_count and ent_list[ent_idx][0] == idx:
+            # next segment is an entity
+            (pos, pos_next, ent_type, entity) = ent_list[ent_idx]
+            ent_text = text[idx:pos_next]
+            idx = pos_next
+            ent_idx += 1
+        else:
+            # next segment is a string (by default, the segment spans till end of the text)
+            string_end_idx = text_len
+            if ent_idx < ent_count:
+                string_end_idx = ent_list[ent_idx][0]
+            segment = text[idx:string_end_idx]
+            html_out.append(segment)
+            xml_out.append(segment)
+            idx = string_end_idx 
+            continue
+
+        if ent_type == 'media':
+            html_link_target = ''
+            thumb_img_src = ''
+
+            size_xml_list = []
+            sizes = entity.get('sizes', {})
+            for size in sizes:
+                size_dict = sizes[size]
+                url_https = '%s:%s' % (entity.get('media_url_https', ''), size)
+                url_http = '%s:%s' % (entity.get('media_url', ''), size)
+                _render_tag(size_xml_list, 'size', _TAG_ATTRIBUTES['size'], {
+                    'key': size,
+                    'width': size_dict.get('w', 0),
+                    'height': size_dict.get('h', 0),
+                    'resize': size_dict.get('resize', ''),
+                    'url': url_http,
+                    'url_https': url_https,
+                    })
+                if size == html_opts_photo_size:
+                    html_link_target = url_https if html_opts_prefer_https else url_http
+                if size == 'thumb':
+                    thumb_img_src = url_https if html_opts_prefer_https else url_http
+
+            _render_tag(xml_out, 'media', _TAG_ATTRIBUTES['media'], {
+                'type': entity.get('type', ''),
+                'id': entity.get('id', ''),
+                'url': entity.get('url', ''),
+                'display_url': entity.get('display_url', ''),
+                'expanded_url': entity.get('expanded_url', ''),
+                }, ''.join(size_xml_list), escape_text=False)
+
+            default_link = entity.get('media_url_https' if html_opts_prefer_https else 'media_url','#')
+            link_title = None 
+            escape_text = True 
+            if 'thumb' == html_opts_photo_link:
+                if thumb_img_src:
+                    img = []
+                    _render_tag(img, 'img', _TAG_ATTRIBUTES['img'], {
+                        'src': thumb_img_src,
+                        'alt': entity.get('display_url', 'preview'),
+                        }, short_tags=True)
+                    link_text = ''.join(img)
+                    escape_text = False 
                 else:
-                    html_text += '<!-- unknown entity -->%s<!-- end -->' % html_escape(
-                            content_list_item['text']
-                    )
-                    xml_text += make_tag('entity', {
-                        'type': content_list_item['type'], 
-                        'content': content_list_item['item'], 
-                    }, content_list_item['text'])
-
-            
-        return (
-                html_text,
-                '<?xml version="1.0" enoding="utf-8" ?><tweet>%s</tweet>' % xml_text if xml_opts_full_xml else xml_text
-        )
-    else:
-        # no entities found
-        html_text= tweet_dict['text']
-        xml_text= tweet_dict['text'] 
+                    # no thumbnail image available
+                    link_text = entity.get('display_url','')
+                    link_title = 'no thumbnail available'
+            else:
+                link_text = entity.get('display_url','')
+
+            _render_tag(html_out, 'a', _TAG_ATTRIBUTES['a.media'], {
+                'class': ('media %s' % entity.get('type','')).strip(),
+                'href': html_link_target if html_link_target else default_link,
+                'title': link_title,
+                }, link_text, escape_text)
+
+        elif ent_type == 'urls':
+            _render_tag(xml_out, 'link', _TAG_ATTRIBUTES['link'], {
+                'url': entity.get('url', ''),
+                'display_url': entity.get('display_url', ''),
+                'expanded_url': entity.get('expanded_url', ''),
+                }, ent_text)
+            _render_tag(html_out, 'a', _TAG_ATTRIBUTES['a.link'], {
+                'class': 'link',
+                'href': entity.get('url', ''),
+                'alt': entity.get('expanded_url', ''),
+                }, ent_text)
+
+        elif ent_type == 'user_mentions':
+            _render_tag(xml_out, 'mention', _TAG_ATTRIBUTES['mention'], {
+                'user_id': entity.get('id', ''),
+                'screen_name': entity.get('screen_name', ''),
+                'name': entity.get('name', ''),
+                }, ent_text)
+            _render_tag(html_out, 'a', _TAG_ATTRIBUTES['a.mention'], {
+                'class': 'mention',
+                # the safest way to link to a user is by user ID (user can change screen names)
+                'href': '%s://twitter.com/account/redirect_by_id?id=%s' % (
+                    scheme, entity.get('id', '')),
+                'alt': '%s://twitter.com/%s' % (
+                    scheme, urllib.quote(entity.get('screen_name', ''))),
+                }, ent_text)
 
-    # html: <a href="expanded_url" alt="url">url</a>
-    return (html_text, xml_text)
+        elif ent_type == 'hashtags':
+            _render_tag(xml_out, 'hashtag', _TAG_ATTRIBUTES['hashtag'], {
+                'text': entity.get('text', ''),
+                }, ent_text)
+            _render_tag(html_out, 'a', _TAG_ATTRIBUTES['a.hashtag'], {
+                'class': 'hashtag',
+                'href': '%s://twitter.com/search?%s' % (
+                    scheme, urllib.urlencode([(
+                        'q', ('#'+entity.get('text','')).encode('utf-8')
+                    )])),
+                }, ent_text)
+
+        else:
+            html_out.append('<!-- unknown entity -->%s<!-- end -->' % _html_escape(
+                    ent_text))
+            _render_tag(xml_out, 'entity', _TAG_ATTRIBUTES['entity'], {
+                'type': ent_type,
+                'content': entity,
+                }, ent_text)
+
+    html_text = ''.join(html_out)
+    xml_text = ''.join(xml_out)
+    return (
+            html_text,
+            '<?xml version="1.0" enoding="utf-8" ?><tweet>%s</tweet>' % xml_text if xml_opts_full_xml else xml_text
+    )
 
 def extract_tweet_id(tweets):
     lst = tweets if isinstance(tweets, list) else [tweets]
@@ -242,14 +313,27 @@ def extract_tweet_id(tweets):
 
     return res if isinstance(tweets, list) else res[0]
 
-def prepare_DTweet_item(tweet_obj, entities_options={}):
-    """from a Tweepy-returned dict, create a DTweets_part-friendly row"""
-    (html_text, xml_text) = process_entities(tweet_obj)
+def prepare_DTweet_item(tweet_obj, entities_options={}, lazy=False):
+    """from a Tweepy-returned dict, create a DTweets_part-friendly row.
+        with lazy, only the raw entities are kept and html_text/xml_text are
+        rendered when read (see render_stored_tweets())
+    """
+    if lazy:
+        return _make_DTweet_row(tweet_obj, None, None)
+    (html_text, xml_text) = process_entities(tweet_obj, entities_options)
+    return _make_DTweet_row(tweet_obj, html_text, xml_text)
+
+def _make_DTweet_row(tweet_obj, html_text, xml_text):
+    """prepare_DTweet_item() with the entities already rendered; None for
+        both means lazy rendering
+    """
+    lazy = html_text is None and xml_text is None
     return {
             'tweet_id': tweet_obj['id'],
             'plain_text': tweet_obj['text'],
             'html_text': html_text,
             'xml_text': xml_text,
+            'entities': tweet_obj.get('entities') if lazy else None,
             'coordinates': (
                 tweet_obj['coordinates'] 
                 if 'coordinates' in tweet_obj 
@@ -272,6 +356,106 @@ def prepare_DTweet_item(tweet_obj, entities_options={}):
             'is_my_fav': tweet_obj['favorited'],
             }
 
+def prepare_DTweet_counters(tweet_obj):
+    """from a Tweepy-returned dict, create a row holding tweet_id and the
+        counters only (DTweets_part.PERSPECTIVE_COLUMNS); nothing is rendered
+    """
+    return {
+            'tweet_id': tweet_obj['id'],
+            'retweeted_count': tweet_obj['retweet_count'],
+            'fav_count': tweet_obj['favorite_count'],
+            'is_my_fav': tweet_obj['favorited'],
+            }
+
+def prepare_DTweet_items(tweet_objs, tweets=None, entities_options={},
+        lazy=False):
+    """prepare_DTweet_item() for a list of Tweepy-returned dicts. with a
+        DTweets instance, ids already stored are looked up in bulk and only
+        their counters are prepared (see DTweets.known_ids()). returns
+        (new_rows, counter_rows)
+    """
+    known = set()
+    if tweets is not None and tweet_objs:
+        known = tweets.known_ids([tweet_obj['id'] for tweet_obj in tweet_objs])
+    new_objs = []
+    counter_rows = []
+    for tweet_obj in tweet_objs:
+        if int(tweet_obj['id']) in known:
+            counter_rows.append(prepare_DTweet_counters(tweet_obj))
+        else:
+            new_objs.append(tweet_obj)
+    if lazy:
+        return ([_make_DTweet_row(tweet_obj, None, None)
+            for tweet_obj in new_objs], counter_rows)
+    rendered = process_entities_batch(new_objs, entities_options)
+    new_rows = [_make_DTweet_row(tweet_obj, html_text, xml_text)
+            for (tweet_obj, (html_text, xml_text)) in zip(new_objs, rendered)]
+    return (new_rows, counter_rows)
+
+def store_tweets(tweets, tweet_objs, entities_options={}, lazy=False):
+    """stores Tweepy-returned dicts into a DTweets instance; known tweets
+        are neither rendered nor rewritten, only their changed counters are.
+        lazy stores raw entities instead of html_text/xml_text.
+        returns (number of new tweets, number of counter rows updated)
+    """
+    (new_rows, counter_rows) = prepare_DTweet_items(tweet_objs, tweets,
+            entities_options, lazy)
+    if new_rows:
+        tweets.insert(new_rows)
+    refreshed = tweets.refresh_counters(counter_rows) if counter_rows else 0
+    return (len(new_rows), refreshed)
+
+# rendered (html_text, xml_text) of lazily stored tweets, keyed by
+# (tweet_id, resolved options); see render_stored_tweets()
+RENDER_CACHE_SIZE = 10000
+_render_cache = collections.OrderedDict()
+_render_cache_lock = threading.Lock()
+
+def render_stored_tweet(row, options={}):
+    """(html_text, xml_text) of one stored tweet; see render_stored_tweets()"""
+    return render_stored_tweets([row], options)[0]
+
+def render_stored_tweets(rows, options={}):
+    """returns [(html_text, xml_text), ..] for stored tweets (sqlite3.Row or
+        dicts as read from DTweets), in the order of rows. eagerly stored
+        tweets return their stored text. lazily stored ones (html_text NULL)
+        are rendered from their entities with process_entities() options and
+        kept in a bounded LRU shared by the process. None rows (ids
+        DTweets.get_by_id() did not find) give None
+    """
+    resolved = _resolve_entity_options(options)
+    result = [None] * len(rows)
+    todo = []
+    with _render_cache_lock:
+        for (i, row) in enumerate(rows):
+            if row is None:
+                continue
+            if row['html_text'] is not None:
+                result[i] = (row['html_text'], row['xml_text'])
+                continue
+            key = (row['tweet_id'], resolved)
+            rendered = _render_cache.pop(key, None)
+            if rendered is None:
+                todo.append((i, key))
+            else:
+                # re-insert as most recently used
+                _render_cache[key] = result[i] = rendered
+
+    for (i, key) in todo:
+        entities = rows[i]['entities']
+        if isinstance(entities, basestring):
+            entities = json.loads(entities)
+        result[i] = _render_entities(
+                {'text': rows[i]['plain_text'], 'entities': entities},
+                resolved)
+
+    with _render_cache_lock:
+        for (i, key) in todo:
+            _render_cache[key] = result[i]
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    return result
+
 def collect_user_info_from_tweet(tweet_obj):
     """salvage useable user info from a tweepy-returned dict
         returns dict {'user_id':{'prop1':xx, ...}, ...}